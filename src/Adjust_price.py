@@ -0,0 +1,370 @@
+import io
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import psycopg2
+import tushare as ts
+import schema
+import Upload_database
+import Pull_merga_stock
+from Generating_periodic_data import PERIODIC_COLUMNS, load_state, save_state, update_cycles_incremental
+from storage import get_storage, latest_dataset
+from run_manifest import RunManifest, dataset_run_date
+from trade_calendar import CALENDAR_START, next_day
+
+# 复权方式：qfq 前复权（以最新复权因子为基准），hfq 后复权（价格乘以当日复权因子）
+ADJUST_MODES = [mode for mode in os.getenv('ADJUST_MODES', 'qfq,hfq').split(',') if mode]
+
+# 复权数据对应的数据库表，表结构与 stock_data 相同
+ADJUSTED_TABLES = {'qfq': 'stock_data_qfq', 'hfq': 'stock_data_hfq'}
+
+# 复权因子历史：每次增量拉取的交易日写入一个 Parquet 文件，另记录每只股票最新一个交易日的复权因子
+FACTOR_DIR = './data/state/adj_factor'
+FACTOR_LATEST_FILE = './data/state/adj_factor_latest.csv'
+
+# 复权后的价格字段，成交量和成交额不复权
+ADJUSTED_PRICES = ['open', 'high', 'low', 'close', 'pre_close']
+
+
+def state_file(mode):
+    """复权数据的增量状态文件，格式与 Generating_periodic_data.STATE_FILE 相同。"""
+    return f'./data/state/periodic_last_bars_{mode}.csv'
+
+
+def dataset_name(mode, run_date):
+    return f'{mode}_stocks_data_{run_date}'
+
+
+def load_latest_factors(latest_file=FACTOR_LATEST_FILE):
+    """读取每只股票最新的复权因子，返回以 ts_code 为索引的 DataFrame（trade_date、adj_factor），不存在时返回 None。"""
+    if not os.path.isfile(latest_file):
+        return None
+    latest = pd.read_csv(latest_file, dtype={'ts_code': str, 'trade_date': str})
+    return latest.set_index('ts_code')
+
+
+def load_factors(codes=None, factor_dir=FACTOR_DIR):
+    """
+    读取复权因子历史。
+
+    :param codes: 只读取这些股票，默认全部
+    :return: 按 ts_code、trade_date 排序去重的 DataFrame，trade_date 为 datetime64
+    """
+    empty = pd.DataFrame({'ts_code': pd.Series(dtype=str), 'trade_date': pd.Series(dtype='datetime64[ns]'),
+                          'adj_factor': pd.Series(dtype='float64')})
+    if not os.path.isdir(factor_dir) or not os.listdir(factor_dir):
+        return empty
+    filters = [('ts_code', 'in', list(codes))] if codes is not None else None
+    if codes is not None and len(codes) == 0:
+        return empty
+    factors = pq.read_table(factor_dir, filters=filters).to_pandas()
+    factors['ts_code'] = factors['ts_code'].astype(str)
+    # 中断后重新拉取的交易日可能在两个文件中重复出现
+    factors = factors.drop_duplicates(['ts_code', 'trade_date'], keep='last')
+    return factors.sort_values(['ts_code', 'trade_date'], ignore_index=True)
+
+
+def fetch_factors(pro, start_date, end_date, factor_dir=FACTOR_DIR):
+    """
+    按交易日整市场拉取 [start_date, end_date] 的复权因子，写入 factor_dir 下的一个 Parquet 文件。
+    请求经过接口缓存和共享限流器，历史交易日的结果长期缓存，中断后重新拉取不再占用接口额度。
+
+    :return: 拉取到的复权因子，trade_date 为 datetime64
+    """
+    trade_dates = Pull_merga_stock.get_open_trade_dates(pro, start_date, end_date) if start_date <= end_date else []
+    if not trade_dates:
+        return None
+    limiter = Pull_merga_stock.get_limiter()
+    cache = Pull_merga_stock.get_cache()
+    print(f"拉取复权因子：{trade_dates[0]} 至 {trade_dates[-1]}，共 {len(trade_dates)} 个交易日")
+    with ThreadPoolExecutor(limiter.max_concurrency) as executor:
+        frames = list(executor.map(lambda date: cache.call(limiter, 'adj_factor', pro.adj_factor, trade_date=date,
+                                                           fields='ts_code,trade_date,adj_factor'), trade_dates))
+    frames = [frame for frame in frames if frame is not None and not frame.empty]
+    if not frames:
+        return None
+    factors = pd.concat(frames, ignore_index=True)[['ts_code', 'trade_date', 'adj_factor']]
+    factors['trade_date'] = schema.normalize_trade_date(factors['trade_date']).astype('datetime64[ns]')
+    factors['adj_factor'] = factors['adj_factor'].astype('float64')
+
+    # 文件名取本次的最后一个交易日，同一天重新拉取时覆盖
+    os.makedirs(factor_dir, exist_ok=True)
+    path = os.path.join(factor_dir, f'part-{trade_dates[-1]}.parquet')
+    tmp_path = path + '.tmp'
+    pq.write_table(pa.Table.from_pandas(factors, preserve_index=False), tmp_path)
+    os.replace(tmp_path, path)
+    return factors
+
+
+def update_latest_factors(latest, factors):
+    """用新拉取的复权因子中每只股票最后一个交易日的值覆盖原记录。"""
+    new = factors.sort_values(['ts_code', 'trade_date']).drop_duplicates('ts_code', keep='last')
+    new = new.assign(trade_date=new['trade_date'].dt.strftime('%Y%m%d')).set_index('ts_code')[['trade_date', 'adj_factor']]
+    if latest is None:
+        return new.sort_index()
+    return pd.concat([latest[~latest.index.isin(new.index)], new]).sort_index()
+
+
+def save_latest_factors(latest, latest_file=FACTOR_LATEST_FILE):
+    os.makedirs(os.path.dirname(latest_file), exist_ok=True)
+    tmp_file = latest_file + '.tmp'
+    latest.rename_axis('ts_code').to_csv(tmp_file)
+    os.replace(tmp_file, latest_file)
+
+
+def align_factors(daily, factors):
+    """
+    按 (ts_code, trade_date) 为每行日线查找复权因子：ts_code 类别编码与交易日天数组合成整数键查找，不为每行生成字符串。
+    停牌等原因缺少当日因子时沿用同一只股票前一个交易日的因子，之前也没有时取之后最近的因子，仍没有时为 1。
+
+    :param daily: 按 ts_code、trade_date 排序的日线数据，类型见 schema.DTYPES
+    :return: 与 daily 对齐的 float64 数组
+    """
+    categories = daily['ts_code'].cat.categories
+    factor_codes = categories.get_indexer(factors['ts_code'])
+    known = factor_codes >= 0
+    factor_keys = (factor_codes[known].astype('int64') << 32) | factors['trade_date'].to_numpy()[known].astype('datetime64[D]').astype('int64')
+    daily_keys = ((daily['ts_code'].cat.codes.to_numpy().astype('int64') << 32)
+                  | daily['trade_date'].to_numpy().astype('datetime64[D]').astype('int64'))
+    positions = pd.Index(factor_keys).get_indexer(daily_keys)
+    values = np.where(positions >= 0, factors['adj_factor'].to_numpy()[known][positions], np.nan)
+
+    if np.isnan(values).any():
+        filled = pd.Series(values).groupby(daily['ts_code'].cat.codes.to_numpy(), sort=False)
+        values = filled.ffill().fillna(filled.bfill()).fillna(1.0).to_numpy()
+    return values
+
+
+def adjust_daily(daily, scale):
+    """
+    计算复权日线：价格字段乘以 scale 后保留两位小数，change、pct_chg 按复权后的 close、pre_close 重新计算。
+
+    :param daily: 原始日线，列同 PERIODIC_COLUMNS
+    :param scale: 与 daily 对齐的复权系数，后复权为当日因子，前复权为当日因子 / 最新因子
+    :return: 复权日线，列同 PERIODIC_COLUMNS 与 cycle
+    """
+    adjusted = daily[['ts_code', 'trade_date']].reset_index(drop=True)
+    prices = schema.float64_values(daily, ADJUSTED_PRICES) * scale[:, None]
+    prices = prices.round(schema.PRICE_DECIMALS)
+    for i, column in enumerate(ADJUSTED_PRICES):
+        adjusted[column] = prices[:, i].astype('float32')
+    close, pre = prices[:, ADJUSTED_PRICES.index('close')], prices[:, ADJUSTED_PRICES.index('pre_close')]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct_chg = np.where(pre != 0, (close - pre) / pre * 100, 0.0)
+    adjusted['change'] = (close - pre).round(2).astype('float32')
+    adjusted['pct_chg'] = pct_chg.round(2)
+    adjusted['vol'] = daily['vol'].to_numpy()
+    adjusted['amount'] = daily['amount'].to_numpy()
+    adjusted['cycle'] = schema.cycle_column('daily', len(adjusted))
+    return adjusted
+
+
+def load_daily_history(codes, first_dates, table='stock_data'):
+    """
+    从数据库读取指定股票早于 first_dates 的原始日线，用于重新计算这些股票的全部复权历史。
+
+    :param codes: 股票代码列表
+    :param first_dates: 与 codes 对齐的日期（datetime64），每只股票只读取此前的日线，当日数据集中已有之后的日线
+    :return: 日线 DataFrame；数据表不存在时为空，无法连接数据库时返回 None
+    """
+    empty = schema.apply_schema(pd.DataFrame(columns=PERIODIC_COLUMNS), categorical=False)
+    if len(codes) == 0:
+        return empty
+    query = f"""
+        COPY (
+            SELECT s.ts_code, s.trade_date, s.open, s.high, s.low, s.close, s.pre_close, s.change, s.pct_chg, s.vol, s.amount
+            FROM {table} s
+            JOIN unnest(%s::text[], %s::date[]) AS w(ts_code, first_date)
+              ON s.ts_code = w.ts_code AND s.trade_date < w.first_date
+            WHERE s.cycle = 'daily'
+        ) TO STDOUT WITH CSV HEADER
+    """
+    try:
+        conn = Upload_database.create_database_connection(max_attempts=1)
+    except psycopg2.Error as e:
+        print(f"无法连接数据库读取日线历史：{e}")
+        return None
+    buffer = io.StringIO()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+            if not cursor.fetchone()[0]:
+                return empty
+            dates = pd.DatetimeIndex(first_dates).strftime('%Y-%m-%d').tolist()
+            cursor.copy_expert(cursor.mogrify(query, (list(codes), dates)).decode(), buffer)
+    except psycopg2.Error as e:
+        print(f"读取数据库日线历史失败：{e}")
+        return None
+    finally:
+        conn.close()
+    buffer.seek(0)
+    return schema.apply_schema(pd.read_csv(buffer, dtype={'ts_code': str}), categorical=False)
+
+
+def adjust_mode(mode, daily, history, factors, latest, recompute, state):
+    """
+    计算一种复权方式下本次需要写入的复权日线与周期K线，并返回新的增量状态。
+
+    :param daily: 当日数据集的原始日线，按 ts_code、trade_date 排序
+    :param history: 需要重新计算的股票在数据库中的更早日线，与 daily 合并后为这些股票的完整历史
+    :param factors: 涉及股票的复权因子历史
+    :param latest: 以 ts_code 为索引的最新复权因子（前复权使用）
+    :param recompute: 需要重新计算全部历史的股票代码集合
+    :param state: 该复权方式的增量状态，None 表示首次计算
+    :return: ({周期标签: 复权K线，含 daily}, 新状态)
+    """
+    if state is None or 'daily' not in state:
+        state = {'daily': schema.apply_schema(pd.DataFrame(columns=PERIODIC_COLUMNS), categorical=False)}
+    # 重新计算的股票从状态中去掉，其全部日线都作为新增日线折叠
+    state = {cycle: bars[~bars['ts_code'].isin(recompute)] for cycle, bars in state.items()}
+
+    rows = history[history['ts_code'].isin(recompute)]
+    data = schema.concat([rows[PERIODIC_COLUMNS].copy(), daily[PERIODIC_COLUMNS].copy()])
+    data = schema.sort_rows(schema.apply_schema(data), ['ts_code', 'trade_date'])
+    # 已上传的日线同时出现在数据库和当日数据集中时保留当日数据集的一行
+    data = data[~data.duplicated(['ts_code', 'trade_date'], keep='last')]
+
+    # 只复权水位之后的日线，与 update_cycles_incremental 的筛选一致
+    watermark = state['daily'].set_index('ts_code')['trade_date']
+    codes = data['ts_code'].cat
+    stock_watermark = watermark.reindex(codes.categories).to_numpy()[codes.codes.to_numpy()]
+    data = data[np.isnat(stock_watermark) | (data['trade_date'].to_numpy() > stock_watermark)]
+
+    scale = align_factors(data, factors)
+    if mode == 'qfq':
+        latest_factor = latest['adj_factor'].reindex(codes.categories).to_numpy(dtype='float64')[data['ts_code'].cat.codes.to_numpy()]
+        scale = scale / np.where(np.isnan(latest_factor) | (latest_factor == 0), scale, latest_factor)
+    adjusted = adjust_daily(data, scale)
+
+    cycle_data, new_state = update_cycles_incremental(adjusted, state)
+    return {'daily': adjusted, **cycle_data}, new_state
+
+
+def adjust_prices(full=False, modes=None, pro=None):
+    """
+    读取最新的日线数据集，增量拉取复权因子，计算各周期的前复权、后复权K线并保存为
+    {qfq,hfq}_stocks_data_{日期} 数据集。
+
+    后复权价格只依赖当日的复权因子，历史不会变化，每天只计算新增日线；前复权以最新因子为基准，
+    只有最新因子发生变化（除权除息）的股票才从数据库读取完整日线重新计算，其余股票同样只计算新增日线。
+
+    :param full: 忽略增量状态，重新计算当日数据集与数据库中全部股票的复权历史
+    :param modes: 复权方式列表，默认读取环境变量 ADJUST_MODES（qfq,hfq）
+    :param pro: Tushare pro 接口，默认用 TUSHARE_TOKEN 创建
+    :return: {复权方式: [复权日线, 各周期复权K线]}；跳过时为 None
+    """
+    modes = modes or ADJUST_MODES
+    storage = get_storage()
+    name = latest_dataset('merged_stocks_data_', storage)
+    if name is None:
+        print("没有找到符合条件的文件")
+        return None
+    run_date = dataset_run_date(name)
+    manifest = RunManifest(run_date)
+    if manifest.is_done('adjust'):
+        print("复权数据已生成，跳过操作。")
+        return None
+
+    start_time = time.time()
+    pro = pro or ts.pro_api(Pull_merga_stock.get_token())
+
+    # 复权因子水位之后的交易日按交易日整市场拉取
+    old_latest = load_latest_factors()
+    factor_start = next_day(old_latest['trade_date'].max()) if old_latest is not None else CALENDAR_START
+    new_factors = fetch_factors(pro, factor_start, run_date)
+    latest = old_latest if new_factors is None else update_latest_factors(old_latest, new_factors)
+    if latest is None:
+        print("没有可用的复权因子，跳过复权")
+        return None
+
+    daily = schema.sort_rows(storage.read(name, cycles=['daily'], columns=PERIODIC_COLUMNS), ['ts_code', 'trade_date'])
+    codes = set(map(str, daily['ts_code'].unique()))
+
+    # 最新因子变化（除权除息）的股票需要重新计算前复权历史；没有增量状态的股票两种复权都需要完整计算
+    states = {mode: None if full else load_state(state_file(mode)) for mode in modes}
+    changed = set()
+    if old_latest is not None:
+        old = old_latest['adj_factor'].reindex(latest.index)
+        changed = set(latest.index[~np.isclose(old.to_numpy(), latest['adj_factor'].to_numpy(), rtol=1e-9, atol=0)])
+    recompute = {}
+    for mode, state in states.items():
+        known = set(state['daily']['ts_code']) if state is not None and 'daily' in state else set()
+        recompute[mode] = (codes - known) | (changed if mode == 'qfq' else set())
+    print(f"复权因子变化 {len(changed)} 只股票，需要重新计算历史："
+          + "，".join(f"{mode} {len(codes_)} 只" for mode, codes_ in recompute.items()))
+
+    # 需要重新计算的股票读取数据库中早于当日数据集的日线
+    history_codes = sorted(set().union(*recompute.values()))
+    history = schema.apply_schema(pd.DataFrame(columns=PERIODIC_COLUMNS), categorical=False)
+    if history_codes:
+        first_dates = daily.groupby('ts_code', observed=True)['trade_date'].min()
+        first_dates.index = first_dates.index.astype(str)
+        first_dates = first_dates.reindex(history_codes).fillna(pd.Timestamp(next_day(run_date)))
+        history = load_daily_history(history_codes, first_dates.to_numpy())
+        if history is None:
+            print("无法读取需要重新计算的日线历史，本次不更新复权数据")
+            return None
+        print(f"从数据库读取日线历史 {len(history)} 条")
+
+    involved = sorted(codes | set(history_codes))
+    factors = load_factors(involved)
+
+    results = {}
+    new_states = {}
+    for mode in modes:
+        interim_time = time.time()
+        print(f"\n计算{mode}复权数据...")
+        bars, new_states[mode] = adjust_mode(mode, daily, history, factors, latest, recompute[mode], states[mode])
+        results[mode] = list(bars.values())
+
+        # 先写复权日线再逐个追加周期数据
+        target = dataset_name(mode, run_date)
+        storage.write(bars['daily'], target)
+        for cycle, cycle_bars in bars.items():
+            if cycle != 'daily':
+                storage.append(cycle_bars, target)
+        print(f"{mode}复权数据已保存到 {storage.path(target)}，共 {sum(len(frame) for frame in bars.values())} 条，"
+              f"耗时: {time.time() - interim_time:.2f} 秒")
+
+    # 输出落盘后再更新增量状态和复权因子水位
+    for mode, state in new_states.items():
+        save_state(state, state_file(mode))
+    save_latest_factors(latest)
+    manifest.mark_done('adjust', changed=len(changed))
+    print(f"\n复权数据生成完成，总耗时: {time.time() - start_time:.2f} 秒")
+    return results
+
+
+def upload_adjusted(results=None, modes=None, run_date=None):
+    """
+    把复权数据上传到 ADJUSTED_TABLES 中对应的数据表。重新计算的前复权历史早于库中水位，因此上传数据集中的全部行，
+    内容未变化的行不会被改写。
+
+    :param results: adjust_prices 的返回值，为 None 时从存储读取当日的复权数据集
+    :param run_date: 运行日期（目标交易日），默认今天
+    """
+    for mode in modes or ADJUST_MODES:
+        data = results.get(mode) if results else None
+        Upload_database.main(data, sync_mode='full', table=ADJUSTED_TABLES[mode], dataset_prefix=f'{mode}_stocks_data_',
+                             run_date=run_date)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='增量拉取复权因子，生成各周期的前复权、后复权数据')
+    parser.add_argument('--full', action='store_true', help='忽略增量状态，重新计算全部股票的复权历史')
+    parser.add_argument('--modes', default=None, help='逗号分隔的复权方式，默认读取环境变量 ADJUST_MODES')
+    parser.add_argument('--upload', action='store_true', help='生成后上传到 stock_data_qfq / stock_data_hfq')
+    args = parser.parse_args()
+    modes = args.modes.split(',') if args.modes else None
+    results = adjust_prices(full=args.full, modes=modes)
+    if args.upload:
+        upload_adjusted(results, modes)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,9 @@ import os
 import glob
 import pandas as pd
 from datetime import datetime
+from run_manifest import RunManifest
 
 data_dir = './data'
-os.makedirs(data_dir, exist_ok=True)
 
 # 定义文件列表
 files = [
@@ -15,63 +15,130 @@ files = [
     '上市公司基本信息.csv'
 ]
 
-# 添加日线行情
-daily_file = glob.glob(os.path.join(data_dir, '日线行情*.csv'))
-if daily_file:
-    files.extend([os.path.basename(f) for f in daily_file])
-
-# 读取所有文件并设置ts_code作为索引，存储在一个字典中
-dfs = {file: pd.read_csv(os.path.join(data_dir, file), index_col='ts_code') for file in files}
-
-# 合并所有DataFrame，按索引进行外连接
-merged_df = pd.concat(dfs.values(), axis=1)
-
-# 保存合并后的数据
-merged_df.to_csv(os.path.join(data_dir, '基础数据_未清洗.csv'))
-
-# 获取当前日期并格式化为 'YYYYMMDD' 格式
-current_date = datetime.now().strftime('%Y%m%d')
-
-# 读取 CSV 文件
-df = pd.read_csv(os.path.join(data_dir, '基础数据_未清洗.csv'))
-
-# 添加“流通市值、总市值”计算市值并四舍五入到一位小数，然后添加到新列
-df['TMC'] = round(df['total_share'] * df['close'], 1)
-df['CMV'] = round(df['float_share'] * df['close'], 1)
-
-# 仅保留以 '6', '3', '0' 开头的代码
-filtered_df = df[df['ts_code'].str.startswith(('6', '3', '0')) & ~df['ts_code'].str.startswith('68')]
-
-# 清理标签 'area'地区 或 'industry' 为空值的行
-df_cleaned = filtered_df.dropna(subset=['area'])
-
-# 去除包含 'ST' 的行
-df_cleaned = df_cleaned[~df_cleaned['name'].str.contains('ST')]
-
-# 去除重复的行，保留最后一个出现的
-df_cleaned = df_cleaned.drop_duplicates(subset='ts_code', keep='last')
-
 # 定义所需的列，并按照给定顺序排列
 desired_columns = [
     'ts_code', 'name', 'industry', 'fullname', 'area', 'city', 'close', 'TMC', 'CMV',
-    'list_date', 'ipo_date','ann_date', 'change_reason', 'act_name', 'act_ent_type', 
-    'chairman', 'manager', 'business_scope', 'employees', 'introduction', 
-    'main_business', 'total_assets','liquid_assets', 'bvps', 'pb', 
+    'list_date', 'ipo_date','ann_date', 'change_reason', 'act_name', 'act_ent_type',
+    'chairman', 'manager', 'business_scope', 'employees', 'introduction',
+    'main_business', 'total_assets','liquid_assets', 'bvps', 'pb',
     'undp', 'profit_yoy', 'holder_num'
 ]
 
-# 提取所需列
-df_final = df_cleaned[desired_columns]
-
-output_filename = os.path.join(data_dir, f'基础数据_预处理{current_date}.csv')
-df_final.to_csv(output_filename, index=False)
-print(f"数据已保存至：{output_filename}")
-print(f"数据形状：{df_final.shape}")
-
-# 删除data目录下除新生成的 CSV 文件之外的其他 CSV 文件
-csv_files = glob.glob(os.path.join(data_dir, '*.csv'))
-for file in csv_files:
-    if file != output_filename:
-        os.remove(file)
 
-print(f"保存为 '{output_filename}'")
\ No newline at end of file
+# 计算市值需要、但不在输出列中的字段
+extra_columns = ['total_share', 'float_share']
+
+
+def base_file_order(names):
+    """按文件列表的顺序排列，日线行情放在最后。"""
+    return [file for file in files if file in names] + [file for file in names if file not in files]
+
+
+def assign_sources(columns_by_file):
+    """
+    为每个需要的字段选择来源文件：按文件顺序取第一个包含该字段的文件，与按 ts_code 外连接后取第一次出现的列一致。
+
+    :param columns_by_file: {文件名: 该文件的列名}
+    :return: {文件名: 从该文件读取的字段}
+    """
+    needed = [column for column in desired_columns if column not in ('ts_code', 'TMC', 'CMV')] + extra_columns
+    taken = set()
+    sources = {}
+    for file in base_file_order(columns_by_file):
+        sources[file] = [column for column in needed if column in columns_by_file[file] and column not in taken]
+        taken.update(sources[file])
+    return sources
+
+
+def read_base_files():
+    """读取 Pull_base_data.py 保存的基础数据文件，每个文件只读取作为来源的字段，返回 {文件名: DataFrame}。"""
+    base_files = list(files)
+    # 添加日线行情
+    daily_file = glob.glob(os.path.join(data_dir, '日线行情*.csv'))
+    if daily_file:
+        base_files.extend([os.path.basename(f) for f in daily_file])
+    headers = {file: pd.read_csv(os.path.join(data_dir, file), nrows=0).columns for file in base_files}
+    sources = assign_sources(headers)
+    return {file: pd.read_csv(os.path.join(data_dir, file), usecols=['ts_code'] + sources[file]) for file in base_files}
+
+
+def clean_base_data(frames=None, save_merged=False, run_date=None):
+    """
+    合并、清洗基础数据并保存为 基础数据_预处理{日期}.csv。
+
+    :param frames: {文件名: DataFrame}，由 Pull_base_data.BASE_DATA_FETCHERS 在内存中传入；为 None 时读取 data 目录下的文件
+    :param save_merged: 是否另外保存合并后未清洗的数据 基础数据_未清洗.csv
+    :param run_date: 运行日期（目标交易日），用于文件名和运行清单，默认今天
+    :return: 清洗后的基础数据 DataFrame
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    from_files = frames is None
+    if from_files:
+        frames = read_base_files()
+
+    # 每个字段只取第一个包含它的文件，各来源以 ts_code 为索引，同一来源中重复的代码保留最后一次出现的行
+    sources = assign_sources({file: df.columns for file, df in frames.items()})
+    keyed = {}
+    owner = {}
+    for file, columns in sources.items():
+        if not columns:
+            continue
+        source = frames[file].set_index('ts_code')[columns]
+        keyed[file] = source[~source.index.duplicated(keep='last')]
+        owner.update(dict.fromkeys(columns, file))
+
+    # 所有来源的股票代码取并集并排序，作为连接索引，各字段按索引位置对齐
+    codes = pd.Index(sorted(set().union(*(source.index for source in keyed.values()))), name='ts_code')
+
+    def column(name, index):
+        return keyed[owner[name]][name].reindex(index)
+
+    if save_merged:
+        merged = pd.DataFrame({name: column(name, codes) for name in owner}, index=codes).reset_index()
+        merged.to_csv(os.path.join(data_dir, '基础数据_未清洗.csv'), index=False)
+
+    # 获取运行日期，格式为 'YYYYMMDD'
+    current_date = run_date or datetime.now().strftime('%Y%m%d')
+
+    # 一次性计算全部过滤条件：仅保留以 '6', '3', '0' 开头且非 '68' 开头的代码，地区不为空，名称不含 'ST'
+    mask = (codes.str.startswith(('6', '3', '0')) & ~codes.str.startswith('68')
+            & column('area', codes).notna().to_numpy()
+            & ~column('name', codes).str.contains('ST', na=False).to_numpy())
+    kept = codes[mask]
+
+    # 只对保留的代码取出所需列，并计算“总市值、流通市值”，四舍五入到一位小数
+    close = column('close', kept).astype('float64')
+    values = {'ts_code': kept.to_numpy()}
+    for name in desired_columns[1:]:
+        if name == 'TMC':
+            values[name] = (column('total_share', kept).astype('float64') * close).round(1)
+        elif name == 'CMV':
+            values[name] = (column('float_share', kept).astype('float64') * close).round(1)
+        else:
+            values[name] = column(name, kept)
+    df_final = pd.DataFrame(values, index=kept).reset_index(drop=True)
+
+    output_filename = os.path.join(data_dir, f'基础数据_预处理{current_date}.csv')
+    df_final.to_csv(output_filename, index=False)
+    print(f"数据已保存至：{output_filename}")
+    print(f"数据形状：{df_final.shape}")
+
+    # 只删除本次清洗读取的原始文件和中间文件，日线数据集、失败清单等其他阶段的输出保持不变
+    if from_files:
+        for file in list(frames) + ['基础数据_未清洗.csv']:
+            file_path = os.path.join(data_dir, file)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    # 删除以前日期的预处理基础数据
+    for file in glob.glob(os.path.join(data_dir, '基础数据_预处理*.csv')):
+        if file != output_filename:
+            os.remove(file)
+
+    RunManifest(current_date).mark_done('base', stocks=len(df_final))
+    print(f"保存为 '{output_filename}'")
+    return df_final
+
+
+if __name__ == "__main__":
+    clean_base_data()
@@ -1,158 +1,448 @@
 import pandas as pd
+import numpy as np
 import os
-import glob
-import sys
 import time
+import zlib
+import shutil
+import argparse
+import psycopg2
+from Upload_database import create_database_connection
+from storage import get_storage, latest_dataset, export_csv, STORAGE_EXPORT_CSV
+import schema
+from run_manifest import RunManifest, dataset_run_date
+from process_pool import context
+
+# 周期标签与 pandas 周期频率的对应关系（周线以每周五作为周期标记）
+CYCLE_FREQS = {
+    'weekly': 'W-FRI',
+    'monthly': 'M',
+    'quarterly': 'Q',
+    'yearly': 'A',
+}
+
+# 增量模式的状态文件：每只股票每个周期（含 daily）最后一根已落盘的K线
+STATE_FILE = './data/state/periodic_last_bars.csv'
+
+# 分片生成的工作进程数，1 表示在当前进程内一次性生成全部股票
+GENERATE_WORKERS = int(os.getenv('GENERATE_WORKERS', '1'))
+
+# 分片生成时各分片每只股票最后一根K线的临时状态，全部分片完成后合并为 STATE_FILE
+SHARD_STATE_DIR = './data/state/periodic_shards'
+
+# 周期数据的输出列顺序，'ts_code' 在 'trade_date' 前面
+PERIODIC_COLUMNS = ['ts_code', 'trade_date', 'open', 'high', 'low', 'close', 'pre_close', 'change', 'pct_chg', 'vol', 'amount']
+
+
+def aggregate_cycle(daily_data, dates, freq):
+    """
+    对全市场日线数据按 (ts_code, 周期) 一次性分组聚合，不计算 pre_close/change/pct_chg。
+
+    :param daily_data: 按 ts_code、trade_date 排序的日线数据
+    :param dates: 与 daily_data 对齐的 datetime 类型交易日期
+    :param freq: pandas 周期频率，如 'W-FRI'、'M'、'Q'、'A'
+    :return: 周期数据 DataFrame，trade_date 为周期结束日期（datetime64）
+    """
+    # 在整个数据集上计算周期键，代替逐只股票 set_index + resample
+    periods = dates.dt.to_period(freq).rename('trade_date')
+    bars = daily_data.groupby([daily_data['ts_code'], periods], sort=True, observed=True).agg(
+        open=('open', 'first'),
+        high=('high', 'max'),
+        low=('low', 'min'),
+        close=('close', 'last'),
+        vol=('vol', 'sum'),
+        amount=('amount', 'sum'),
+    )
+
+    # 删除没有数据的周期
+    bars = bars.dropna(subset=['open', 'high', 'low', 'close', 'vol', 'amount'])
+
+    # 周期结束日期只对去重后的周期计算一次，再按编码映射回每一行
+    index = bars.index
+    end_dates = index.levels[1].end_time.normalize().to_numpy()
+    bars = bars.reset_index(drop=True)
+    bars.insert(0, 'ts_code', index.get_level_values(0))
+    bars.insert(1, 'trade_date', end_dates[index.codes[1]])
+    return bars
+
+
+def finalize_bars(bars, cycle_label, first_pre_close=None):
+    """
+    为聚合后的周期数据计算 pre_close、change、pct_chg 并整理列顺序。
+
+    :param bars: aggregate_cycle 的输出，按 ts_code、trade_date 排序
+    :param cycle_label: 周期标签，如 'weekly'
+    :param first_pre_close: 可选，每只股票第一个周期的 pre_close（Series，索引与 bars 对齐），缺省为 0
+    :return: 与逐只股票 resample 结果一致的周期数据
+    """
+    # 修正 pre_close，设置为同一只股票前一个周期的收盘价
+    pre_close = bars.groupby('ts_code', sort=False, observed=True)['close'].shift(1)
+    if first_pre_close is not None:
+        pre_close = pre_close.fillna(first_pre_close)
+
+    # 如果 pre_close 是 NaN（即第一个周期），将其设置为 0
+    pre_close = pre_close.fillna(0)
+
+    # float32 价格还原为两位小数的 float64 后再计算 change、pct_chg
+    close = bars['close'].to_numpy(dtype='float64').round(schema.PRICE_DECIMALS)
+    pre = pre_close.to_numpy(dtype='float64').round(schema.PRICE_DECIMALS)
+
+    # 计算 change（当前周期的 close 减去 pre_close）；pct_chg 避免除以零，若 pre_close 为 0，则 pct_chg 设置为 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct_chg = np.where(pre != 0, (close - pre) / pre * 100, 0.0)
+
+    # 四舍五入到 2 位小数，按 PERIODIC_COLUMNS 的位置插入，不复制整个数据框
+    position = bars.columns.get_loc('close') + 1
+    bars.insert(position, 'pre_close', pre.astype('float32'))
+    bars.insert(position + 1, 'change', (close - pre).round(2).astype('float32'))
+    bars.insert(position + 2, 'pct_chg', pct_chg.round(2))
+    bars['cycle'] = schema.cycle_column(cycle_label, len(bars))
+    return bars
+
+
+def resample_all_cycles(daily_data, cycles=None):
+    """
+    向量化生成全部股票的多周期数据。
+
+    :param daily_data: 日线数据，按 schema.DTYPES 转换类型，已按 ts_code、trade_date 排序时不再复制
+    :param cycles: 需要生成的周期标签列表，默认为 CYCLE_FREQS 中的全部周期
+    :return: {周期标签: 周期数据 DataFrame}
+    """
+    cycles = cycles or list(CYCLE_FREQS)
+    daily_data = schema.sort_rows(schema.apply_schema(daily_data), ['ts_code', 'trade_date'])
+    dates = daily_data['trade_date']
+
+    results = {}
+    for cycle_label in cycles:
+        interim_time = time.time()
+        print(f"\n生成{cycle_label}数据...")
+        bars = aggregate_cycle(daily_data, dates, CYCLE_FREQS[cycle_label])
+        results[cycle_label] = finalize_bars(bars, cycle_label)
+        print(f"{cycle_label}数据生成完成，共 {len(results[cycle_label])} 条，耗时: {time.time() - interim_time:.2f} 秒")
+    return results
+
+
+def fold_cycle(new_daily, dates, last_bars, cycle_label):
+    """
+    将新增日线折叠进每只股票最后一根已落盘的周期K线：仍未结束的周期就地更新，跨越周期边界时追加新周期。
+
+    :param new_daily: 水位之后的新增日线数据，按 ts_code、trade_date 排序
+    :param dates: 与 new_daily 对齐的 datetime 类型交易日期
+    :param last_bars: 该周期每只股票最后一根K线（列同 PERIODIC_COLUMNS），可为空
+    :param cycle_label: 周期标签，如 'weekly'
+    :return: 被更新或新增的周期K线
+    """
+    bars = aggregate_cycle(new_daily, dates, CYCLE_FREQS[cycle_label])
+    prev = last_bars.set_index('ts_code').reindex(bars['ts_code'])
+    prev.index = bars.index
+
+    # 每只股票的第一根新K线若与已落盘K线处于同一周期，则与之合并
+    is_first = ~bars['ts_code'].duplicated()
+    same_period = is_first & (bars['trade_date'] == prev['trade_date'])
+    bars.loc[same_period, 'open'] = prev.loc[same_period, 'open']
+    bars.loc[same_period, 'high'] = np.fmax(prev.loc[same_period, 'high'], bars.loc[same_period, 'high'])
+    bars.loc[same_period, 'low'] = np.fmin(prev.loc[same_period, 'low'], bars.loc[same_period, 'low'])
+    bars.loc[same_period, 'vol'] = prev.loc[same_period, 'vol'] + bars.loc[same_period, 'vol']
+    bars.loc[same_period, 'amount'] = prev.loc[same_period, 'amount'] + bars.loc[same_period, 'amount']
+
+    # 第一根新K线的 pre_close：同一周期沿用原 pre_close，新周期取上一周期收盘价；新股无历史则为 0
+    first_pre_close = prev['pre_close'].where(same_period, prev['close']).where(is_first).astype('float64')
+    return finalize_bars(bars, cycle_label, first_pre_close)
+
+
+def last_bar_per_stock(bars):
+    """取每只股票最后一根K线（bars 已按 ts_code、trade_date 排序）。"""
+    return bars.drop_duplicates(subset='ts_code', keep='last')
+
+
+def merge_last_bars(last_bars, bars):
+    """用新K线中每只股票的最后一根覆盖原状态。"""
+    merged = pd.concat([last_bars[PERIODIC_COLUMNS], last_bar_per_stock(bars)[PERIODIC_COLUMNS]], ignore_index=True)
+    return merged.drop_duplicates(subset='ts_code', keep='last').sort_values('ts_code', ignore_index=True)
+
+
+def load_state(state_file=STATE_FILE):
+    """读取增量状态，返回 {周期标签: 每只股票最后一根K线}，不存在时返回 None。"""
+    if not os.path.isfile(state_file):
+        return None
+    state = schema.read_csv(state_file, categorical=False)
+    return {cycle: group.drop(columns='cycle') for cycle, group in state.groupby('cycle')}
+
+
+def load_state_from_db():
+    """
+    从 stock_data 表读取每只股票每个周期最后一根K线作为增量状态，表不存在或无法连接时返回 None。
+    """
+    query = """
+        SELECT DISTINCT ON (ts_code, cycle)
+            ts_code, to_char(trade_date, 'YYYY-MM-DD') AS trade_date, open, high, low, close,
+            pre_close, change, pct_chg, vol, amount, cycle
+        FROM stock_data
+        ORDER BY ts_code, cycle, trade_date DESC;
+    """
+    try:
+        conn = create_database_connection()
+    except psycopg2.Error as e:
+        print(f"无法连接数据库读取增量状态：{e}")
+        return None
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(query)
+            rows = cursor.fetchall()
+    except psycopg2.Error as e:
+        print(f"读取数据库增量状态失败：{e}")
+        return None
+    finally:
+        conn.close()
+    if not rows:
+        return None
+    state = schema.apply_schema(pd.DataFrame(rows, columns=PERIODIC_COLUMNS + ['cycle']), categorical=False)
+    return {cycle: group.drop(columns='cycle') for cycle, group in state.groupby('cycle')}
+
+
+def save_state(state, state_file=STATE_FILE):
+    """保存增量状态，先写临时文件再替换，避免中断时留下不完整的状态。"""
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    frames = [bars[PERIODIC_COLUMNS].assign(cycle=cycle) for cycle, bars in state.items()]
+    tmp_file = state_file + '.tmp'
+    pd.concat(frames, ignore_index=True).to_csv(tmp_file, index=False)
+    os.replace(tmp_file, state_file)
+
+
+def update_cycles_incremental(daily_data, state):
+    """
+    增量生成周期数据：只处理每只股票水位（已落盘的最后一个交易日）之后的日线。
+
+    :param daily_data: 按 ts_code、trade_date 排序的日线数据，类型见 schema.DTYPES
+    :param state: load_state 返回的状态
+    :return: ({周期标签: 被更新或新增的周期K线}, 新状态)
+    """
+    # 按 ts_code 的类别编码查找水位，不为每行生成字符串
+    watermark = state['daily'].set_index('ts_code')['trade_date']
+    codes = daily_data['ts_code'].cat
+    stock_watermark = watermark.reindex(codes.categories).to_numpy()[codes.codes.to_numpy()]
+    new_daily = daily_data[np.isnat(stock_watermark) | (daily_data['trade_date'].to_numpy() > stock_watermark)]
+    print(f"增量模式：水位之后的新增日线 {len(new_daily)} 条，涉及 {new_daily['ts_code'].nunique()} 只股票")
+
+    new_state = dict(state)
+    results = {}
+    if new_daily.empty:
+        return results, new_state
+
+    dates = new_daily['trade_date']
+    for cycle_label in CYCLE_FREQS:
+        last_bars = state.get(cycle_label)
+        if last_bars is None:
+            last_bars = schema.apply_schema(pd.DataFrame(columns=PERIODIC_COLUMNS), categorical=False)
+        results[cycle_label] = fold_cycle(new_daily, dates, last_bars, cycle_label)
+        new_state[cycle_label] = merge_last_bars(last_bars, results[cycle_label])
+        print(f"{cycle_label}数据：更新/新增 {len(results[cycle_label])} 条")
+
+    new_state['daily'] = merge_last_bars(state['daily'], new_daily)
+    return results, new_state
+
+
+def shard_codes(codes, num_shards):
+    """按 ts_code 的 crc32 哈希把股票分到 num_shards 个分片，同一只股票每次都落在同一分片。"""
+    shards = [[] for _ in range(num_shards)]
+    for code in codes:
+        shards[zlib.crc32(code.encode()) % num_shards].append(code)
+    return shards
+
+
+def shard_state_file(shard):
+    return os.path.join(SHARD_STATE_DIR, f'shard_{shard:03d}.csv')
+
+
+def generate_shard(args):
+    """
+    分片工作进程：只读取本分片股票的日线，生成各周期数据并写入数据集，
+    本分片每只股票每个周期的最后一根K线写入分片状态文件。
+
+    :param args: (数据集名称, 分片编号, 本分片的股票代码, 本分片股票的增量状态，None 时全量生成)
+    :return: (分片编号, 股票数)
+    """
+    name, shard, codes, state = args
+    storage = get_storage()
+    daily_data = schema.sort_rows(storage.read(name, cycles=['daily'], codes=codes), ['ts_code', 'trade_date'])
+    daily_data['cycle'] = schema.cycle_column('daily', len(daily_data))
+
+    if state is not None:
+        cycle_data, new_state = update_cycles_incremental(daily_data, state)
+    else:
+        cycle_data = resample_all_cycles(daily_data)
+        new_state = {cycle: last_bar_per_stock(bars) for cycle, bars in cycle_data.items()}
+        new_state['daily'] = last_bar_per_stock(daily_data)
+
+    # 文件名带分片编号，中断后重新生成同一分片时覆盖上次写入的文件
+    for bars in cycle_data.values():
+        storage.insert(bars, name, basename=f'shard-{shard:03d}')
+    save_state(new_state, shard_state_file(shard))
+    return shard, len(codes)
+
+
+def generate_sharded(storage, name, state, num_shards, manifest):
+    """
+    按 ts_code 哈希分片，用进程池并行生成各分片的周期数据，每个分片完成后记入运行清单；
+    周期数据由各工作进程直接写入数据集，主进程只合并每只股票最后一根K线的状态。
+
+    :param state: load_state 返回的增量状态，None 时全量生成
+    :return: (新状态, 股票总数)
+    """
+    codes = sorted(map(str, storage.read(name, cycles=['daily'], columns=['ts_code'])['ts_code'].unique()))
+    generated = manifest.done_units('generate')
+    # 每个分片的任务只带本分片股票的增量状态，子进程不需要整份状态
+    tasks = [(name, shard, shard_list, None if state is None else
+              {cycle: bars[bars['ts_code'].isin(shard_list)] for cycle, bars in state.items()})
+             for shard, shard_list in enumerate(shard_codes(codes, num_shards))
+             if shard_list and f'shard:{shard}' not in generated]
+    print(f"分片生成：{len(codes)} 只股票分为 {num_shards} 个分片，待生成 {len(tasks)} 个")
+
+    if tasks:
+        with context.Pool(processes=min(num_shards, len(tasks))) as pool:
+            for shard, stocks in pool.imap_unordered(generate_shard, tasks):
+                manifest.add_units('generate', [f'shard:{shard}'])
+                print(f"分片 {shard + 1}/{num_shards} 生成完成：{stocks} 只股票")
+
+    # 各分片的股票互不重叠，按周期拼接分片状态后覆盖原状态
+    new_state = dict(state or {})
+    pieces = [load_state(shard_state_file(shard)) for shard in range(num_shards) if os.path.isfile(shard_state_file(shard))]
+    for cycle in ['daily'] + list(CYCLE_FREQS):
+        frames = [piece[cycle] for piece in pieces if cycle in piece]
+        if frames:
+            last_bars = new_state.get(cycle, schema.apply_schema(pd.DataFrame(columns=PERIODIC_COLUMNS), categorical=False))
+            new_state[cycle] = merge_last_bars(last_bars, pd.concat(frames, ignore_index=True))
+    return new_state, len(codes)
+
+
+def generate_periodic_data(full=False, workers=None):
+    """
+    读取最新的日线数据集，生成周、月、季、年线并写回同一数据集。
+
+    :param full: 忽略增量状态，从全部日线重新生成所有周期；数据集须为完整历史拉取（运行清单中拉取阶段 incremental 为 False），否则抛出 ValueError
+    :param workers: 分片生成的工作进程数，默认读取环境变量 GENERATE_WORKERS，1 表示在当前进程内生成
+    :return: (数据集名称, [日线 DataFrame, 本次写入的各周期 DataFrame])；跳过生成或分片生成时为 None，下游从数据集读取
+    """
+    # 获取主脚本拉取的日线数据集
+    directory = './data/'
+    storage = get_storage()
+    name = latest_dataset('merged_stocks_data_', storage)
+
+    if name is None:
+        print("没有找到符合条件的文件")
+        return None, None
+
+    print(f"读取的数据集是: {storage.path(name)}")
+
+    # 运行清单记录了本数据集已生成的周期；没有清单记录时沿用旧逻辑，已存在日线以外的周期则跳过
+    manifest = RunManifest(dataset_run_date(name))
+    if manifest.is_done('generate'):
+        print("周期数据已生成，跳过操作。")
+        return name, None
+    if 'generate' not in manifest.data['stages'] and set(storage.cycles(name)) - {'daily'}:
+        print("周期数据存在，跳过操作。")
+        return name, None
+
+    # 完整重新生成会覆盖增量状态，增量拉取的数据集只有水位之后的日线，不能作为完整历史；拉取阶段没有记录时按增量处理
+    if full and manifest.data['stages'].get('fetch', {}).get('incremental', True):
+        raise ValueError(f"{storage.path(name)} 不是完整历史拉取的数据集，不能完整重新生成周期数据，"
+                         f"请先执行 python src/Pull_merga_stock.py --full 或 python src/main.py --full")
+
+    workers = workers or GENERATE_WORKERS
+    if workers > 1 and storage.fmt != 'parquet':
+        print("CSV 存储不支持分片写入，改为单进程生成")
+        workers = 1
+    # 分片数变化时已记录的进度不再对应，清空后重新生成
+    manifest.check_params('generate', shards=workers)
+    generated = manifest.done_units('generate')
+    if generated:
+        print(f"从上次中断处继续：已完成 {sorted(generated)}")
+    if storage.fmt == 'parquet' and not (workers > 1 and generated):
+        # 删除上次中断时写了一半的周期分区；分片生成中断后的文件按分片命名，重新生成同一分片时直接覆盖
+        storage.delete_cycles(name, set(storage.cycles(name)) - {'daily'} - generated)
+    if not generated:
+        shutil.rmtree(SHARD_STATE_DIR, ignore_errors=True)
 
-# 获取主脚本拉取的 CSV 文件名
-directory = './data/'
-file_pattern = os.path.join(directory, "merged_stocks_data_*.csv")
-files = glob.glob(file_pattern)
-
-if not files:
-    print("没有找到符合条件的文件")
-else:
-    latest_file = max(files, key=lambda x: os.path.basename(x).split('_')[-1].replace('.csv', ''))
-    stock_list = pd.read_csv(latest_file)
-    print(f"读取的文件是: {latest_file}")
-
-# 检查是否已经存在 'cycle' 列，若存在，则跳过周期数据的生成
-if 'cycle' in stock_list.columns:
-    print("周期数据存在，跳过操作。")
-else:
     print("多周期数据生成中......")
+    start_time = time.time()
 
-    # 读取日线数据，并统一日期格式
-    daily_data = pd.read_csv(latest_file)
+    # 存在增量状态时只折叠水位之后的日线，否则一次性全量生成周、月、季、年线数据
+    state = None if full else (load_state() or load_state_from_db())
+    if state is not None and 'daily' not in state:
+        state = None
 
-    # 将 'trade_date' 从 int 转换为字符串格式，并转换为 datetime 类型，统一格式为 '%Y-%m-%d'
-    daily_data['trade_date'] = pd.to_datetime(daily_data['trade_date'].astype(str), format='%Y%m%d').dt.strftime('%Y-%m-%d')
+    if workers > 1:
+        # 各分片由工作进程读取、生成并写入，主进程不读取日线
+        new_state, total_stocks = generate_sharded(storage, name, state, workers, manifest)
+        if STORAGE_EXPORT_CSV:
+            print(f"CSV 已导出到 {export_csv(name, storage)}")
+        save_state(new_state)
+        shutil.rmtree(SHARD_STATE_DIR, ignore_errors=True)
+        manifest.mark_done('generate', stocks=int(total_stocks), incremental=state is not None)
+        print(f"\n数据生成完成！共处理 {total_stocks} 只股票，总耗时: {time.time() - start_time:.2f} 秒")
+        return name, None
 
-    # 按照 ts_code 和 trade_date 排序
-    daily_data = daily_data.sort_values(by=['ts_code', 'trade_date'])
+    daily_data = storage.read(name, cycles=['daily'])
+
+    # 按照 ts_code 和 trade_date 排序，trade_date 保持 datetime64，ts_code 按类别编码排序
+    daily_data = schema.sort_rows(daily_data, ['ts_code', 'trade_date'])
 
     # 为日线数据添加 'cycle' 标签，标记为 'daily'
-    daily_data['cycle'] = 'daily'
-
-    # 定义一个函数来生成每个周期的数据，并删除空行
-    def resample_data(group, freq, cycle_label, stock_index, total_stocks):
-        # 更新进度
-        progress = (stock_index / total_stocks) * 100
-        sys.stdout.write(f"\r生成{cycle_label}数据: {stock_index}/{total_stocks} 股票 ({progress:.1f}%)")
-        sys.stdout.flush()
-        
-        # 确保 trade_date 是 datetime 格式，并设置为索引
-        group['trade_date'] = pd.to_datetime(group['trade_date'], errors='coerce')
-        group = group.set_index('trade_date')
-
-        # 对单个股票进行重采样，使用不同周期的结束日期
-        resampled_data = group.resample(freq).agg({
-            'open': 'first',
-            'high': 'max',
-            'low': 'min',
-            'close': 'last',
-            'change': 'last',
-            'pct_chg': 'last',
-            'vol': 'sum',
-            'amount': 'sum'
-        }).reset_index()
-
-        # 删除没有数据的周期
-        resampled_data = resampled_data.dropna(subset=['open', 'high', 'low', 'close', 'vol', 'amount'])
-
-        # 保留 ts_code 字段，并将 ts_code 放在最前面
-        resampled_data['ts_code'] = group['ts_code'].iloc[0]
-
-        # 获取每个周期的最后一个交易日（即每周最后一个交易日）
-        resampled_data['trade_date'] = resampled_data['trade_date'].dt.to_period(freq).dt.end_time
-
-        # 修正 pre_close，设置为前一个周期的收盘价
-        resampled_data['pre_close'] = resampled_data['close'].shift(1)
-        
-        # 如果 pre_close 是 NaN（即第一个周期），将其设置为 0
-        resampled_data['pre_close'] = resampled_data['pre_close'].fillna(0)
-
-        # 计算 change（当前周期的 close 减去前一个周期的 pre_close）
-        resampled_data['change'] = resampled_data['close'] - resampled_data['pre_close']
-
-        # 计算 pct_chg，避免除以零，若 pre_close 为 0，则 pct_chg 设置为 0
-        resampled_data['pct_chg'] = resampled_data.apply(
-            lambda row: (row['close'] - row['pre_close']) / row['pre_close'] * 100 if row['pre_close'] != 0 else 0,
-            axis=1
-        )
-
-        # 四舍五入到 2 位小数
-        resampled_data['change'] = resampled_data['change'].round(2)
-        resampled_data['pct_chg'] = resampled_data['pct_chg'].round(2)
-
-        # 统一格式为 '%Y-%m-%d' 字符串
-        resampled_data['trade_date'] = resampled_data['trade_date'].dt.strftime('%Y-%m-%d')
-
-        # 调整列顺序，使 'ts_code' 在 'trade_date' 前面
-        columns = ['ts_code', 'trade_date', 'open', 'high', 'low', 'close', 'pre_close', 'change', 'pct_chg', 'vol', 'amount']
-        resampled_data = resampled_data[columns]
-
-        # 添加周期列
-        resampled_data['cycle'] = cycle_label
-        
-        return resampled_data
-
-    # 为每只股票分别生成周期数据
-    stock_groups = daily_data.groupby('ts_code')
-    total_stocks = len(stock_groups)
-    start_time = time.time()
-    
+    daily_data['cycle'] = schema.cycle_column('daily', len(daily_data))
+
+    total_stocks = daily_data['ts_code'].nunique()
     print(f"开始生成周期数据，共需处理 {total_stocks} 只股票")
-    
-    # 生成周线数据，使用每周五作为周期标记
-    print("\n生成周线数据...")
-    weekly_data = pd.concat([resample_data(group, 'W-FRI', 'weekly', i+1, total_stocks) 
-                            for i, (_, group) in enumerate(stock_groups)], ignore_index=True)
-    print(f"\n周线数据生成完成，耗时: {time.time() - start_time:.2f} 秒")
-    
-    # 重置计时器
-    interim_time = time.time()
-    
-    # 生成月线数据
-    print("\n生成月线数据...")
-    monthly_data = pd.concat([resample_data(group, 'M', 'monthly', i+1, total_stocks) 
-                             for i, (_, group) in enumerate(stock_groups)], ignore_index=True)
-    print(f"\n月线数据生成完成，耗时: {time.time() - interim_time:.2f} 秒")
-    
-    # 重置计时器
-    interim_time = time.time()
-    
-    # 生成季线数据
-    print("\n生成季线数据...")
-    quarterly_data = pd.concat([resample_data(group, 'Q', 'quarterly', i+1, total_stocks) 
-                               for i, (_, group) in enumerate(stock_groups)], ignore_index=True)
-    print(f"\n季线数据生成完成，耗时: {time.time() - interim_time:.2f} 秒")
-    
-    # 重置计时器
-    interim_time = time.time()
-    
-    # 生成年线数据
-    print("\n生成年线数据...")
-    yearly_data = pd.concat([resample_data(group, 'A', 'yearly', i+1, total_stocks) 
-                            for i, (_, group) in enumerate(stock_groups)], ignore_index=True)
-    print(f"\n年线数据生成完成，耗时: {time.time() - interim_time:.2f} 秒")
-
-    # 合并所有周期数据
-    print("\n合并所有周期数据...")
-    combined_data = pd.concat([daily_data, weekly_data, monthly_data, quarterly_data, yearly_data], ignore_index=True)
-
-    # 保存为 CSV 文件（覆盖原始文件）
-    print(f"保存数据到 {latest_file}...")
+
+    if state is not None:
+        cycle_data, new_state = update_cycles_incremental(daily_data, state)
+    else:
+        cycle_data = resample_all_cycles(daily_data)
+        new_state = {cycle: last_bar_per_stock(bars) for cycle, bars in cycle_data.items()}
+        new_state['daily'] = last_bar_per_stock(daily_data)
+
+    print(f"保存数据到 {storage.path(name)}...")
     save_start = time.time()
-    combined_data.to_csv(latest_file, index=False)
+    manifest.add_units('generate', [])
+    if storage.fmt == 'parquet':
+        # 分区存储只需写入新生成的周期分区，日线分区保持不变；每写完一个周期记入运行清单
+        for cycle, bars in cycle_data.items():
+            if cycle in generated:
+                continue
+            storage.append(bars, name)
+            manifest.add_units('generate', [cycle])
+    else:
+        # 先写日线再逐个追加周期数据，覆盖原始文件，不在内存中合并
+        storage.write(daily_data[PERIODIC_COLUMNS + ['cycle']], name)
+        for bars in cycle_data.values():
+            storage.append(bars, name)
+        manifest.add_units('generate', list(cycle_data))
     print(f"保存完成，耗时: {time.time() - save_start:.2f} 秒")
 
+    if STORAGE_EXPORT_CSV:
+        print(f"CSV 已导出到 {export_csv(name, storage)}")
+
+    # 输出落盘后再更新增量状态
+    save_state(new_state)
+    manifest.mark_done('generate', stocks=int(total_stocks), incremental=state is not None)
+
     # 删除已保存的周期数据文件
-    for cycle_data, cycle_name in zip([weekly_data, monthly_data, quarterly_data, yearly_data], ['weekly_data.csv', 'monthly_data.csv', 'quarterly_data.csv', 'yearly_data.csv']):
+    for cycle_name in ['weekly_data.csv', 'monthly_data.csv', 'quarterly_data.csv', 'yearly_data.csv']:
         cycle_file_path = os.path.join(directory, cycle_name)
         if os.path.exists(cycle_file_path):
             os.remove(cycle_file_path)
             print(f"{cycle_name} 已删除")
 
     total_time = time.time() - start_time
-    print(f"\n数据生成完成！共处理 {total_stocks} 只股票，总耗时: {total_time:.2f} 秒")
\ No newline at end of file
+    print(f"\n数据生成完成！共处理 {total_stocks} 只股票，总耗时: {total_time:.2f} 秒")
+    return name, [daily_data] + list(cycle_data.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成周、月、季、年线数据')
+    parser.add_argument('--full', action='store_true', help='忽略增量状态，从全部日线重新生成所有周期')
+    parser.add_argument('--workers', type=int, help='分片生成的工作进程数，默认读取环境变量 GENERATE_WORKERS')
+    args = parser.parse_args()
+    generate_periodic_data(full=args.full, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,224 @@
 import tushare as ts
 import pandas as pd
 import os
+import json
+import time
+import threading
+from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from rate_limiter import RateLimiter
+from api_cache import ApiCache
+from trade_calendar import load_calendar
 
 # 加载.env环境变量
 load_dotenv()
 TUSHARE_TOKEN = os.getenv('TUSHARE_TOKEN')
 
-if not TUSHARE_TOKEN:
-    raise ValueError('请在.env文件中设置TUSHARE_TOKEN')
+data_dir = './data'
 
-ts.set_token(TUSHARE_TOKEN)
-pro = ts.pro_api()
+# Tushare 接口、限流器和接口缓存在首次使用时创建，导入本模块不调用接口、不创建共享内存
+pro = None
 
-data_dir = './data'
-os.makedirs(data_dir, exist_ok=True)
+# 所有接口调用共用一个限流器，按每分钟调用次数限流
+limiter = None
+
+# 接口返回结果的磁盘缓存，同一天内重复运行时直接读取，不再占用接口额度
+cache = None
+
+# 各接口在线程池中并行拉取，首次创建时加锁，保证只创建一份
+init_lock = threading.Lock()
+
+def get_pro():
+    """返回 Tushare pro 接口，首次调用时检查 Token 并创建。"""
+    global pro
+    with init_lock:
+        if pro is None:
+            if not TUSHARE_TOKEN:
+                raise ValueError('请在.env文件中设置TUSHARE_TOKEN')
+            ts.set_token(TUSHARE_TOKEN)
+            pro = ts.pro_api()
+    return pro
+
+def get_limiter():
+    """返回共用的限流器，首次调用时创建。"""
+    global limiter
+    with init_lock:
+        if limiter is None:
+            limiter = RateLimiter()
+    return limiter
+
+def get_cache():
+    """返回共用的接口缓存，首次调用时创建。"""
+    global cache
+    with init_lock:
+        if cache is None:
+            cache = ApiCache()
+    return cache
+
+def save_csv(df, file_name):
+    """保存到 data 目录，目录不存在时创建。"""
+    os.makedirs(data_dir, exist_ok=True)
+    df.to_csv(os.path.join(data_dir, file_name), index=False)
+
+# 分页接口每个接口同时请求的页数
+PAGE_WORKERS = int(os.getenv('TUSHARE_PAGE_WORKERS', '4'))
+
+# 记录各分页接口上次拉取到的页数，下次直接并行请求这些页
+PAGES_FILE = os.path.join(data_dir, 'state', 'base_data_pages.json')
+pages_lock = threading.Lock()
+
+def load_page_counts():
+    if not os.path.isfile(PAGES_FILE):
+        return {}
+    with open(PAGES_FILE, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_page_count(name, pages):
+    with pages_lock:
+        counts = load_page_counts()
+        counts[name] = pages
+        os.makedirs(os.path.dirname(PAGES_FILE), exist_ok=True)
+        tmp_file = PAGES_FILE + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(counts, f, ensure_ascii=False)
+        os.replace(tmp_file, PAGES_FILE)
+
+def fetch_paginated(name, func, limit=5000, **kwargs):
+    """
+    按 offset 分页拉取接口的全部数据，遇到空页为止。
+
+    第一轮并行请求上次记录的页数再多一页，之后每轮并行请求 PAGE_WORKERS 页，
+    所有请求都经过接口缓存和共享限流器，页数不变时整个接口只需一轮并行请求。
+
+    :param name: 接口名称，用于记录页数
+    :param func: pro 的接口方法
+    :param limit: 每页行数
+    :return: 按页顺序合并后的 DataFrame
+    """
+    pages = []
+    start = 0
+    wave = max(load_page_counts().get(name, 0) + 1, PAGE_WORKERS)
+    with ThreadPoolExecutor(PAGE_WORKERS) as executor:
+        while True:
+            futures = [executor.submit(get_cache().call, get_limiter(), name, func, limit=limit, offset=(start + i) * limit, **kwargs)
+                       for i in range(wave)]
+            results = [future.result() for future in futures]
+            finished = False
+            for df in results:
+                if df.empty:
+                    finished = True
+                    break
+                pages.append(df)
+            if finished:
+                break
+            start += wave
+            wave = PAGE_WORKERS
+    save_page_count(name, len(pages))
+    return pd.concat(pages, ignore_index=True)
+
+def get_calendar(date=None):
+    """读取本地交易日历，需要时经过接口缓存和限流器刷新。"""
+    return load_calendar(get_pro(), date, call=partial(get_cache().call, get_limiter()))
 
 # 获取并保存日线行情数据
-def fetch_and_save_daily_data(pro):
-    df = pro.daily(ts_code="", trade_date="", start_date="", end_date="", offset="", limit="")
-    df_filtered = df[~df['ts_code'].str.startswith(('8', '9'))]
-    latest_date = df_filtered['trade_date'].max()
-    df_latest = df_filtered[df_filtered['trade_date'] == latest_date]
-    file_name = os.path.join(data_dir, f"日线行情{latest_date}.csv")
-    df_latest.to_csv(file_name, index=False)
+def fetch_and_save_daily_data(pro, save=True):
+    calendar = get_calendar()
+    if calendar is None:
+        # 没有交易日历时拉取不带日期的日线，从中取最新交易日
+        df = get_cache().call(get_limiter(), 'daily', pro.daily, ts_code="", trade_date="", start_date="", end_date="", offset="", limit="")
+        df_filtered = df[~df['ts_code'].str.startswith(('8', '9'))]
+        latest_date = df_filtered['trade_date'].max()
+        df_latest = df_filtered[df_filtered['trade_date'] == latest_date]
+    else:
+        # 按交易日历只拉取最近一个交易日，当天数据尚未发布时取上一个交易日
+        latest_date = calendar.latest_trade_date(datetime.now().strftime('%Y%m%d'))
+        df = get_cache().call(get_limiter(), 'daily', pro.daily, trade_date=latest_date)
+        if df.empty:
+            latest_date = calendar.previous_trade_date(latest_date)
+            df = get_cache().call(get_limiter(), 'daily', pro.daily, trade_date=latest_date)
+        df_latest = df[~df['ts_code'].str.startswith(('8', '9'))]
+    if save:
+        save_csv(df_latest, f"日线行情{latest_date}.csv")
     print(f"日线行情数据形状: {df_latest.shape}")
+    return df_latest
 
 # 获取并保存上市公司基础信息
-def fetch_and_save_stock_company_data(pro, limit=5000):
-    offset = 0
-    all_data = []
-    while True:
-        df = pro.stock_company(limit=limit, offset=offset, fields=["ts_code", "chairman", "manager", "reg_capital", "province", "city", "website", "email", "business_scope", "employees", "introduction", "setup_date", "main_business"])
-        if df.empty:
-            break
-        all_data.append(df)
-        offset += limit
-    all_data_df = pd.concat(all_data, ignore_index=True)
+def fetch_and_save_stock_company_data(pro, limit=5000, save=True):
+    all_data_df = fetch_paginated('stock_company', pro.stock_company, limit, fields=["ts_code", "chairman", "manager", "reg_capital", "province", "city", "website", "email", "business_scope", "employees", "introduction", "setup_date", "main_business"])
     filtered_df = all_data_df[~all_data_df['ts_code'].str.startswith('8')]
-    filtered_df.to_csv(os.path.join(data_dir, '上市公司基本信息.csv'), index=False)
+    if save:
+        save_csv(filtered_df, '上市公司基本信息.csv')
     print(f"上市公司基础信息形状: {filtered_df.shape}")
+    return filtered_df
 
 # 获取并保存股票曾用名数据
-def fetch_and_save_namechange_data(pro, limit=5000):
-    offset = 0
-    all_data = []
-    while True:
-        df = pro.namechange(ts_code="", start_date="", end_date="", limit=limit, offset=offset)
-        if df.empty:
-            break
-        all_data.append(df)
-        offset += limit
-    all_data_df = pd.concat(all_data, ignore_index=True)
+def fetch_and_save_namechange_data(pro, limit=5000, save=True):
+    all_data_df = fetch_paginated('namechange', pro.namechange, limit, ts_code="", start_date="", end_date="")
     filtered_df = all_data_df[~all_data_df['ts_code'].str.startswith(('T', 'A', '9', '8', '7'))]
     filtered_df = filtered_df.sort_values(by='ann_date', ascending=False).drop_duplicates(subset='ts_code', keep='first')
-    filtered_df.to_csv(os.path.join(data_dir, '股票曾用名.csv'), index=False)
+    if save:
+        save_csv(filtered_df, '股票曾用名.csv')
     print(f"股票曾用名数据形状: {filtered_df.shape}")
+    return filtered_df
 
 # 获取并保存新股上市数据
-def fetch_and_save_new_share_data(pro, limit=5000):
-    offset = 0
-    all_data = []
-    while True:
-        df = pro.new_share(start_date="", end_date="", limit=limit, offset=offset)
-        if df.empty:
-            break
-        all_data.append(df)
-        offset += limit
-    all_data_df = pd.concat(all_data, ignore_index=True)
+def fetch_and_save_new_share_data(pro, limit=5000, save=True):
+    all_data_df = fetch_paginated('new_share', pro.new_share, limit, start_date="", end_date="")
     filtered_df = all_data_df[~all_data_df['ts_code'].str.startswith(('8', '9'))]
-    filtered_df.to_csv(os.path.join(data_dir, 'IPO新股上市.csv'), index=False)
+    if save:
+        save_csv(filtered_df, 'IPO新股上市.csv')
     print(f"新股上市数据形状: {filtered_df.shape}")
+    return filtered_df
+
+# 获取并保存股票列表
+def fetch_and_save_stock_basic_data(pro, save=True):
+    df = get_cache().call(get_limiter(), 'stock_basic', pro.stock_basic, **{"ts_code": "", "name": "", "exchange": "", "market": "", "is_hs": "", "list_status": "", "limit": "", "offset": ""}, fields=["ts_code", "symbol", "name", "area", "industry", "market", "list_date", "act_name", "act_ent_type", "fullname", "enname", "exchange", "is_hs"])
+    df_filtered = df[~df['ts_code'].str.startswith('8')]
+    if save:
+        save_csv(df_filtered, '股票列表.csv')
+    print(f"股票列表数据形状: {df_filtered.shape}")
+    return df_filtered
+
+# 获取并保存备用列表
+def fetch_and_save_bak_basic_data(pro, save=True):
+    df = get_cache().call(get_limiter(), 'bak_basic', pro.bak_basic, **{"trade_date": "", "ts_code": "", "limit": "", "offset": ""}, fields=["trade_date", "ts_code", "industry", "area", "pe", "float_share", "total_share", "total_assets", "liquid_assets", "fixed_assets", "reserved", "eps", "bvps", "pb", "list_date", "undp", "per_undp", "rev_yoy", "profit_yoy", "gpr", "npr", "holder_num", "name"])
+    df_filt = df[~df['ts_code'].str.startswith('8')]
+    filt_df = df_filt.sort_values(by='trade_date', ascending=False).drop_duplicates(subset='ts_code', keep='first')
+    if save:
+        save_csv(filt_df, '备用列表.csv')
+    print(f"备用列表数据形状: {filt_df.shape}")
+    return filt_df
+
+# 各基础数据接口与 Clear_data.py 读取的文件名的对应关系，日线行情的文件名带有交易日期
+BASE_DATA_FETCHERS = {
+    '日线行情': fetch_and_save_daily_data,
+    '上市公司基本信息.csv': fetch_and_save_stock_company_data,
+    '股票曾用名.csv': fetch_and_save_namechange_data,
+    'IPO新股上市.csv': fetch_and_save_new_share_data,
+    '股票列表.csv': fetch_and_save_stock_basic_data,
+    '备用列表.csv': fetch_and_save_bak_basic_data,
+}
+
+def collect_base_data(save=True, max_workers=None):
+    """
+    并行拉取全部基础数据接口，所有请求共用同一个限流器。
+
+    :param save: 是否把各接口结果保存到 data 目录（Clear_data.py 读取的文件）
+    :param max_workers: 同时拉取的接口数，默认全部接口同时拉取
+    :return: {文件名: DataFrame}，键与 BASE_DATA_FETCHERS 一致
+    """
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers or len(BASE_DATA_FETCHERS)) as executor:
+        futures = {name: executor.submit(fetch, get_pro(), save=save) for name, fetch in BASE_DATA_FETCHERS.items()}
+        frames = {name: future.result() for name, future in futures.items()}
+    print(f"基础数据拉取完成，耗时：{time.time() - start_time:.2f} 秒")
+    print(get_cache().summary())
+    return frames
+
+def main():
+    collect_base_data()
 
-fetch_and_save_daily_data(pro)
-fetch_and_save_stock_company_data(pro)
-fetch_and_save_namechange_data(pro)
-fetch_and_save_new_share_data(pro)
-
-df = pro.stock_basic(**{"ts_code": "", "name": "", "exchange": "", "market": "", "is_hs": "", "list_status": "", "limit": "", "offset": ""}, fields=["ts_code", "symbol", "name", "area", "industry", "market", "list_date", "act_name", "act_ent_type", "fullname", "enname", "exchange", "is_hs"])
-df_filtered = df[~df['ts_code'].str.startswith('8')]
-df_filtered.to_csv(os.path.join(data_dir, '股票列表.csv'), index=False)
-print(f"股票列表数据形状: {df_filtered.shape}")
-
-df = pro.bak_basic(**{"trade_date": "", "ts_code": "", "limit": "", "offset": ""}, fields=["trade_date", "ts_code", "industry", "area", "pe", "float_share", "total_share", "total_assets", "liquid_assets", "fixed_assets", "reserved", "eps", "bvps", "pb", "list_date", "undp", "per_undp", "rev_yoy", "profit_yoy", "gpr", "npr", "holder_num", "name"])
-df_filt = df[~df['ts_code'].str.startswith('8')]
-filt_df = df_filt.sort_values(by='trade_date', ascending=False).drop_duplicates(subset='ts_code', keep='first')
-filt_df.to_csv(os.path.join(data_dir, '备用列表.csv'), index=False)
-print(filt_df.shape)
-print(f"备用列表数据形状: {filt_df.shape}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,73 @@ import pandas as pd
 import os
 import time
 import sys
-from multiprocessing import Pool
+import json
+import queue
+import heapq
+import asyncio
+import argparse
+from collections import deque
+from functools import partial
 from datetime import datetime
 from dotenv import load_dotenv
+from Generating_periodic_data import load_state, load_state_from_db
+from rate_limiter import RateLimiter, retry_delay
+from api_cache import ApiCache
+from trade_calendar import load_calendar, next_day
+from async_fetcher import fetch_stock_data_async
+from storage import get_storage, normalize_trade_date
+from run_manifest import RunManifest
+from process_pool import context
 
 # 加载.env环境变量
 load_dotenv()
 TUSHARE_TOKEN = os.getenv('TUSHARE_TOKEN')
-if not TUSHARE_TOKEN:
-    raise ValueError('请在.env文件中设置TUSHARE_TOKEN')
+
+def get_token():
+    """返回 TUSHARE_TOKEN，未设置时抛出异常；导入本模块时不检查。"""
+    if not TUSHARE_TOKEN:
+        raise ValueError('请在.env文件中设置TUSHARE_TOKEN')
+    return TUSHARE_TOKEN
+
+# 按股票拉取的执行引擎：'process' 为多进程，'async' 为单进程 asyncio 并发
+FETCH_ENGINE = os.getenv('TUSHARE_FETCH_ENGINE', 'process')
+
+# 所有进程共享的限流器，由主进程创建并通过进程池 initializer 传给子进程
+limiter = None
+
+def get_limiter():
+    """返回当前进程的限流器，主进程首次调用时创建。"""
+    global limiter
+    if limiter is None:
+        limiter = RateLimiter()
+    return limiter
+
+# 所有进程共享的接口缓存，创建和传递方式与限流器相同
+cache = None
+
+def get_cache():
+    """返回当前进程的接口缓存，主进程首次调用时创建。"""
+    global cache
+    if cache is None:
+        cache = ApiCache()
+    return cache
+
+# 代替 Tushare pro 接口的对象（如基准测试的本地合成接口），由主进程设置并通过进程池 initializer 传给子进程，None 时调用 Tushare
+api = None
+
+def get_pro(token):
+    """返回 pro 接口，设置了 api 时返回 api。"""
+    if api is not None:
+        return api
+    ts.set_token(token)
+    return ts.pro_api()
+
+def init_worker(shared_limiter, shared_cache, shared_api=None):
+    """进程池子进程初始化：使用主进程创建的共享限流器、接口缓存和替代接口。"""
+    global limiter, cache, api
+    limiter = shared_limiter
+    cache = shared_cache
+    api = shared_api
 
 def fetch_and_save_single_stock(args):
     """
@@ -27,12 +85,10 @@ def fetch_and_save_single_stock(args):
     """
     code, start_date, end_date, token = args
     try:
-        ts.set_token(token)
-        pro = ts.pro_api()
+        pro = get_pro(token)
 
-        # 获取股票数据
-        data = pro.daily(ts_code=code, start_date=start_date, end_date=end_date)
-        time.sleep(0.4)
+        # 获取股票数据，命中接口缓存时直接返回，否则调用频率由共享限流器控制
+        data = get_cache().call(get_limiter(), 'daily', pro.daily, ts_code=code, start_date=start_date, end_date=end_date)
 
         # 检查数据是否为空
         if data is not None and not data.empty:
@@ -43,36 +99,79 @@ def fetch_and_save_single_stock(args):
     except Exception as e:
         return str(e)  # 返回错误信息
 
-def fetch_and_save_stock_data_parallel(stock_codes, start_date, end_date, token, output_file, num_processes):
+def fetch_stock_data_parallel(args_list, num_processes, max_attempts=4, sink=None):
     """
-    使用多进程拉取股票数据并保存为单个 CSV 文件。
+    使用多进程按股票拉取历史数据，失败的股票进入重试队列，按指数退避与主流程并行重试。
 
-    :param stock_codes: 股票代码列表
-    :param start_date: 起始日期，格式：YYYYMMDD
-    :param end_date: 结束日期，格式：YYYYMMDD
-    :param token: Tushare 的 API Token
-    :param output_file: 输出 CSV 文件路径
-    :param num_processes: 使用的进程数量
+    :param args_list: 参数元组列表，每个元组为 (code, start_date, end_date, token)
+    :param num_processes: 进程数量，实际同时在途的请求数由限流器自适应控制
+    :param max_attempts: 每只股票的最多尝试次数
+    :param sink: 流式写入器，提供时每只股票的数据到达后立即写入，不在内存中保留
+    :return: (成功拉取的 DataFrame 列表, 成功数量, 最终失败的股票 {code: 失败信息})
     """
-    # 为每只股票构建参数元组
-    args_list = [(code, start_date, end_date, token) for code in stock_codes]
-    
-    with Pool(num_processes) as pool:
-        total_stocks = len(stock_codes)
-        completed = 0
-        failed = 0
-        successful = 0
+    total_stocks = len(args_list)
+    completed = 0
+    successful = 0
+    empty = 0
+    retried = 0
+    all_data = []
+    failures = {}
+    if not args_list:
+        return all_data, successful, failures
+
+    results = queue.Queue()
+    pending = deque(args_list)
+    retry_heap = []
+    in_flight = 0
+    # 控制提交给进程池的任务数，使到期的重试任务不必排在全部首轮任务之后
+    max_in_flight = num_processes * 2
+
+    with context.Pool(num_processes, initializer=init_worker, initargs=(get_limiter(), get_cache(), api)) as pool:
         start_time = time.time()
 
-        all_data = []
-        
-        # 使用 imap_unordered 来获得各个进程返回的数据
-        for data in pool.imap_unordered(fetch_and_save_single_stock, args_list):
+        def submit(args, attempt):
+            pool.apply_async(fetch_and_save_single_stock, (args,),
+                             callback=lambda data: results.put((args, attempt, data)),
+                             error_callback=lambda e: results.put((args, attempt, str(e))))
+
+        while completed < total_stocks:
+            # 优先提交已到期的重试任务，其次是首轮任务
+            now = time.time()
+            while in_flight < max_in_flight and (retry_heap and retry_heap[0][0] <= now or pending):
+                if retry_heap and retry_heap[0][0] <= now:
+                    _, _, args, attempt = heapq.heappop(retry_heap)
+                else:
+                    args, attempt = pending.popleft(), 1
+                submit(args, attempt)
+                in_flight += 1
+
+            timeout = max(0.05, retry_heap[0][0] - now) if retry_heap and in_flight == 0 else 0.5
+            try:
+                args, attempt, data = results.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            in_flight -= 1
+            code = args[0]
+
             if isinstance(data, pd.DataFrame):
-                all_data.append(data)
+                if sink is not None:
+                    sink.write(data, [code])
+                else:
+                    all_data.append(data)
                 successful += 1
+            elif data is None:
+                if sink is not None:
+                    sink.write(None, [code])
+                empty += 1
+            elif attempt < max_attempts:
+                # 失败的股票放入重试队列，等待退避时间后再次提交
+                heapq.heappush(retry_heap, (time.time() + retry_delay(attempt), retried, args, attempt + 1))
+                get_limiter().metrics.add_retry('daily')
+                retried += 1
+                continue
             else:
-                failed += 1
+                failures[code] = {'ts_code': code, 'start_date': args[1], 'end_date': args[2],
+                                  'attempts': attempt, 'error': data}
 
             completed += 1
             
@@ -81,41 +180,365 @@ def fetch_and_save_stock_data_parallel(stock_codes, start_date, end_date, token,
             elapsed_time = time.time() - start_time
             
             # 每次更新进度时，使用 '\r' 让光标回到行首并更新所有信息
-            sys.stdout.write(f"\r拉取进度：{completed}/{total_stocks} ({percent_complete:.1f}%)，成功：{successful}，失败：{failed}，" 
-                            f"当前拉取：{args_list[completed-1][0]}，已耗时：{elapsed_time:.2f} 秒")
+            sys.stdout.write(f"\r拉取进度：{completed}/{total_stocks} ({percent_complete:.1f}%)，成功：{successful}，无数据：{empty}，"
+                            f"失败：{len(failures)}，重试：{retried}，当前拉取：{code}，已耗时：{elapsed_time:.2f} 秒")
             sys.stdout.flush()
 
         # 输出最终换行
         print()
-        
-        # 合并所有数据
-        if all_data:
-            final_data = pd.concat(all_data, ignore_index=True)
-            output_file_with_date = os.path.join(output_file, f"merged_stocks_data_{end_date}.csv")
-            final_data.to_csv(output_file_with_date, index=False)
-            print(f"所有数据已保存到 {output_file_with_date}")
+
+    stats = get_limiter().stats()
+    print(f"限流统计：当前并发 {stats['concurrency']}，累计限流等待 {stats['throttle_wait']:.1f} 秒，频率超限 {stats['quota_errors']} 次")
+    print(get_cache().summary())
+    return all_data, successful, failures
+
+def fetch_stock_data(args_list, num_processes, engine=None, sink=None):
+    """
+    按配置的执行引擎按股票拉取历史数据。
+
+    :param args_list: 参数元组列表，每个元组为 (code, start_date, end_date, token)
+    :param num_processes: 多进程引擎的进程数量
+    :param engine: 'process' 或 'async'，默认读取环境变量 TUSHARE_FETCH_ENGINE
+    :param sink: 流式写入器，提供时拉取结果直接写入磁盘，返回的 DataFrame 列表为空
+    :return: (成功拉取的 DataFrame 列表, 成功数量, 最终失败的股票 {code: 失败信息})
+    """
+    engine = engine or FETCH_ENGINE
+    if engine == 'async':
+        max_in_flight = int(os.getenv('TUSHARE_MAX_IN_FLIGHT', '50'))
+        return asyncio.run(fetch_stock_data_async(args_list, max_in_flight, sink=sink, cache=get_cache()))
+    return fetch_stock_data_parallel(args_list, num_processes, sink=sink)
+
+def failure_manifest_path(output_file, end_date):
+    """返回失败清单文件路径。"""
+    return os.path.join(output_file, f"failed_stocks_{end_date}.json")
+
+def write_failure_manifest(failures, output_file, end_date):
+    """
+    写入最终失败的股票清单，供后续运行只补拉这些股票；全部成功时删除旧清单。
+    """
+    manifest_file = failure_manifest_path(output_file, end_date)
+    if not failures:
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        return
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(list(failures.values()), f, ensure_ascii=False, indent=2)
+    print(f"{len(failures)} 只股票或交易日多次重试后仍失败，清单已保存到 {manifest_file}")
+
+def retry_failed_stocks(token, output_file, end_date, num_processes, engine=None):
+    """
+    只补拉失败清单中的股票和交易日，并合并进当日的日线文件。
+    """
+    manifest_file = failure_manifest_path(output_file, end_date)
+    if not os.path.isfile(manifest_file):
+        print(f"没有找到失败清单：{manifest_file}")
+        return
+    with open(manifest_file, encoding='utf-8') as f:
+        entries = json.load(f)
+
+    storage = get_storage(data_dir=output_file)
+    name = f"merged_stocks_data_{end_date}"
+    if storage.exists(name) and set(storage.cycles(name)) - {'daily'}:
+        print("当日周期数据已生成，补拉的股票将在下一次增量运行中按缺口补齐。")
+        return
+
+    # 整市场拉取失败的交易日重新整市场拉取，其余为按股票拉取失败的股票
+    date_entries = [e for e in entries if 'trade_date' in e]
+    stock_entries = [e for e in entries if 'trade_date' not in e]
+    print(f"补拉失败清单中的 {len(date_entries)} 个交易日、{len(stock_entries)} 只股票")
+    args_list = [(e['ts_code'], e['start_date'], e['end_date'], token) for e in stock_entries]
+    all_data = []
+    done_units = []
+    failures = {}
+    if date_entries:
+        pro = get_pro(token)
+        # 与增量拉取相同，只保留已有水位的股票，新上市股票已按股票拉取完整历史
+        watermarks = load_watermarks()
+        known_units = get_run_manifest(output_file, end_date).done_units('fetch')
+        for e in date_entries:
+            # 从失败的交易日拉到当时的结束日期，再次失败时停在失败的交易日，之后的交易日仍留待补拉
+            for trade_date in get_open_trade_dates(pro, e['trade_date'], e.get('end_date', e['trade_date'])):
+                key = f"trade_date:{trade_date}"
+                data = fetch_trade_date(pro, trade_date)
+                if isinstance(data, str):
+                    failures[key] = dict(e, trade_date=trade_date, attempts=e['attempts'] + 1, error=data)
+                    break
+                all_data.append(data if watermarks is None else data[data['ts_code'].isin(watermarks.index)])
+                done_units.append(key)
+        if watermarks is not None and all_data:
+            # 水位落后的股票在补拉的交易日中恢复交易时补齐缺口，之前的交易日中已有成交的股票已在拉取阶段补齐
+            global_watermark = watermarks.max()
+            traded = set(pd.concat(all_data)['ts_code'])
+            lagging = watermarks[(watermarks < global_watermark) & watermarks.index.isin(traded)]
+            lagging = lagging[[f"lagging:{code}" not in known_units for code in lagging.index]]
+            args_list += [(code, next_day(wm), global_watermark, token) for code, wm in lagging.items()]
+            done_units += [f"lagging:{code}" for code in lagging.index]
+    fetched_dates = len(all_data)
+    stock_data, successful, stock_failures = fetch_stock_data(args_list, num_processes, engine)
+    failures.update(stock_failures)
+    all_data += stock_data
+    done_units += [str(code) for code in pd.concat(stock_data)['ts_code'].unique()] if stock_data else []
+    if all_data:
+        # 失败的股票不在已保存的数据集中，补拉结果直接追加写入
+        data = pd.concat(all_data, ignore_index=True)
+        data['trade_date'] = normalize_trade_date(data['trade_date'])
+        if storage.fmt == 'csv':
+            data['trade_date'] = data['trade_date'].dt.strftime('%Y%m%d')
+        if storage.exists(name):
+            storage.insert(data, name)
         else:
-            print("没有数据可以保存。")
+            storage.write(data, name)
+        get_run_manifest(output_file, end_date).add_units('fetch', done_units)
+        print(f"补拉数据已写入 {storage.path(name)}")
+    write_failure_manifest(failures, output_file, end_date)
+    print(f"补拉结束：成功 {successful} 只股票、{fetched_dates} 个交易日，失败 {len(failures)}")
 
-        total_elapsed = time.time() - start_time
-        print(f"\n最终结果：成功 {successful}，失败 {failed}，总共 {total_stocks} 只股票。总耗时：{total_elapsed:.2f} 秒")
+def get_run_manifest(output_file, end_date):
+    """返回当日的运行清单。"""
+    return RunManifest(end_date, os.path.join(output_file, 'state'))
 
-if __name__ == "__main__":
-    directory = './data/'
+def open_merged_sink(output_file, end_date):
+    """
+    打开数据集 merged_stocks_data_{end_date} 的流式写入器（存储格式由 STORAGE_FORMAT 决定），
+    上次运行中断时从已落盘的位置继续，每次落盘的股票代码/交易日同步记入运行清单。
+
+    :param output_file: 输出目录
+    :param end_date: 结束日期，格式：YYYYMMDD
+    :return: StreamingSink，done_keys 为已完成的股票代码和交易日
+    """
+    storage = get_storage(data_dir=output_file)
+    sink = storage.open_sink(f"merged_stocks_data_{end_date}")
+    manifest = get_run_manifest(output_file, end_date)
+    if sink.done_keys:
+        print(f"从上次中断处继续：已落盘 {len(sink.done_keys)} 项，{sink.rows_written} 条")
+    else:
+        # 重新拉取日线后，下游阶段的进度不再有效
+        manifest.reset('fetch', 'generate', 'upload', 'bar_store', 'adjust', 'upload:stock_data_qfq', 'upload:stock_data_hfq')
+    sink.on_flush = lambda keys: manifest.add_units('fetch', keys)
+    return sink
+
+def close_merged_sink(sink, output_file, end_date, failures, incremental):
+    """
+    落盘剩余数据并发布数据集，在运行清单中标记拉取阶段完成。
+
+    :param incremental: 数据集是否只包含水位之后的日线，完整重新生成周期数据前据此核对
+    """
+    if sink.close():
+        print(f"所有数据已保存到 {sink.storage.path(sink.name)}，共 {sink.rows_written} 条")
+        get_run_manifest(output_file, end_date).mark_done('fetch', rows=sink.rows_written, failed=len(failures),
+                                                          incremental=incremental)
+    else:
+        print("没有数据可以保存。")
+
+def fetch_and_save_stock_data_parallel(stock_codes, start_date, end_date, token, output_file, num_processes, engine=None):
+    """
+    使用多进程拉取股票数据并保存为单个数据集。
+
+    :param stock_codes: 股票代码列表
+    :param start_date: 起始日期，格式：YYYYMMDD
+    :param end_date: 结束日期，格式：YYYYMMDD
+    :param token: Tushare 的 API Token
+    :param output_file: 输出目录
+    :param num_processes: 使用的进程数量
+    :param engine: 执行引擎，'process' 为多进程，'async' 为 asyncio 并发，默认读取环境变量 TUSHARE_FETCH_ENGINE
+    """
+    # 每只股票的数据到达后直接写入磁盘，跳过上次中断前已落盘的股票
+    sink = open_merged_sink(output_file, end_date)
+    args_list = [(code, start_date, end_date, token) for code in stock_codes if code not in sink.done_keys]
+    start_time = time.time()
+
+    _, successful, failures = fetch_stock_data(args_list, num_processes, engine, sink=sink)
+
+    close_merged_sink(sink, output_file, end_date, failures, incremental=False)
+    write_failure_manifest(failures, output_file, end_date)
+
+    total_elapsed = time.time() - start_time
+    print(f"\n最终结果：成功 {successful}，失败 {len(failures)}，总共 {len(stock_codes)} 只股票。总耗时：{total_elapsed:.2f} 秒")
+
+def load_watermarks(source='auto'):
+    """
+    读取每只股票已落盘的最新交易日（水位）。
+
+    :param source: 'local' 读取本地增量状态文件，'db' 读取 stock_data 表，'auto' 优先本地、其次数据库
+    :return: 以 ts_code 为索引、YYYYMMDD 字符串为值的 Series，无可用水位时返回 None
+    """
+    state = None
+    if source in ('auto', 'local'):
+        state = load_state()
+    if state is None and source in ('auto', 'db'):
+        state = load_state_from_db()
+    if state is None or 'daily' not in state:
+        return None
+    watermarks = state['daily'].set_index('ts_code')['trade_date']
+    return watermarks.dt.strftime('%Y%m%d')
+
+def get_calendar(pro, date=None):
+    """读取本地交易日历，需要时经过接口缓存和共享限流器刷新。"""
+    return load_calendar(pro, date, call=partial(get_cache().call, get_limiter()))
+
+def get_open_trade_dates(pro, start_date, end_date):
+    """
+    获取 [start_date, end_date] 区间内的交易日列表（升序，YYYYMMDD），优先使用本地交易日历。
+    """
+    calendar = get_calendar(pro, end_date)
+    if calendar is not None and calendar.covers(start_date) and calendar.covers(end_date):
+        return calendar.open_dates(start_date, end_date)
+    cal = get_cache().call(get_limiter(), 'trade_cal', pro.trade_cal, exchange='SSE', start_date=start_date, end_date=end_date, is_open='1')
+    return sorted(cal['cal_date'].astype(str).tolist())
+
+def fetch_trade_date(pro, trade_date):
+    """
+    整市场拉取一个交易日的日线。
+
+    :return: DataFrame；接口出错或没有返回数据时返回错误信息
+    """
+    try:
+        data = get_cache().call(get_limiter(), 'daily', pro.daily, trade_date=trade_date)
+    except Exception as e:
+        return str(e)
+    if data is None or data.empty:
+        return '整市场日线没有返回数据'
+    return data
+
+def fetch_trade_dates(pro, trade_dates, codes, sink, end_date, lagging=()):
+    """
+    按顺序整市场拉取交易日并写入 sink，只保留 codes 中的股票；跳过 sink 中已落盘的交易日。
+
+    遇到失败的交易日即停止：之后的交易日落盘后，生成阶段会把水位推进到这一天之后，下次运行不会再请求它；
+    数据集只包含失败交易日之前的日线，补拉阶段或下次运行从失败的交易日继续。
+
+    lagging 中的股票在拉取的交易日中有成交时，以 'lagging:代码' 随该交易日一起记入进度，中断后继续时仍然可知。
+
+    :param end_date: 本次拉取的结束日期，记入失败清单，补拉时拉到这一天
+    :param lagging: 水位落后于全局水位的股票代码
+    :return: (失败的交易日 {'trade_date:日期': 失败信息}，最后一个已拉取的交易日，没有时为 None，lagging 中有成交的股票集合)
+    """
+    fetched_through = None
+    traded = {key.split(':', 1)[1] for key in sink.done_keys if key.startswith('lagging:')}
+    for trade_date in trade_dates:
+        key = f"trade_date:{trade_date}"
+        if key in sink.done_keys:
+            fetched_through = trade_date
+            continue
+        data = fetch_trade_date(pro, trade_date)
+        if isinstance(data, str):
+            print(f"交易日 {trade_date} 拉取失败：{data}，之后的交易日留待补拉")
+            failure = {'trade_date': trade_date, 'end_date': end_date, 'attempts': 1, 'error': data}
+            return {key: failure}, fetched_through, traded
+        # 新上市股票按股票拉取完整历史，这里只保留已有水位的股票，避免重复
+        data = data[data['ts_code'].isin(codes)]
+        resumed = set(data['ts_code'][data['ts_code'].isin(lagging)]) - traded
+        sink.write(data, [key] + [f"lagging:{code}" for code in sorted(resumed)])
+        traded |= resumed
+        fetched_through = trade_date
+        print(f"交易日 {trade_date} 拉取完成：{len(data)} 条")
+    return {}, fetched_through, traded
+
+def fetch_and_save_stock_data_incremental(stock_codes, watermarks, start_date, end_date, token, output_file, num_processes, engine=None):
+    """
+    按水位增量拉取日线：缺失的交易日按 trade_date 整市场拉取，新上市或存在缺口的股票回退为按股票拉取。
+
+    :param stock_codes: 股票代码列表
+    :param watermarks: load_watermarks 返回的每只股票水位
+    :param start_date: 新上市股票的起始日期，格式：YYYYMMDD
+    :param end_date: 结束日期，格式：YYYYMMDD
+    :param token: Tushare 的 API Token
+    :param output_file: 输出目录
+    :param num_processes: 按股票回退拉取时使用的进程数量
+    :param engine: 按股票拉取的执行引擎，默认读取环境变量 TUSHARE_FETCH_ENGINE
+    """
+    start_time = time.time()
+    pro = get_pro(token)
+
+    stock_watermarks = watermarks.reindex(list(stock_codes))
+    known_watermarks = stock_watermarks.dropna()
+    if known_watermarks.empty:
+        print("股票列表中没有可用水位，改为拉取完整历史")
+        fetch_and_save_stock_data_parallel(stock_codes, start_date, end_date, token, output_file, num_processes, engine)
+        return
+    global_watermark = known_watermarks.max()
+    print(f"全局水位：{global_watermark}")
+
+    # 全局水位之后缺失的交易日，每个交易日一次整市场请求
+    sink = open_merged_sink(output_file, end_date)
+    trade_dates = get_open_trade_dates(pro, next_day(global_watermark), end_date) if global_watermark < end_date else []
+    lagging = known_watermarks[known_watermarks < global_watermark]
+    date_failures, fetched_through, traded = fetch_trade_dates(pro, trade_dates, known_watermarks.index, sink, end_date,
+                                                               lagging.index)
+    fetched_through = fetched_through or global_watermark
+
+    # 新上市股票拉取完整历史，只拉到最后一个已拉取的交易日，避免全局水位越过失败的交易日；
+    # 水位落后于全局水位、且在拉取的交易日中有成交的股票补齐缺口，停牌、退市的股票没有新数据，不逐只请求
+    new_codes = stock_watermarks[stock_watermarks.isna()].index
+    lagging = lagging[lagging.index.isin(traded)]
+    args_list = [(code, start_date, fetched_through, token) for code in new_codes]
+    args_list += [(code, next_day(wm), global_watermark, token) for code, wm in lagging.items()]
+    print(f"缺失交易日 {len(trade_dates)} 个，新上市 {len(new_codes)} 只，需补齐缺口 {len(lagging)} 只")
+    args_list = [args for args in args_list if args[0] not in sink.done_keys]
+
+    _, successful, failures = fetch_stock_data(args_list, num_processes, engine, sink=sink)
+    failures.update(date_failures)
+    close_merged_sink(sink, output_file, end_date, failures, incremental=True)
+    write_failure_manifest(failures, output_file, end_date)
+
+    total_elapsed = time.time() - start_time
+    print(f"\n增量拉取结束：整市场请求 {len(trade_dates)} 次，按股票请求成功 {successful}，失败 {len(failures)}。总耗时：{total_elapsed:.2f} 秒")
+
+def load_stock_codes(directory='./data/'):
+    """读取最新的 基础数据_预处理*.csv，返回股票代码数组，没有文件时返回 None。"""
     file_pattern = os.path.join(directory, "基础数据_预处理*.csv")
     files = glob.glob(file_pattern)
     if not files:
         print("没有找到符合条件的文件")
-    else:
-        latest_file = max(files, key=lambda x: os.path.basename(x).split('_')[-1].replace('.csv', ''))
-        stock_list = pd.read_csv(latest_file)
-        print(f"读取的文件是: {latest_file}")
-    stock_codes = stock_list['ts_code'].values    
-    selected_token = TUSHARE_TOKEN
+        return None
+    latest_file = max(files, key=lambda x: os.path.basename(x).split('_')[-1].replace('.csv', ''))
+    stock_list = pd.read_csv(latest_file)
+    print(f"读取的文件是: {latest_file}")
+    return stock_list['ts_code'].values
+
+def pull_daily_data(stock_codes=None, full=False, watermark_source='auto', engine=None, retry_failed=False, end_date=None):
+    """
+    拉取日线数据集 merged_stocks_data_{end_date}。
+
+    :param stock_codes: 股票代码列表，默认读取最新的预处理基础数据
+    :param full: 忽略水位，拉取全部股票的完整历史
+    :param watermark_source: 水位来源，'auto'、'local' 或 'db'
+    :param engine: 按股票拉取的执行引擎，默认读取环境变量 TUSHARE_FETCH_ENGINE
+    :param retry_failed: 只补拉当日失败清单中的股票
+    :param end_date: 结束日期（目标交易日），同时作为数据集和运行清单的日期，默认今天
+    :return: 数据集名称
+    """
+    selected_token = get_token()
     start_date = '20100101'
-    end_date = datetime.today().strftime('%Y%m%d')
+    end_date = end_date or datetime.today().strftime('%Y%m%d')
     output_file = './data'
-    num_processes = 5
+    num_processes = get_limiter().max_concurrency
 
-    # 开始拉取并保存数据
-    fetch_and_save_stock_data_parallel(stock_codes, start_date, end_date, selected_token, output_file, num_processes)
\ No newline at end of file
+    if retry_failed:
+        retry_failed_stocks(selected_token, output_file, end_date, num_processes, engine)
+        return f"merged_stocks_data_{end_date}"
+
+    if stock_codes is None:
+        stock_codes = load_stock_codes()
+        if stock_codes is None:
+            return None
+
+    # 有水位时只拉取缺失的交易日，否则拉取完整历史
+    watermarks = None if full else load_watermarks(watermark_source)
+    if watermarks is not None and not watermarks.empty:
+        fetch_and_save_stock_data_incremental(stock_codes, watermarks, start_date, end_date, selected_token, output_file, num_processes, engine)
+    else:
+        fetch_and_save_stock_data_parallel(stock_codes, start_date, end_date, selected_token, output_file, num_processes, engine)
+    return f"merged_stocks_data_{end_date}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='拉取日线历史数据')
+    parser.add_argument('--full', action='store_true', help='忽略水位，拉取全部股票的完整历史')
+    parser.add_argument('--watermark-source', choices=['auto', 'local', 'db'], default='auto',
+                        help='水位来源：本地增量状态文件、stock_data 表或自动选择')
+    parser.add_argument('--engine', choices=['process', 'async'], default=None,
+                        help='按股票拉取的执行引擎，默认读取环境变量 TUSHARE_FETCH_ENGINE')
+    parser.add_argument('--retry-failed', action='store_true', help='只补拉当日失败清单中的股票')
+    args = parser.parse_args()
+    pull_daily_data(full=args.full, watermark_source=args.watermark_source, engine=args.engine,
+                    retry_failed=args.retry_failed)
@@ -1,4 +1,3 @@
-import psycopg2
 import pandas as pd
 import time
 from datetime import datetime
@@ -6,8 +5,19 @@ import os
 import logging
 import io
 import sys
-import random
-import multiprocessing
+import struct
+import argparse
+import json
+import tempfile
+import numpy as np
+import pyarrow as pa
+from storage import get_storage, normalize_trade_date
+import schema
+from run_manifest import RunManifest
+import db_schema
+import db_pool
+import metrics
+from process_pool import context
 
 # 设置日志
 logging.basicConfig(
@@ -18,194 +28,655 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 def create_database_connection(max_attempts=5, base_delay=5):
-    """创建数据库连接，如果失败则重试
-    
-    Args:
-        max_attempts: 最大重试次数
-        base_delay: 基础等待时间（秒）
-    
-    Returns:
-        psycopg2连接对象
-    
-    Raises:
-        Exception: 如果超过最大重试次数仍无法连接
+    """创建数据库连接，连接参数读取自环境变量，重试机制见 db_pool.connect。"""
+    return db_pool.connect(max_attempts=max_attempts, base_delay=base_delay)
+
+# 上传的列，按数据库顺序；ts_code、trade_date、cycle 之后均为浮点列
+COLUMNS = ['ts_code', 'trade_date', 'cycle', 'open', 'high', 'low', 'close',
+           'pre_close', 'change', 'pct_chg', 'vol', 'amount']
+FLOAT_COLUMNS = COLUMNS[3:]
+
+# 批次行数、并发进程数与 COPY 格式（binary 或 csv），可通过环境变量或命令行参数调整
+UPLOAD_BATCH_SIZE = int(os.getenv('UPLOAD_BATCH_SIZE', '100000'))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '4'))
+UPLOAD_COPY_FORMAT = os.getenv('UPLOAD_COPY_FORMAT', 'binary')
+
+# 同步模式：delta 只上传新增和有变化的行，full 上传数据集中的全部行
+UPLOAD_SYNC_MODE = os.getenv('UPLOAD_SYNC_MODE', 'delta')
+
+# 周期K线的来源：python 上传生成阶段的周期数据，sql 只上传日线，周、月、季、年K线在数据库内由日线聚合（见 periodic_sql.py）
+UPLOAD_PERIODIC_MODE = os.getenv('UPLOAD_PERIODIC_MODE', 'python')
+
+# PostgreSQL 二进制 COPY 格式：文件头、结束标记，日期以 2000-01-01 起的天数表示
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+PG_EPOCH = np.datetime64('2000-01-01', 'D')
+
+# 待上传数据的临时文件目录，每个进程池一个 Arrow IPC 文件，上传结束后删除
+UPLOAD_SPOOL_DIR = './data/tmp/upload'
+
+# 工作进程内待上传的数据（内存映射的 Arrow 表），由进程池的 initializer 打开，按行号范围读取，不再逐批序列化 DataFrame；
+# 主进程不设置该变量，原始数据与复权数据的上传阶段并行运行时各自的进程池只读取自己的文件
+upload_data = None
+
+def spool_upload_data(data, table):
+    """
+    把待上传的数据写成 UPLOAD_SPOOL_DIR 下未压缩的 Arrow IPC 文件，返回文件路径，由调用方在上传结束后删除。
+    工作进程以 spawn 方式启动（见 process_pool.py），不继承主进程的数据框；数据只写一次，
+    各工作进程以内存映射方式共用同一个文件，不随进程数复制。
+    """
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=f'{table}_', suffix='.arrow', dir=UPLOAD_SPOOL_DIR)
+    os.close(fd)
+    arrow_table = pa.Table.from_pandas(data[COLUMNS], preserve_index=False)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, arrow_table.schema) as writer:
+        writer.write_table(arrow_table)
+    return path
+
+def init_upload_worker(spool_path, db_params=None, setup=None):
+    """
+    上传进程池的 initializer：以内存映射方式打开 spool_upload_data 写出的文件，并记录数据库连接参数（见 db_pool.init_worker）。
+    """
+    global upload_data
+    upload_data = pa.ipc.open_file(pa.memory_map(spool_path)).read_all()
+    db_pool.init_worker(db_params, setup)
+
+def upload_rows(start, end):
+    """以 DataFrame 返回 upload_data 中 [start, end) 行，只转换这些行。"""
+    return upload_data.slice(start, end - start).to_pandas()
+
+def create_table_sql(table='stock_data'):
+    """
+    建表语句：数据表，以及记录每只股票每个周期已入库最新交易日的水位表 {table}_watermark。
+    """
+    return f"""
+    CREATE TABLE IF NOT EXISTS {table} (
+        ts_code VARCHAR(10) NOT NULL,
+        trade_date DATE NOT NULL,
+        cycle VARCHAR(10) NOT NULL,
+        open FLOAT,
+        high FLOAT,
+        low FLOAT,
+        close FLOAT,
+        pre_close FLOAT,
+        change FLOAT,
+        pct_chg FLOAT,
+        vol FLOAT,
+        amount FLOAT,
+        PRIMARY KEY (ts_code, trade_date, cycle)
+    );
+    CREATE TABLE IF NOT EXISTS {table}_watermark (
+        ts_code VARCHAR(10) NOT NULL,
+        cycle VARCHAR(10) NOT NULL,
+        trade_date DATE NOT NULL,
+        PRIMARY KEY (ts_code, cycle)
+    );
+    """
+
+def encode_binary_copy(batch):
+    """
+    将一个批次编码为 PostgreSQL 二进制 COPY 数据。
+
+    没有空值的行按 (ts_code 长度, cycle 长度) 分组，每组用一个 numpy 结构化数组一次性写出整组行；
+    含空值的行逐行编码，空值写为长度 -1。
+
+    :param batch: 包含 COLUMNS 的 DataFrame
+    :return: bytes
+    """
+    ts_codes = batch['ts_code'].astype(str).to_numpy().astype('S')
+    cycles = batch['cycle'].astype(str).to_numpy().astype('S')
+    days = (normalize_trade_date(batch['trade_date']).to_numpy().astype('datetime64[D]') - PG_EPOCH).astype('int32')
+    values = schema.float64_values(batch, FLOAT_COLUMNS)
+    has_null = np.isnan(values).any(axis=1)
+    ts_lengths = np.char.str_len(ts_codes)
+    cycle_lengths = np.char.str_len(cycles)
+
+    parts = [COPY_HEADER]
+    fast_rows = np.flatnonzero(~has_null)
+    groups = np.unique(np.stack([ts_lengths[fast_rows], cycle_lengths[fast_rows]], axis=1), axis=0)
+    for ts_length, cycle_length in groups:
+        rows = fast_rows[(ts_lengths[fast_rows] == ts_length) & (cycle_lengths[fast_rows] == cycle_length)]
+        fields = [('count', '>i2'), ('ts_code_len', '>i4'), ('ts_code', f'S{ts_length}'),
+                  ('trade_date_len', '>i4'), ('trade_date', '>i4'),
+                  ('cycle_len', '>i4'), ('cycle', f'S{cycle_length}')]
+        for column in FLOAT_COLUMNS:
+            fields += [(f'{column}_len', '>i4'), (column, '>f8')]
+        records = np.empty(len(rows), dtype=np.dtype(fields))
+        records['count'] = len(COLUMNS)
+        records['ts_code_len'] = ts_length
+        records['ts_code'] = ts_codes[rows]
+        records['trade_date_len'] = 4
+        records['trade_date'] = days[rows]
+        records['cycle_len'] = cycle_length
+        records['cycle'] = cycles[rows]
+        for i, column in enumerate(FLOAT_COLUMNS):
+            records[f'{column}_len'] = 8
+            records[column] = values[rows, i]
+        parts.append(records.tobytes())
+
+    for row in np.flatnonzero(has_null):
+        fields = [struct.pack('>h', len(COLUMNS)),
+                  struct.pack('>i', len(ts_codes[row])), ts_codes[row],
+                  struct.pack('>ii', 4, days[row]),
+                  struct.pack('>i', len(cycles[row])), cycles[row]]
+        fields += [struct.pack('>i', -1) if np.isnan(value) else struct.pack('>id', 8, value) for value in values[row]]
+        parts.append(b''.join(fields))
+
+    parts.append(COPY_TRAILER)
+    return b''.join(parts)
+
+def copy_batch(cursor, batch, copy_format, target='tmp_stock_data'):
+    """把批次 COPY 进临时表 tmp_stock_data 或指定的暂存表。"""
+    if copy_format == 'binary':
+        buffer = io.BytesIO(encode_binary_copy(batch))
+        cursor.copy_expert(f"COPY {target} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT binary)", buffer)
+    else:
+        buffer = io.StringIO()
+        batch[COLUMNS].to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cursor.copy_from(buffer, target, sep=',', null='', columns=COLUMNS)
+    buffer.close()
+
+def prepare_staging(conn):
+    """在新连接上创建会话级临时表 tmp_stock_data，事务提交时清空，同一连接上的所有批次复用。"""
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS tmp_stock_data ({db_schema.COLUMNS_SQL}) ON COMMIT DELETE ROWS;")
+
+def upsert_sql(table, source='tmp_stock_data'):
+    """从 source 表 upsert 到 table 的语句，内容未变化的行不改写。"""
+    return f"""
+        INSERT INTO {table} ({', '.join(COLUMNS)})
+        SELECT {', '.join(COLUMNS)} FROM {source}
+        ON CONFLICT (ts_code, trade_date, cycle) DO UPDATE SET
+            open=EXCLUDED.open,
+            high=EXCLUDED.high,
+            low=EXCLUDED.low,
+            close=EXCLUDED.close,
+            pre_close=EXCLUDED.pre_close,
+            change=EXCLUDED.change,
+            pct_chg=EXCLUDED.pct_chg,
+            vol=EXCLUDED.vol,
+            amount=EXCLUDED.amount
+        WHERE ({', '.join(f'{table}.{column}' for column in FLOAT_COLUMNS)})
+            IS DISTINCT FROM ({', '.join(f'EXCLUDED.{column}' for column in FLOAT_COLUMNS)});
     """
-    attempt = 0
-    last_exception = None
-    
-    while attempt < max_attempts:
-        try:
-            conn = psycopg2.connect(
-                host='localhost', 
-                user='postgres', 
-                dbname='stocks',
-                connect_timeout=10,
-                options='-c statement_timeout=300000'  # 5分钟超时
-            )
-            if attempt > 0:
-                logger.info(f"成功连接到数据库，尝试次数：{attempt+1}")
-            return conn
-        except psycopg2.OperationalError as e:
-            attempt += 1
-            last_exception = e
-            
-            # 检查是否是数据库被占用的错误
-            if "is being accessed by other users" in str(e):
-                # 使用指数退避和随机抖动
-                delay = base_delay * (2 ** (attempt - 1)) + random.uniform(0, 3)
-                logger.warning(f"数据库被其他用户占用，{delay:.2f}秒后重试 ({attempt}/{max_attempts})：{e}")
-                time.sleep(delay)
-            else:
-                # 其他连接错误，直接抛出
-                raise e
-    
-    # 超出最大重试次数
-    logger.error(f"无法连接到数据库，已达到最大重试次数：{max_attempts}")
-    raise last_exception
 
 def upsert_batch(args):
-    batch_data, columns, db_params = args
+    """
+    上传 upload_data 中 [start, end) 行，返回 (批次编号, 写入行数, 耗时)，失败时写入行数为 0。
+    使用工作进程的持久连接和已建好的临时表，每个批次一个事务。
+    """
+    batch_index, start, end, table, copy_format = args
+    start_time = time.perf_counter()
     try:
-        conn = psycopg2.connect(**db_params)
+        batch_data = upload_rows(start, end)
+        conn = db_pool.worker_connection()
         with conn:
             with conn.cursor() as cursor:
-                buffer = io.StringIO()
-                batch_data.to_csv(buffer, index=False, header=False)
-                buffer.seek(0)
-                # 临时表用于copy_from
-                cursor.execute("""
-                    CREATE TEMP TABLE tmp_stock_data (
-                        ts_code VARCHAR(10),
-                        trade_date DATE,
-                        cycle VARCHAR(10),
-                        open FLOAT,
-                        high FLOAT,
-                        low FLOAT,
-                        close FLOAT,
-                        pre_close FLOAT,
-                        change FLOAT,
-                        pct_chg FLOAT,
-                        vol FLOAT,
-                        amount FLOAT
-                    ) ON COMMIT DROP;
-                """)
-                cursor.copy_from(buffer, 'tmp_stock_data', sep=',', columns=columns)
-                # upsert
+                copy_batch(cursor, batch_data, copy_format)
+                cursor.execute(upsert_sql(table))
+                # 与数据在同一事务中推进水位
                 cursor.execute(f"""
-                    INSERT INTO stock_data ({', '.join(columns)})
-                    SELECT {', '.join(columns)} FROM tmp_stock_data
-                    ON CONFLICT (ts_code, trade_date, cycle) DO UPDATE SET
-                        open=EXCLUDED.open,
-                        high=EXCLUDED.high,
-                        low=EXCLUDED.low,
-                        close=EXCLUDED.close,
-                        pre_close=EXCLUDED.pre_close,
-                        change=EXCLUDED.change,
-                        pct_chg=EXCLUDED.pct_chg,
-                        vol=EXCLUDED.vol,
-                        amount=EXCLUDED.amount;
+                    INSERT INTO {table}_watermark (ts_code, cycle, trade_date)
+                    SELECT ts_code, cycle, max(trade_date) FROM tmp_stock_data GROUP BY ts_code, cycle
+                    ORDER BY ts_code, cycle
+                    ON CONFLICT (ts_code, cycle) DO UPDATE SET
+                        trade_date=GREATEST({table}_watermark.trade_date, EXCLUDED.trade_date);
                 """)
-                buffer.close()
-        conn.close()
-        return len(batch_data)
+        return batch_index, len(batch_data), time.perf_counter() - start_time
     except Exception as e:
-        logger.error(f"批次上传失败: {e}")
-        return 0
+        logger.error(f"批次 {batch_index} 上传失败: {e}")
+        return batch_index, 0, time.perf_counter() - start_time
 
-def main():
-    start_time = time.time()
-    
-    # 读取CSV
-    today = datetime.today().strftime('%Y%m%d')
-    csv_file_path = f'./data/merged_stocks_data_{today}.csv'
-    
+def upload_batches(data, batch_indexes, batch_size, workers, db_params=None, table='stock_data', copy_format=None, on_commit=None):
+    """
+    用进程池并行上传指定批次，每个工作进程在整个上传期间复用一个数据库连接。
+
+    :param data: 待上传的数据，按行号切分批次
+    :param batch_indexes: 需要上传的批次编号
+    :param on_commit: 每个批次提交后以批次编号调用
+    :return: (写入行数, 失败批次数)
+    """
+    copy_format = copy_format or UPLOAD_COPY_FORMAT
+    num_rows = len(data)
+    tasks = [(i, i * batch_size, min(num_rows, (i + 1) * batch_size), table, copy_format) for i in batch_indexes]
+    rows_processed = num_rows - sum(end - start for _, start, end, *_ in tasks)
+    rows_written = 0
+    failed_batches = 0
+    spool_path = spool_upload_data(data, table)
     try:
-        data = pd.read_csv(csv_file_path)
-        logger.info(f"读取CSV文件，共{len(data)}条数据")
+        with context.Pool(processes=max(1, min(workers, len(tasks))), initializer=init_upload_worker,
+                          initargs=(spool_path, db_params, prepare_staging)) as pool:
+            for batch_index, rows, seconds in pool.imap_unordered(upsert_batch, tasks):
+                if rows:
+                    metrics.record_batch(table, 'upsert', rows, seconds)
+                    if on_commit is not None:
+                        on_commit(batch_index)
+                else:
+                    failed_batches += 1
+                rows_processed += rows
+                rows_written += rows
+                percent = int((rows_processed/num_rows)*100)
+                progress_msg = f"数据库导入进度: {percent}% ({rows_processed}/{num_rows})"
+                sys.stdout.write('\r' + progress_msg)
+                sys.stdout.flush()
+            # 等待工作进程正常退出并关闭各自的连接
+            pool.close()
+            pool.join()
+    finally:
+        os.remove(spool_path)
+    # 导入完成后换行
+    print()
+    return rows_written, failed_batches
+
+def split_partitions(data, loaded):
+    """
+    把数据拆成两部分：所属分区尚无数据的行通过暂存表整体装载，其余行按批次 upsert。
+
+    :param loaded: 已有数据的分区 {(cycle, year)}，见 db_schema.loaded_partitions
+    :return: (暂存装载的行, 需 upsert 的行, [(cycle, year, 起始行, 结束行)])；暂存装载的行按 (cycle, trade_date, ts_code) 排序，每个分区占连续的行
+    """
+    cycle_codes = data['cycle'].cat.codes.to_numpy()
+    daily = schema.CYCLES.index('daily')
+    years = np.where(cycle_codes == daily, data['trade_date'].dt.year.to_numpy(), 0)
+    keys = pd.DataFrame({'cycle': cycle_codes, 'year': years})
+    staged_mask = np.zeros(len(data), dtype=bool)
+    for code, year in keys.drop_duplicates().itertuples(index=False):
+        if (schema.CYCLES[code], int(year) if code == daily else None) not in loaded:
+            staged_mask |= (cycle_codes == code) & (years == year)
+
+    # 全部或没有行需要暂存装载时不复制数据
+    if staged_mask.all():
+        staged, rest = data, data.iloc[0:0]
+    elif not staged_mask.any():
+        staged, rest = data.iloc[0:0], data
+    else:
+        staged, rest = data[staged_mask], data[~staged_mask]
+    staged = schema.sort_rows(staged, ['cycle', 'trade_date', 'ts_code'])
+    staged_keys = keys[staged_mask].sort_values(['cycle', 'year'], ignore_index=True)
+    partitions = []
+    for (code, year), rows in staged_keys.groupby(['cycle', 'year'], sort=False).indices.items():
+        partitions.append((schema.CYCLES[code], int(year) if code == daily else None, int(rows.min()), int(rows.max()) + 1))
+    return staged, rest, partitions
+
+def load_partition(args):
+    """
+    通过暂存表整体装载 upload_data 中 [start, end) 行所属的分区，按批次大小分块 COPY，
+    返回 (分区名, 写入行数, 耗时)，失败时写入行数为 0。
+    """
+    cycle, year, start, end, table, copy_format, batch_size = args
+    name = db_schema.partition_name(table, cycle, year)
+    start_time = time.perf_counter()
+
+    def fill(cursor, staging):
+        for offset in range(start, end, batch_size):
+            copy_batch(cursor, upload_rows(offset, min(end, offset + batch_size)), copy_format, target=staging)
+
+    try:
+        db_schema.load_partition_via_staging(db_pool.worker_connection(), table, cycle, year, fill)
+        return name, end - start, time.perf_counter() - start_time
     except Exception as e:
-        logger.error(f"读取CSV文件失败: {e}")
-        return
+        logger.error(f"分区 {name} 装载失败: {e}")
+        return name, 0, time.perf_counter() - start_time
+
+def load_partitions(data, partitions, batch_size, workers, db_params=None, table='stock_data', copy_format=None, on_commit=None):
+    """
+    用进程池并行装载尚无数据的分区，每个分区在一个事务中完成。
+
+    :param data: split_partitions 返回的暂存装载的行
+    :param partitions: [(cycle, year, 起始行, 结束行)]
+    :param on_commit: 每个分区提交后以分区名调用
+    :return: (写入行数, 失败分区数)
+    """
+    copy_format = copy_format or UPLOAD_COPY_FORMAT
+    tasks = [(cycle, year, start, end, table, copy_format, batch_size) for cycle, year, start, end in partitions]
+    rows_written = 0
+    failed_partitions = 0
+    spool_path = spool_upload_data(data, table)
+    try:
+        with context.Pool(processes=max(1, min(workers, len(tasks))), initializer=init_upload_worker,
+                          initargs=(spool_path, db_params)) as pool:
+            for name, rows, seconds in pool.imap_unordered(load_partition, tasks):
+                if rows:
+                    metrics.record_batch(table, 'partition', rows, seconds)
+                    if on_commit is not None:
+                        on_commit(name)
+                    logger.info(f"分区 {name} 已装载 {rows} 行")
+                else:
+                    failed_partitions += 1
+                rows_written += rows
+            pool.close()
+            pool.join()
+    finally:
+        os.remove(spool_path)
+    return rows_written, failed_partitions
+
+def load_db_watermarks(conn, table='stock_data'):
+    """
+    读取每只股票每个周期已入库的最新交易日，水位表为空而数据表有数据时先从数据表初始化水位表。
+
+    :return: DataFrame，列为 ts_code、cycle、trade_date（datetime64）
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table}_watermark) OR NOT EXISTS (SELECT 1 FROM {table});")
+        if not cursor.fetchone()[0]:
+            logger.info("初始化水位表...")
+            cursor.execute(f"""
+                INSERT INTO {table}_watermark (ts_code, cycle, trade_date)
+                SELECT ts_code, cycle, max(trade_date) FROM {table} GROUP BY ts_code, cycle;
+            """)
+            conn.commit()
+        cursor.execute(f"SELECT ts_code, cycle, trade_date FROM {table}_watermark;")
+        watermarks = pd.DataFrame(cursor.fetchall(), columns=['ts_code', 'cycle', 'trade_date'])
+    watermarks['trade_date'] = pd.to_datetime(watermarks['trade_date'])
+    return watermarks
+
+def load_boundary_rows(conn, table='stock_data'):
+    """读取数据库中每只股票每个周期水位当天的行，用于判断仍未结束的周期K线是否有变化。"""
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT {', '.join(f's.{column}' for column in COLUMNS)}
+            FROM {table} s JOIN {table}_watermark w
+                ON s.ts_code = w.ts_code AND s.cycle = w.cycle AND s.trade_date = w.trade_date;
+        """)
+        rows = pd.DataFrame(cursor.fetchall(), columns=COLUMNS)
+    rows['trade_date'] = pd.to_datetime(rows['trade_date'])
+    rows[FLOAT_COLUMNS] = rows[FLOAT_COLUMNS].astype('float64')
+    return rows
+
+def delta_mask(data, conn, table='stock_data'):
+    """
+    与数据库中已入库的数据对比，标记需要写入的行：
+    交易日晚于 (ts_code, cycle) 水位的行为新增；等于水位的行与库中对应行逐列比较，有变化才更新；早于水位的行视为已入库。
+
+    :return: (逐行的布尔数组, 新增行数, 更新行数)
+    """
+    watermarks = load_db_watermarks(conn, table)
+
+    # 水位按 (cycle 编码, ts_code 编码) 放入二维数组，每行按编码查找水位，不为每行生成字符串
+    ts_codes = data['ts_code'].cat
+    lookup = np.full((len(schema.CYCLES), len(ts_codes.categories)), np.datetime64('NaT'), dtype='datetime64[ns]')
+    code_index = ts_codes.categories.get_indexer(watermarks['ts_code'])
+    cycle_index = pd.Index(schema.CYCLES).get_indexer(watermarks['cycle'])
+    known = (code_index >= 0) & (cycle_index >= 0)
+    lookup[cycle_index[known], code_index[known]] = watermarks['trade_date'].to_numpy()[known]
+    watermark_dates = lookup[data['cycle'].cat.codes.to_numpy(), ts_codes.codes.to_numpy()]
+    trade_dates = data['trade_date'].to_numpy()
+    new_mask = np.isnat(watermark_dates) | (trade_dates > watermark_dates)
+    boundary_mask = trade_dates == watermark_dates
+
+    changed_mask = np.zeros(len(data), dtype=bool)
+    if boundary_mask.any():
+        rows = np.flatnonzero(boundary_mask)
+        keys = pd.DataFrame({'ts_code': data['ts_code'].iloc[rows].astype(str).to_numpy(),
+                             'cycle': data['cycle'].iloc[rows].astype(str).to_numpy(),
+                             'trade_date': trade_dates[rows]})
+        boundary = keys.merge(load_boundary_rows(conn, table), how='left', on=['ts_code', 'cycle', 'trade_date'])
+        new_values = schema.float64_values(data.iloc[rows], FLOAT_COLUMNS)
+        old_values = boundary[FLOAT_COLUMNS].to_numpy(dtype='float64')
+        same = np.isclose(new_values, old_values, rtol=0, atol=1e-9) | (np.isnan(new_values) & np.isnan(old_values))
+        changed_mask[rows[~same.all(axis=1)]] = True
+
+    return new_mask | changed_mask, int(new_mask.sum()), int(changed_mask.sum())
+
+def run_benchmark(data, batch_size, workers, db_params):
+    """
+    分别用 csv 和 binary 两种 COPY 格式把数据上传到临时的 stock_data_benchmark 表，报告每秒写入行数。
+    每种格式先在空表上插入一次，再对全部已存在的行 upsert 一次。
+    """
+    num_batches = (len(data) + batch_size - 1) // batch_size
+    conn = create_database_connection()
+    conn.autocommit = True
+    results = []
+    try:
+        for copy_format in ['csv', 'binary']:
+            with conn.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS stock_data_benchmark, stock_data_benchmark_watermark;")
+                cursor.execute(create_table_sql('stock_data_benchmark'))
+            for mode in ['insert', 'upsert']:
+                start = time.time()
+                rows, failed = upload_batches(data, range(num_batches), batch_size, workers, db_params,
+                                              table='stock_data_benchmark', copy_format=copy_format)
+                elapsed = time.time() - start
+                results.append((copy_format, mode, rows, failed, elapsed))
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS stock_data_benchmark, stock_data_benchmark_watermark;")
+        conn.close()
+
+    logger.info(f"基准测试：{len(data)} 行，批次 {batch_size} 行，{workers} 个进程")
+    for copy_format, mode, rows, failed, elapsed in results:
+        logger.info(f"{copy_format:<6} {mode:<6} {rows} 行，耗时 {elapsed:.2f} 秒，{rows / elapsed:,.0f} 行/秒"
+                    + (f"，失败 {failed} 个批次" if failed else ""))
+    return results
+
+def main(data=None, batch_size=None, workers=None, copy_format=None, benchmark=False, sync_mode=None,
+         table='stock_data', dataset_prefix='merged_stocks_data_', periodic_mode=None, run_date=None):
+    """
+    上传当日数据集到 stock_data 表。
+
+    :param data: 上一阶段在内存中生成的日线与周期数据（DataFrame 或按周期的 DataFrame 列表），为 None 时从存储读取当日数据集
+    :param batch_size: 每批行数，默认读取环境变量 UPLOAD_BATCH_SIZE（100000）
+    :param workers: 并发上传的进程数，默认读取环境变量 UPLOAD_WORKERS（4）
+    :param copy_format: COPY 格式，'binary' 或 'csv'，默认读取环境变量 UPLOAD_COPY_FORMAT
+    :param benchmark: 只在临时表上对比两种 COPY 格式的写入速度，不修改 stock_data
+    :param sync_mode: 'delta' 只上传新增和有变化的行，'full' 上传全部行，默认读取环境变量 UPLOAD_SYNC_MODE
+    :param table: 目标数据表，复权数据上传到 stock_data_qfq / stock_data_hfq
+    :param dataset_prefix: 当日数据集名称的前缀
+    :param periodic_mode: 'python' 上传全部周期，'sql' 只上传日线并在数据库内聚合其他周期，默认读取环境变量 UPLOAD_PERIODIC_MODE
+    :param run_date: 运行日期（目标交易日），用于数据集名称和运行清单，默认今天
+    """
+    start_time = time.time()
     
     # 只保留需要的列，按数据库顺序
-    columns = ['ts_code', 'trade_date', 'cycle', 'open', 'high', 'low', 'close', 
-               'pre_close', 'change', 'pct_chg', 'vol', 'amount']
-    data = data[columns]
-    
-    # 计算批次数
-    batch_size = 100000
-    num_rows = len(data)
-    num_batches = (num_rows + batch_size - 1) // batch_size
+    columns = COLUMNS
+
+    # 读取当日数据集
+    today = run_date or datetime.today().strftime('%Y%m%d')
+    storage = get_storage()
+    dataset_name = f'{dataset_prefix}{today}'
     
-    db_params = dict(
-        host='localhost', 
-        user='postgres', 
-        dbname='stocks',
-        connect_timeout=10,
-        options='-c statement_timeout=300000'
-    )
+    if data is not None:
+        # 各周期数据只拼接一次，多余的列就地删除，不再按列选择复制
+        data = schema.concat(data if isinstance(data, list) else [data])
+        data.drop(columns=[column for column in data.columns if column not in columns], inplace=True)
+        schema.apply_schema(data)
+        logger.info(f"使用内存中的数据集 {dataset_name}，共{len(data)}条数据")
+    else:
+        try:
+            data = storage.read(dataset_name, columns=columns)
+            logger.info(f"读取数据集 {storage.path(dataset_name)}，共{len(data)}条数据")
+        except Exception as e:
+            logger.error(f"读取数据集失败: {e}")
+            return
     
-    # 使用上下文管理器处理数据库连接，包含重试机制
-    conn = None
+    db_params = db_pool.db_params()
+    sync_mode = sync_mode or UPLOAD_SYNC_MODE
+    periodic_mode = periodic_mode or UPLOAD_PERIODIC_MODE
+    batch_size = batch_size or UPLOAD_BATCH_SIZE
+    workers = workers or UPLOAD_WORKERS
+
+    # 主进程在整个上传期间只用一个连接执行建表、增量对比和 ANALYZE，上传的工作进程各自持有持久连接
+    conn = None if benchmark else create_database_connection()
     try:
-        # 尝试建立连接并处理可能的数据库占用问题
-        conn = create_database_connection()
-        
-        with conn:
-            with conn.cursor() as cursor:
-                # 建表
-                create_table_sql = """
-                CREATE TABLE IF NOT EXISTS stock_data (
-                    ts_code VARCHAR(10) NOT NULL,
-                    trade_date DATE NOT NULL,
-                    cycle VARCHAR(10) NOT NULL,
-                    open FLOAT,
-                    high FLOAT,
-                    low FLOAT,
-                    close FLOAT,
-                    pre_close FLOAT,
-                    change FLOAT,
-                    pct_chg FLOAT,
-                    vol FLOAT,
-                    amount FLOAT,
-                    PRIMARY KEY (ts_code, trade_date, cycle)
-                );
-                """
-                cursor.execute(create_table_sql)
-        conn.close()
-        
-        # 多进程上传
-        pool = multiprocessing.Pool(processes=min(4, num_batches))
-        batches = [(data.iloc[i*batch_size:(i+1)*batch_size], columns, db_params) for i in range(num_batches)]
-        results = []
-        for i, res in enumerate(pool.imap_unordered(upsert_batch, batches), 1):
-            results.append(res)
-            rows_processed = sum(results)
-            percent = int((rows_processed/num_rows)*100)
-            progress_msg = f"数据库导入进度: {percent}% ({rows_processed}/{num_rows})"
-            sys.stdout.write('\r' + progress_msg)
-            sys.stdout.flush()
-        pool.close()
-        pool.join()
-        
-        # 导入完成后换行
-        print()
-        
-        # 重新分析表
-        conn = create_database_connection()
-        with conn:
-            with conn.cursor() as cursor:
-                cursor.execute("ANALYZE stock_data;")
-        logger.info(f"成功导入 {num_rows} 条数据！")
-                
-    except Exception as e:
-        logger.error(f"数据库操作失败: {e}")
-        # 确保连接被关闭
+        since = upload(data, conn, today, start_time, batch_size, workers, db_params, copy_format, benchmark, sync_mode, table,
+                       periodic_mode)
+        if periodic_mode == 'sql' and not benchmark:
+            # 上传中断后重新运行时本次没有上传日线，状态表落后于日线水位的股票仍会重新聚合
+            import periodic_sql
+            periodic_sql.refresh(conn, table, since=since)
+    finally:
         if conn and not conn.closed:
             conn.close()
-    
+
     # 显示总耗时
     elapsed_time = time.time() - start_time
     logger.info(f"任务完成，总耗时: {elapsed_time:.2f} 秒")
 
+def upload_selection_path(manifest, table):
+    """上传选中的行和已有数据的分区保存在运行清单旁。"""
+    return os.path.join(os.path.dirname(manifest.path), f'upload_selection_{table}_{manifest.run_date}.npz')
+
+def save_upload_selection(manifest, table, mask, loaded):
+    """
+    保存第一次上传时的增量对比结果和已有数据的分区，先写临时文件再替换。
+
+    :param mask: 按排序后的数据集逐行标记是否需要上传，全量同步时为 None
+    :param loaded: 已有数据的分区 {(cycle, year)}
+    """
+    path = upload_selection_path(manifest, table)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    arrays = {'loaded': np.array(json.dumps(sorted(loaded, key=str)))}
+    if mask is not None:
+        arrays['mask'] = mask
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+def load_upload_selection(manifest, table):
+    """读取 save_upload_selection 保存的 (mask, loaded)，文件不存在时返回 None。"""
+    path = upload_selection_path(manifest, table)
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as selection:
+        mask = selection['mask'] if 'mask' in selection.files else None
+        loaded = {(cycle, year) for cycle, year in json.loads(str(selection['loaded']))}
+    return mask, loaded
+
+def finish_upload(manifest, stage, table):
+    """标记上传阶段完成并删除保存的选择。"""
+    manifest.mark_done(stage)
+    path = upload_selection_path(manifest, table)
+    if os.path.isfile(path):
+        os.remove(path)
+
+def upload_stage(table):
+    """运行清单中上传阶段的名称，stock_data 为 'upload'，其他数据表为 'upload:{table}'。"""
+    return 'upload' if table == 'stock_data' else f'upload:{table}'
+
+def upload(data, conn, today, start_time, batch_size, workers, db_params, copy_format, benchmark, sync_mode, table='stock_data',
+           periodic_mode='python'):
+    """
+    main 的上传过程，conn 为主进程的连接，基准测试时为 None。
+
+    :return: periodic_mode 为 'sql' 时返回待上传日线中每只股票的最早交易日（Series），否则为 None
+    """
+    # 在数据库内聚合周期K线时只上传日线
+    if periodic_mode == 'sql' and not benchmark:
+        daily = (data['cycle'] == 'daily').to_numpy()
+        if not daily.all():
+            data = data[daily]
+    # 按 (cycle, ts_code, trade_date) 排序，使内存数据与存储读出的数据划分出相同的批次，中断后可按批次编号继续；
+    # 生成阶段按周期顺序传入的数据已经有序，不再复制
+    data = schema.sort_rows(data, ['cycle', 'ts_code', 'trade_date'])
+
+    if benchmark:
+        run_benchmark(data, batch_size, workers, db_params)
+        return
+
+    # 运行清单记录已提交的分区和批次；工作单元按数据集的行数、同步方式和批次大小划分，
+    # 不随已提交批次之后重新计算的增量变化
+    layout = db_schema.ensure_schema(conn, table)
+    stage = upload_stage(table)
+    manifest = RunManifest(today)
+    manifest.check_params(stage, rows=len(data), sync_mode=sync_mode, periodic_mode=periodic_mode, batch_size=batch_size)
+    if manifest.is_done(stage):
+        logger.info(f"今日数据已全部上传到 {table}，跳过")
+        return None
+    committed = manifest.done_units(stage)
+
+    # 增量同步时与库中水位和水位当天的行对比，只保留新增和有变化的行；分区表中尚无数据的分区通过暂存表整体装载。
+    # 已有批次提交后，库中水位和已有数据的分区都已变化，沿用第一次上传时保存的选择
+    selection = load_upload_selection(manifest, table) if committed else None
+    if committed and selection is None:
+        logger.info("没有找到上次上传选中的行，重新上传")
+        manifest.reset(stage)
+        manifest.check_params(stage, rows=len(data), sync_mode=sync_mode, periodic_mode=periodic_mode, batch_size=batch_size)
+        committed = set()
+    if selection is not None:
+        mask, loaded = selection
+    else:
+        mask = None
+        if sync_mode == 'delta':
+            mask, inserted, updated = delta_mask(data, conn, table)
+            logger.info(f"增量同步：新增 {inserted} 行，更新 {updated} 行，跳过未变化的 {len(data) - int(mask.sum())} 行")
+        loaded = set()
+        if layout == 'partitioned':
+            with conn:
+                with conn.cursor() as cursor:
+                    loaded = db_schema.loaded_partitions(cursor, table)
+        save_upload_selection(manifest, table, mask, loaded)
+    if mask is not None and not mask.all():
+        data = data[mask]
+    since = None
+    if periodic_mode == 'sql':
+        since = data.groupby('ts_code', observed=True)['trade_date'].min()
+    num_rows = len(data)
+
+    # 分区表中尚无数据的分区（首次上传、新的年份）通过暂存表整体装载，其余行按批次 upsert
+    partitions = []
+    if layout == 'partitioned':
+        staged, data, partitions = split_partitions(data, loaded)
+    num_batches = (len(data) + batch_size - 1) // batch_size
+
+    if num_rows == 0:
+        finish_upload(manifest, stage, table)
+        logger.info(f"{table} 已是最新，无需上传")
+        return since
+    pending = [i for i in range(num_batches) if i not in committed]
+    partitions = [p for p in partitions if db_schema.partition_name(table, p[0], p[1]) not in committed]
+    if committed:
+        logger.info(f"从上次中断处继续：已提交 {num_batches - len(pending)}/{num_batches} 个批次，待装载 {len(partitions)} 个分区")
+
+    try:
+        failed_partitions = 0
+        if partitions:
+            logger.info(f"通过暂存表装载 {len(partitions)} 个分区，共 {len(staged)} 行")
+            _, failed_partitions = load_partitions(staged, partitions, batch_size, workers, db_params, table=table,
+                                                   copy_format=copy_format, on_commit=lambda name: manifest.add_units(stage, [name]))
+        staged = None
+
+        # 多进程上传，每个批次提交后记入运行清单
+        failed_batches = 0
+        if pending:
+            _, failed_batches = upload_batches(data, pending, batch_size, workers, db_params, table=table, copy_format=copy_format,
+                                               on_commit=lambda batch_index: manifest.add_units(stage, [batch_index]))
+
+        if failed_partitions:
+            logger.error(f"{failed_partitions} 个分区装载失败，重新运行将只装载这些分区")
+        if failed_batches:
+            logger.error(f"{failed_batches} 个批次上传失败，重新运行将只上传这些批次")
+        if not failed_partitions and not failed_batches:
+            # 重新分析表，暂存装载的分区已在装载时分析
+            if pending:
+                with conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(f"ANALYZE {table};")
+            finish_upload(manifest, stage, table)
+            logger.info(f"成功导入 {num_rows} 条数据，{num_rows / (time.time() - start_time):,.0f} 行/秒！")
+
+    except Exception as e:
+        logger.error(f"数据库操作失败: {e}")
+    return since
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='上传当日数据集到 PostgreSQL')
+    parser.add_argument('--batch-size', type=int, default=None, help='每批行数，默认读取环境变量 UPLOAD_BATCH_SIZE')
+    parser.add_argument('--workers', type=int, default=None, help='并发上传的进程数，默认读取环境变量 UPLOAD_WORKERS')
+    parser.add_argument('--copy-format', choices=['binary', 'csv'], default=None,
+                        help='COPY 格式，默认读取环境变量 UPLOAD_COPY_FORMAT')
+    parser.add_argument('--benchmark', action='store_true', help='在临时表上对比两种 COPY 格式的写入速度')
+    parser.add_argument('--full-sync', action='store_true', help='上传数据集中的全部行，不与库中数据对比')
+    parser.add_argument('--periodic-sql', action='store_true', help='只上传日线，周、月、季、年K线在数据库内聚合')
+    parser.add_argument('--migrate', action='store_true', help='把未分区的旧 stock_data 表迁移为分区表后退出')
+    parser.add_argument('--keep-legacy', action='store_true', help='迁移完成后保留旧表 stock_data_legacy')
+    args = parser.parse_args()
+    if args.migrate:
+        conn = create_database_connection()
+        try:
+            db_schema.migrate_legacy_table(conn, keep_legacy=args.keep_legacy)
+        finally:
+            conn.close()
+        sys.exit(0)
+    main(batch_size=args.batch_size, workers=args.workers, copy_format=args.copy_format, benchmark=args.benchmark,
+         sync_mode='full' if args.full_sync else None, periodic_mode='sql' if args.periodic_sql else None)
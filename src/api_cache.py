@@ -0,0 +1,235 @@
+import os
+import time
+import json
+import pickle
+import hashlib
+from datetime import datetime, timedelta
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from process_pool import context
+
+# 加载.env环境变量
+load_dotenv()
+
+# 缓存目录、总大小上限（MB），TUSHARE_CACHE=0 时关闭缓存
+CACHE_DIR = os.getenv('TUSHARE_CACHE_DIR', './data/cache/tushare')
+CACHE_MAX_MB = int(os.getenv('TUSHARE_CACHE_MAX_MB', '2048'))
+CACHE_ENABLED = os.getenv('TUSHARE_CACHE', '1') != '0'
+
+# 各接口缓存的有效期（秒），'day' 表示当天有效、次日零点过期；未列出的接口使用 DEFAULT_TTL
+CACHE_TTL = {
+    'stock_company': 'day',
+    'stock_basic': 'day',
+    'namechange': 'day',
+    'new_share': 'day',
+    'bak_basic': 'day',
+    'trade_cal': 'day',
+    'daily': 3600,
+    'adj_factor': 3600,
+}
+DEFAULT_TTL = 3600
+
+# 行情类接口请求的日期全部早于今天时，返回的历史数据不再变化，缓存永不过期
+HISTORICAL_APIS = {'daily', 'adj_factor'}
+
+# 写入 Parquet 元数据的键，记录接口名称、参数和过期时间
+META_KEY = b'api_cache'
+
+
+def cache_key(api_name, params):
+    """接口名称与参数的 sha256，参数按键排序，取值相同的调用得到同一个键。"""
+    payload = json.dumps({'api': api_name, 'params': params}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def expires_at(api_name, params, now=None):
+    """
+    按接口的有效期规则计算过期时间戳，None 表示永不过期。
+    """
+    now = now or datetime.now()
+    today = now.strftime('%Y%m%d')
+    if api_name in HISTORICAL_APIS:
+        end = params.get('end_date') or params.get('trade_date')
+        if end and str(end).replace('-', '') < today:
+            return None
+    ttl = CACHE_TTL.get(api_name, DEFAULT_TTL)
+    if ttl == 'day':
+        return datetime.combine(now.date() + timedelta(days=1), datetime.min.time()).timestamp()
+    return now.timestamp() + ttl
+
+
+class ApiCache:
+    """
+    按接口名称和参数寻址的 Tushare 返回结果磁盘缓存。
+
+    每次调用的结果以 Parquet 文件保存（无法转换为 Arrow 的数据框退回 pickle），文件名为接口名称与参数的 sha256；
+    命中时更新文件修改时间，总大小超过上限时按修改时间淘汰最久未使用的文件。
+    命中、未命中次数和缓存总大小保存在共享内存中，需在创建进程池之前构造，并通过 initializer 传给子进程。
+    """
+
+    def __init__(self, cache_dir=None, max_mb=None, enabled=None):
+        """
+        :param cache_dir: 缓存目录，默认读取环境变量 TUSHARE_CACHE_DIR（./data/cache/tushare）
+        :param max_mb: 缓存总大小上限（MB），默认读取环境变量 TUSHARE_CACHE_MAX_MB（2048）
+        :param enabled: 是否启用缓存，默认读取环境变量 TUSHARE_CACHE
+        """
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.max_bytes = (max_mb or CACHE_MAX_MB) * 2**20
+        self.enabled = CACHE_ENABLED if enabled is None else enabled
+
+        self._lock = context.Lock()
+        self._hits = context.RawValue('i', 0)
+        self._misses = context.RawValue('i', 0)
+        self._evicted = context.RawValue('i', 0)
+        self._size = context.RawValue('q', sum(size for _, _, size in self._entries()) if self.enabled else 0)
+
+    def _path(self, api_name, key, suffix):
+        return os.path.join(self.cache_dir, api_name, f'{key}.{suffix}')
+
+    def _entries(self):
+        """返回缓存中全部文件 (修改时间, 路径, 大小)。"""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for api_dir in os.scandir(self.cache_dir):
+            if not api_dir.is_dir():
+                continue
+            for entry in os.scandir(api_dir.path):
+                if entry.name.endswith(('.parquet', '.pkl')):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._size.value = max(0, self._size.value - size)
+
+    def get(self, api_name, params):
+        """
+        查找缓存，未命中或已过期时返回 None。
+        """
+        if not self.enabled:
+            return None
+        key = cache_key(api_name, params)
+        for suffix in ('parquet', 'pkl'):
+            path = self._path(api_name, key, suffix)
+            if not os.path.isfile(path):
+                continue
+            try:
+                if suffix == 'parquet':
+                    table = pq.read_table(path)
+                    meta = json.loads(table.schema.metadata[META_KEY])
+                    df = None
+                else:
+                    with open(path, 'rb') as f:
+                        meta, df = pickle.load(f)
+            except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError, pa.ArrowException):
+                # 文件被其他进程淘汰或内容损坏，按未命中处理
+                self._remove(path)
+                break
+            # 早先写入的空结果同样按未命中处理
+            empty = table.num_rows == 0 if df is None else df.empty
+            if empty or meta['expires_at'] is not None and meta['expires_at'] <= time.time():
+                self._remove(path)
+                break
+            # 修改时间记录最近一次使用，淘汰时按修改时间排序
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                self._hits.value += 1
+            return df if df is not None else table.to_pandas()
+        with self._lock:
+            self._misses.value += 1
+        return None
+
+    def put(self, api_name, params, df):
+        """
+        写入缓存，先写临时文件再重命名，总大小超过上限时淘汰最久未使用的文件。
+        空结果不缓存：历史日期的行情缓存永不过期，暂时没有返回数据的请求需要在之后重新请求。
+        """
+        if not self.enabled or not isinstance(df, pd.DataFrame) or df.empty:
+            return
+        key = cache_key(api_name, params)
+        meta = {'api': api_name, 'params': params, 'expires_at': expires_at(api_name, params)}
+        os.makedirs(os.path.join(self.cache_dir, api_name), exist_ok=True)
+        path = self._path(api_name, key, 'parquet')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            table = pa.Table.from_pandas(df)
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                                   META_KEY: json.dumps(meta, default=str).encode('utf-8')})
+            pq.write_table(table, tmp_path)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # 列中混有无法统一类型的取值时改用 pickle 保存
+            path = self._path(api_name, key, 'pkl')
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((meta, df), f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size.value += size
+            over = self._size.value > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        """按最近使用时间从旧到新删除缓存文件，直到总大小降到上限的 90%。"""
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._size.value = total
+            self._evicted.value += evicted
+
+    def call(self, limiter, api_name, func, **params):
+        """
+        命中缓存时直接返回，不占用限流令牌；否则在限流下调用 func(**params) 并写入缓存。
+
+        :param limiter: 限流器
+        :param api_name: 接口名称，用于寻址和确定有效期
+        :param func: pro 的接口方法
+        """
+        df = self.get(api_name, params)
+        if df is not None:
+            return df
+        df = limiter.call(func, api_name=api_name, **params)
+        self.put(api_name, params, df)
+        return df
+
+    def stats(self):
+        """返回命中次数、未命中次数、淘汰文件数和缓存总大小（字节）。"""
+        with self._lock:
+            return {
+                'hits': self._hits.value,
+                'misses': self._misses.value,
+                'evicted': self._evicted.value,
+                'size': self._size.value,
+            }
+
+    def summary(self):
+        """返回缓存命中情况的描述。"""
+        stats = self.stats()
+        total = stats['hits'] + stats['misses']
+        rate = stats['hits'] / total * 100 if total else 0.0
+        return (f"接口缓存：命中 {stats['hits']} 次，未命中 {stats['misses']} 次（命中率 {rate:.1f}%），"
+                f"淘汰 {stats['evicted']} 个文件，占用 {stats['size'] / 2**20:.1f} MB")
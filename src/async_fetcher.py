@@ -0,0 +1,131 @@
+import os
+import sys
+import time
+import json
+import asyncio
+import aiohttp
+import pandas as pd
+from rate_limiter import RateLimiter, retry_delay
+
+# Tushare HTTP 接口地址，可通过环境变量指向本地模拟服务
+TUSHARE_API_URL = os.getenv('TUSHARE_API_URL', 'http://api.waditu.com')
+
+
+class AsyncTushareClient:
+    """
+    基于 aiohttp 的 Tushare 异步客户端，请求与返回格式与 tushare.pro.client.DataApi 一致。
+    """
+
+    def __init__(self, token, session, url=None):
+        """
+        :param token: Tushare API 的 Token
+        :param session: 复用的 aiohttp.ClientSession（连接池）
+        :param url: 接口地址，默认为 TUSHARE_API_URL
+        """
+        self.token = token
+        self.session = session
+        self.url = url or TUSHARE_API_URL
+
+    async def query(self, api_name, fields='', **kwargs):
+        req_params = {
+            'api_name': api_name,
+            'token': self.token,
+            'params': kwargs,
+            'fields': fields
+        }
+        # HTTP 错误和接口返回的错误码都抛出异常，由调用方重试或记入失败清单，不当作没有数据
+        async with self.session.post(self.url, json=req_params) as res:
+            if res.status != 200:
+                raise Exception(f"接口 {api_name} 请求失败：HTTP {res.status}")
+            result = json.loads(await res.text())
+        if result['code'] != 0:
+            raise Exception(result['msg'])
+        data = result['data']
+        return pd.DataFrame(data['items'], columns=data['fields'])
+
+
+async def fetch_stock_data_async(args_list, max_in_flight, limiter=None, max_attempts=4, url=None, sink=None, cache=None):
+    """
+    在单个进程内用 asyncio 并发按股票拉取历史数据，输入输出与 Pull_merga_stock.fetch_stock_data_parallel 一致。
+
+    :param args_list: 参数元组列表，每个元组为 (code, start_date, end_date, token)
+    :param max_in_flight: 最多同时在途的请求数，同时作为连接池大小
+    :param limiter: 限流器，默认新建一个并发上限为 max_in_flight 的 RateLimiter
+    :param max_attempts: 每只股票的最多尝试次数，失败后按指数退避重试，重试期间不占用并发名额
+    :param url: 接口地址，默认为 TUSHARE_API_URL
+    :param sink: 流式写入器，提供时每只股票的数据到达后立即写入，不在内存中保留
+    :param cache: 接口缓存，命中时不发送请求
+    :return: (成功拉取的 DataFrame 列表, 成功数量, 最终失败的股票 {code: 失败信息})
+    """
+    total_stocks = len(args_list)
+    completed = 0
+    successful = 0
+    empty = 0
+    all_data = []
+    failures = {}
+    if not args_list:
+        return all_data, successful, failures
+
+    limiter = limiter or RateLimiter(max_concurrency=max_in_flight, initial_concurrency=max(1, max_in_flight // 4))
+    semaphore = asyncio.Semaphore(max_in_flight)
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        client = AsyncTushareClient(args_list[0][3], session, url)
+
+        async def fetch_one(args):
+            code, start_date, end_date, _ = args
+            error = None
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    params = dict(ts_code=code, start_date=start_date, end_date=end_date)
+                    data = cache.get('daily', params) if cache is not None else None
+                    if data is None:
+                        async with semaphore:
+                            data = await limiter.call_async(client.query, 'daily', api_name='daily', **params)
+                        if cache is not None:
+                            cache.put('daily', params, data)
+                    if data is not None and not data.empty:
+                        data['ts_code'] = code
+                        return args, attempt, data
+                    return args, attempt, None
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+                    if attempt < max_attempts:
+                        limiter.metrics.add_retry('daily')
+                        await asyncio.sleep(retry_delay(attempt))
+            return args, max_attempts, error
+
+        start_time = time.time()
+        tasks = [asyncio.ensure_future(fetch_one(args)) for args in args_list]
+        for future in asyncio.as_completed(tasks):
+            args, attempt, data = await future
+            code = args[0]
+            if isinstance(data, pd.DataFrame):
+                if sink is not None:
+                    sink.write(data, [code])
+                else:
+                    all_data.append(data)
+                successful += 1
+            elif data is None:
+                if sink is not None:
+                    sink.write(None, [code])
+                empty += 1
+            else:
+                failures[code] = {'ts_code': code, 'start_date': args[1], 'end_date': args[2],
+                                  'attempts': attempt, 'error': data}
+            completed += 1
+
+            percent_complete = (completed / total_stocks) * 100
+            elapsed_time = time.time() - start_time
+            sys.stdout.write(f"\r拉取进度：{completed}/{total_stocks} ({percent_complete:.1f}%)，成功：{successful}，无数据：{empty}，"
+                             f"失败：{len(failures)}，当前拉取：{code}，已耗时：{elapsed_time:.2f} 秒")
+            sys.stdout.flush()
+        print()
+
+    stats = limiter.stats()
+    print(f"限流统计：当前并发 {stats['concurrency']}，累计限流等待 {stats['throttle_wait']:.1f} 秒，频率超限 {stats['quota_errors']} 次")
+    if cache is not None:
+        print(cache.summary())
+    return all_data, successful, failures
@@ -0,0 +1,394 @@
+import io
+import os
+import re
+import json
+import time
+import shutil
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import psycopg2
+import schema
+from storage import get_storage, latest_dataset
+from run_manifest import RunManifest, dataset_run_date
+
+# 读取端的K线存储目录
+BAR_STORE_DIR = os.getenv('BAR_STORE_DIR', './data/bar_store')
+
+# 增量段数超过该值时自动合并为新的基础段
+BAR_STORE_MAX_DELTAS = int(os.getenv('BAR_STORE_MAX_DELTAS', '20'))
+
+# 每个周期按字段保存的数组及其类型，trade_date 以 datetime64[D] 保存
+FIELDS = {
+    'trade_date': 'datetime64[D]',
+    'open': 'float32',
+    'high': 'float32',
+    'low': 'float32',
+    'close': 'float32',
+    'pre_close': 'float32',
+    'change': 'float32',
+    'pct_chg': 'float64',
+    'vol': 'float64',
+    'amount': 'float64',
+}
+
+BASE_SEGMENT = 'base'
+DELTA_PATTERN = re.compile(r'^delta-(\d{6})$')
+
+
+def write_segment(path, data, cycles=None):
+    """
+    把 data 按周期写成一个段：每个周期一个目录，每个字段一个 .npy 数组，按 ts_code、trade_date 排序，
+    codes.npy 与 offsets.npy 记录每只股票在数组中的起止位置（第 i 只股票为 offsets[i]:offsets[i + 1]）。
+
+    :param data: 含 cycle 列的K线数据，类型见 schema.DTYPES
+    :param cycles: 需要写入的周期，默认为 data 中出现的全部周期
+    :return: 写入的行数
+    """
+    data = schema.apply_schema(data)
+    rows = 0
+    for cycle in cycles or schema.CYCLES:
+        bars = data[data['cycle'] == cycle]
+        if bars.empty:
+            continue
+        write_cycle(os.path.join(path, cycle), bars)
+        rows += len(bars)
+    return rows
+
+
+def write_cycle(path, bars):
+    """写入一个周期的字段数组和偏移索引，同一只股票同一交易日出现多次时保留最后一行。"""
+    bars = schema.sort_rows(bars, ['ts_code', 'trade_date'])
+    bars = bars[~bars.duplicated(['ts_code', 'trade_date'], keep='last')]
+    codes = bars['ts_code'].cat
+    counts = np.bincount(codes.codes.to_numpy(), minlength=len(codes.categories))
+    present = counts > 0
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'codes.npy'), codes.categories.to_numpy(dtype=str)[present])
+    np.save(os.path.join(path, 'offsets.npy'), np.concatenate([[0], np.cumsum(counts[present])]).astype('int64'))
+    for field, dtype in FIELDS.items():
+        np.save(os.path.join(path, f'{field}.npy'), bars[field].to_numpy().astype(dtype))
+
+
+class Segment:
+    """一个段中某个周期的只读视图，字段数组以内存映射方式打开。"""
+
+    def __init__(self, path):
+        self.path = path
+        codes = np.load(os.path.join(path, 'codes.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.index = {code: i for i, code in enumerate(codes.tolist())}
+        self.arrays = {field: np.load(os.path.join(path, f'{field}.npy'), mmap_mode='r') for field in FIELDS}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def codes(self):
+        return list(self.index)
+
+    def rows(self, ts_code):
+        """股票在数组中的 [起始, 结束) 位置，没有该股票时返回 None。"""
+        i = self.index.get(ts_code)
+        if i is None:
+            return None
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+
+class BarStore:
+    """
+    读取端的K线存储：每个周期每个字段一个连续的 NumPy 数组，按 ts_code、trade_date 排序并以内存映射方式打开，
+    按 ts_code 的偏移索引定位每只股票的行，load 返回的是数组切片，不复制数据。
+
+    全量构建写入基础段 base，之后每次生成的新增和更新的K线写入增量段 delta-NNNNNN；
+    读取时增量段中的K线覆盖基础段中同一交易日及之后的K线，compact 把所有增量段合并回基础段。
+    """
+
+    def __init__(self, store_dir=None):
+        """
+        :param store_dir: 存储目录，默认读取环境变量 BAR_STORE_DIR（./data/bar_store）
+        """
+        self.store_dir = store_dir or BAR_STORE_DIR
+        self._segments = {}
+        self._deltas = None
+
+    def exists(self):
+        return os.path.isdir(os.path.join(self.store_dir, BASE_SEGMENT))
+
+    def deltas(self):
+        """按写入顺序返回增量段名称，目录只在首次调用和段变化后读取。"""
+        if self._deltas is None:
+            names = os.listdir(self.store_dir) if os.path.isdir(self.store_dir) else []
+            self._deltas = sorted(name for name in names if DELTA_PATTERN.match(name))
+        return self._deltas
+
+    def segment(self, name, cycle):
+        """返回段中某个周期的 Segment，该周期没有数据时返回 None。"""
+        key = (name, cycle)
+        if key not in self._segments:
+            path = os.path.join(self.store_dir, name, cycle)
+            self._segments[key] = Segment(path) if os.path.isfile(os.path.join(path, 'offsets.npy')) else None
+        return self._segments[key]
+
+    def codes(self, cycle='daily'):
+        """存储中该周期的全部股票代码。"""
+        codes = set()
+        for name in [BASE_SEGMENT] + self.deltas():
+            segment = self.segment(name, cycle)
+            if segment is not None:
+                codes.update(segment.index)
+        return sorted(codes)
+
+    def load(self, ts_code, cycle='daily', start=None, end=None, fields=None):
+        """
+        读取一只股票的K线。没有增量段涉及该股票时返回基础段数组的切片，不复制数据；
+        否则按增量段覆盖后拼接为新数组。
+
+        :param ts_code: 股票代码
+        :param cycle: 周期标签
+        :param start: 起始日期（含），YYYYMMDD、YYYY-MM-DD 或 datetime，默认不限
+        :param end: 结束日期（含），默认不限
+        :param fields: 需要的字段，默认全部
+        :return: {字段: 数组}，trade_date 为 datetime64[D]；没有该股票时各数组为空
+        """
+        fields = list(fields or FIELDS)
+        if 'trade_date' not in fields:
+            fields = ['trade_date'] + fields
+        bars = None
+        for name in [BASE_SEGMENT] + self.deltas():
+            segment = self.segment(name, cycle)
+            rows = segment.rows(ts_code) if segment is not None else None
+            if rows is None:
+                continue
+            part = {field: segment.arrays[field][rows[0]:rows[1]] for field in fields}
+            if bars is None:
+                bars = part
+            else:
+                # 增量段只包含新增和更新的K线，覆盖此前各段中同一交易日及之后的K线
+                keep = np.searchsorted(bars['trade_date'], part['trade_date'][0])
+                bars = {field: np.concatenate([bars[field][:keep], part[field]]) for field in fields}
+        if bars is None:
+            return {field: np.empty(0, dtype=FIELDS[field]) for field in fields}
+
+        # trade_date 有序，按日期二分查找区间
+        dates = bars['trade_date']
+        lo = 0 if start is None else np.searchsorted(dates, to_day(start), side='left')
+        hi = len(dates) if end is None else np.searchsorted(dates, to_day(end), side='right')
+        return {field: values[lo:hi] for field, values in bars.items()}
+
+    def load_frame(self, ts_code, cycle='daily', start=None, end=None, fields=None):
+        """同 load，返回 DataFrame（会复制数据）。"""
+        bars = self.load(ts_code, cycle, start, end, fields)
+        df = pd.DataFrame(bars)
+        df['trade_date'] = df['trade_date'].astype('datetime64[ns]')
+        df.insert(0, 'ts_code', ts_code)
+        return df
+
+    def read_cycle(self, cycle):
+        """
+        按段的写入顺序合并出一个周期的全部K线：每个增量段中每只股票的第一根K线及之后的日期覆盖此前各段，
+        按股票代码整体向量化比较，不逐只股票读取。
+
+        :return: DataFrame，ts_code 为字符串，trade_date 为 datetime64
+        """
+        bars = None
+        for name in [BASE_SEGMENT] + self.deltas():
+            segment = self.segment(name, cycle)
+            if segment is None:
+                continue
+            frame = pd.DataFrame({field: np.asarray(values) for field, values in segment.arrays.items()})
+            frame.insert(0, 'ts_code', np.repeat(segment.codes(), np.diff(segment.offsets)))
+            if bars is not None:
+                first = frame.drop_duplicates('ts_code').set_index('ts_code')['trade_date']
+                cutoff = first.reindex(bars['ts_code']).to_numpy()
+                bars = pd.concat([bars[~(bars['trade_date'].to_numpy() >= cutoff)], frame], ignore_index=True)
+                bars = bars.sort_values(['ts_code', 'trade_date'], ignore_index=True, kind='stable')
+            else:
+                bars = frame
+        if bars is None:
+            return pd.DataFrame(columns=['ts_code'] + list(FIELDS))
+        bars['trade_date'] = bars['trade_date'].astype('datetime64[ns]')
+        return bars
+
+    def close(self):
+        """释放已打开的内存映射，重建或合并段之前调用。"""
+        self._segments.clear()
+        self._deltas = None
+
+    def _replace(self, write):
+        """在临时目录中写入新的存储，完成后替换原目录。"""
+        tmp_dir = self.store_dir + '.tmp'
+        old_dir = self.store_dir + '.old'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        write(tmp_dir)
+        self.close()
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.isdir(self.store_dir):
+            os.rename(self.store_dir, old_dir)
+        os.rename(tmp_dir, self.store_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def build(self, read_cycle):
+        """
+        全量重建基础段，删除所有增量段。
+
+        :param read_cycle: read_cycle(cycle) 返回该周期全部K线的函数，按周期逐个读取以控制内存
+        :return: 写入的行数
+        """
+        rows = 0
+
+        def write(path):
+            nonlocal rows
+            for cycle in schema.CYCLES:
+                bars = read_cycle(cycle)
+                if bars is not None and not bars.empty:
+                    write_cycle(os.path.join(path, BASE_SEGMENT, cycle), schema.apply_schema(bars))
+                    rows += len(bars)
+            os.makedirs(os.path.join(path, BASE_SEGMENT), exist_ok=True)
+            write_meta(path, rows=rows)
+
+        self._replace(write)
+        return rows
+
+    def append(self, data):
+        """
+        把新增和更新的K线写入一个新的增量段，增量段数超过 BAR_STORE_MAX_DELTAS 时自动合并。
+
+        :param data: 含 cycle 列的K线数据
+        :return: 写入的行数
+        """
+        deltas = self.deltas()
+        seq = int(DELTA_PATTERN.match(deltas[-1]).group(1)) + 1 if deltas else 1
+        name = f'delta-{seq:06d}'
+        tmp_path = os.path.join(self.store_dir, name + '.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        rows = write_segment(tmp_path, data)
+        os.rename(tmp_path, os.path.join(self.store_dir, name))
+        self._deltas = None
+        if len(deltas) + 1 > BAR_STORE_MAX_DELTAS:
+            self.compact()
+        return rows
+
+    def compact(self):
+        """把所有增量段合并进基础段，合并后 load 重新返回不复制的切片。"""
+        deltas = self.deltas()
+        if not deltas:
+            return 0
+        rows = 0
+
+        def write(path):
+            nonlocal rows
+            for cycle in schema.CYCLES:
+                bars = self.read_cycle(cycle)
+                if bars.empty:
+                    continue
+                write_cycle(os.path.join(path, BASE_SEGMENT, cycle), schema.apply_schema(bars))
+                rows += len(bars)
+            os.makedirs(os.path.join(path, BASE_SEGMENT), exist_ok=True)
+            write_meta(path, rows=rows, compacted=len(deltas))
+
+        self._replace(write)
+        return rows
+
+
+def to_day(date):
+    """把 YYYYMMDD、YYYY-MM-DD 字符串或 datetime 转换为 datetime64[D]。"""
+    if isinstance(date, str) and len(date) == 8 and date.isdigit():
+        date = f'{date[:4]}-{date[4:6]}-{date[6:]}'
+    return np.datetime64(pd.Timestamp(date).date(), 'D')
+
+
+def write_meta(path, **info):
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'updated_at': datetime.now().isoformat(timespec='seconds'), **info}, f, ensure_ascii=False)
+
+
+def read_db_cycle(cycle, table='stock_data'):
+    """从数据库读取一个周期的全部K线，用于从 stock_data 重建存储。"""
+    from Upload_database import create_database_connection
+    buffer = io.StringIO()
+    conn = create_database_connection(max_attempts=1)
+    try:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(f"""
+                COPY (SELECT ts_code, trade_date, open, high, low, close, pre_close, change, pct_chg, vol, amount, cycle
+                      FROM {table} WHERE cycle = '{cycle}') TO STDOUT WITH CSV HEADER
+            """, buffer)
+    finally:
+        conn.close()
+    buffer.seek(0)
+    return schema.apply_schema(pd.read_csv(buffer, dtype={'ts_code': str}, float_precision='round_trip'))
+
+
+def update_bar_store(data=None, full=False, store_dir=None):
+    """
+    用最新的数据集更新K线存储：full 或存储不存在且数据集为全量生成时从数据集全量构建，否则把数据集
+    （或生成阶段在内存中的结果）作为增量段追加。存储不存在而数据集只包含增量生成的K线时，先从 stock_data 表构建基础段，
+    数据库不可用时不更新，也不记为完成。
+
+    :param data: 生成阶段在内存中的日线与各周期数据（DataFrame 列表），为 None 时从存储读取数据集
+    :param full: 从数据集全量重建
+    :return: 写入的行数
+    """
+    storage = get_storage()
+    name = latest_dataset('merged_stocks_data_', storage)
+    if name is None:
+        print("没有找到符合条件的文件")
+        return 0
+    # 同一数据集只追加一次增量段
+    manifest = RunManifest(dataset_run_date(name))
+    if manifest.is_done('bar_store'):
+        print("K线存储已更新，跳过操作。")
+        return 0
+    store = BarStore(store_dir)
+    start_time = time.time()
+    # 生成阶段记录了数据集是否只包含增量生成的K线，没有记录时按增量处理
+    incremental = manifest.data['stages'].get('generate', {}).get('incremental', True)
+    if full or not store.exists() and not incremental:
+        rows = store.build(lambda cycle: storage.read(name, cycles=[cycle]))
+        print(f"K线存储已重建：{rows} 条，耗时: {time.time() - start_time:.2f} 秒")
+    else:
+        if not store.exists():
+            # 数据集只有最近的K线，基础段取数据库中的完整历史；上传阶段可能同时在写入，数据集随后作为增量段覆盖
+            try:
+                base_rows = store.build(read_db_cycle)
+            except psycopg2.Error as e:
+                print(f"K线存储不存在，数据集只包含增量K线，从数据库构建基础段失败：{e}")
+                print("上传完成后可执行 python src/bar_store.py --rebuild --source db")
+                return 0
+            print(f"K线存储基础段已从数据库构建：{base_rows} 条")
+        # 浅复制后再拼接，不修改上传阶段同时使用的数据框
+        data = schema.concat([frame.copy(deep=False) for frame in data]) if data is not None else storage.read(name)
+        rows = store.append(data)
+        print(f"K线存储已追加增量段：{rows} 条，共 {len(store.deltas())} 个增量段，耗时: {time.time() - start_time:.2f} 秒")
+    manifest.mark_done('bar_store', rows=int(rows))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='构建或更新内存映射的K线存储')
+    parser.add_argument('--rebuild', action='store_true', help='全量重建')
+    parser.add_argument('--source', choices=['dataset', 'db'], default='dataset',
+                        help='全量重建的数据来源：最新的数据集或 stock_data 表')
+    parser.add_argument('--compact', action='store_true', help='把增量段合并进基础段')
+    args = parser.parse_args()
+
+    store = BarStore()
+    if args.compact:
+        start_time = time.time()
+        rows = store.compact()
+        print(f"合并完成：{rows} 条，耗时: {time.time() - start_time:.2f} 秒")
+    elif args.rebuild and args.source == 'db':
+        start_time = time.time()
+        try:
+            rows = store.build(read_db_cycle)
+        except psycopg2.Error as e:
+            print(f"从数据库读取K线失败：{e}")
+            return
+        print(f"K线存储已从数据库重建：{rows} 条，耗时: {time.time() - start_time:.2f} 秒")
+    else:
+        update_bar_store(full=args.rebuild)
+
+
+if __name__ == "__main__":
+    main()
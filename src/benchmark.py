@@ -0,0 +1,336 @@
+import os
+import io
+import sys
+import json
+import time
+import logging
+import shutil
+import platform
+import resource
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime
+from dotenv import load_dotenv
+
+# 自动加载项目根目录下的 .env 文件，需在导入各阶段模块之前加载
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+# 拉取阶段使用本地合成接口，不需要真实的 Token
+os.environ.setdefault('TUSHARE_TOKEN', 'benchmark')
+
+import numpy as np
+import pyarrow as pa
+import Pull_merga_stock
+import Upload_database
+import db_pool
+import db_schema
+import schema
+from Clear_data import clean_base_data
+from Generating_periodic_data import generate_periodic_data
+from api_cache import ApiCache
+from pipeline import RssSampler
+from rate_limiter import RateLimiter
+from storage import get_storage
+from synthetic_data import make_daily, make_base_frames
+
+# 基准测试结果按行追加保存，便于与历史结果对比
+RESULTS_FILE = os.path.abspath(os.getenv('BENCHMARK_RESULTS', './data/benchmarks/results.jsonl'))
+
+# 上传阶段使用的数据表，测试结束后删除，不影响 stock_data
+BENCHMARK_TABLE = 'stock_data_bench'
+
+STAGES = ['clean', 'fetch', 'serialize_read', 'serialize_write', 'generate', 'db_load', 'db_upsert']
+
+
+class SyntheticPro:
+    """
+    按 pro.daily 的参数从合成日线中切片返回的本地接口，用于测量拉取进程池、限流器和流式写入的开销。
+
+    合成日线按股票排序后写成未压缩的 Arrow IPC 文件，通过进程池 initializer 传给拉取进程时只序列化文件路径和
+    每只股票的行范围，子进程以内存映射方式读取，不依赖 fork 继承主进程的数据。
+    """
+
+    def __init__(self, daily, path):
+        daily = daily.sort_values('ts_code', kind='stable', ignore_index=True)
+        arrow_table = pa.Table.from_pandas(daily, preserve_index=False)
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+        codes = daily['ts_code'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        ends = np.r_[starts[1:], len(codes)]
+        self.path = path
+        self.ranges = {code: (int(start), int(end)) for code, start, end in zip(codes[starts], starts, ends)}
+        self.table = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'ranges': self.ranges, 'table': None}
+
+    def daily(self, ts_code='', start_date='', end_date='', **kwargs):
+        rows = self.ranges.get(ts_code)
+        if rows is None:
+            return None
+        if self.table is None:
+            self.table = pa.ipc.open_file(pa.memory_map(self.path)).read_all()
+        frame = self.table.slice(rows[0], rows[1] - rows[0]).to_pandas()
+        dates = frame['trade_date']
+        return frame[(dates >= start_date) & (dates <= end_date)].reset_index(drop=True)
+
+
+def cpu_seconds():
+    """当前进程与已回收子进程的 CPU 时间之和（秒）。"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+@contextlib.contextmanager
+def silence_output():
+    """屏蔽本进程及期间启动的子进程的标准输出；spawn 启动的子进程不继承 sys.stdout 的重定向，需在文件描述符上屏蔽。"""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, 'w') as devnull:
+        os.dup2(devnull.fileno(), 1)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def git_commit():
+    """当前代码的 git 提交号，不在 git 仓库中时返回 None。"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkRun:
+    """记录每个阶段的耗时、CPU 时间、处理行数和内存峰值。"""
+
+    def __init__(self, sampler, verbose=False):
+        self.sampler = sampler
+        self.verbose = verbose
+        self.stages = {}
+
+    def measure(self, name, func, rows):
+        """
+        运行 func 并记录指标，各阶段的输出默认不打印。
+
+        :param rows: 处理的行数，或以 func 返回值为参数计算行数的函数
+        :return: func 的返回值
+        """
+        start_rss = self.sampler.start_stage(name)
+        start_cpu = cpu_seconds()
+        start = time.perf_counter()
+        output = contextlib.nullcontext() if self.verbose else silence_output()
+        with output:
+            result = func()
+        wall = time.perf_counter() - start
+        cpu = cpu_seconds() - start_cpu
+        peak_rss = self.sampler.end_stage(name)
+        rows = rows(result) if callable(rows) else rows
+        self.stages[name] = {
+            'rows': int(rows),
+            'wall': round(wall, 4),
+            'cpu': round(cpu, 4),
+            'rows_per_sec': round(rows / wall, 1) if wall > 0 else None,
+            'peak_rss_mb': round(peak_rss / 2**20, 1),
+            'rss_delta_mb': round((peak_rss - start_rss) / 2**20, 1),
+            # 子进程的内存峰值无法按阶段重置，记录的是截至本阶段结束时所有子进程中的最大值
+            'children_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        }
+        print(f"{name:<18}{rows:>12}{wall:>10.2f}{cpu:>10.2f}{self.stages[name]['rows_per_sec'] or 0:>14,.0f}"
+              f"{self.stages[name]['peak_rss_mb']:>12.1f}")
+        return result
+
+
+def run_benchmark(stocks, years, seed=0, stages=None, workers=4, generate_workers=1, batch_size=100000,
+                  db_params=None, verbose=False, keep_dir=None):
+    """
+    在临时目录中用合成数据依次运行各阶段并计时。
+
+    :param stocks: 股票数量
+    :param years: 历史年数
+    :param stages: 需要运行的阶段，默认 STAGES 全部；后面的阶段依赖前面阶段的输出，未选中的前置阶段仍会运行但不计入结果
+    :param workers: 拉取和上传阶段的进程数
+    :param generate_workers: 周期数据生成的分片进程数
+    :param batch_size: 上传阶段的每批行数
+    :param db_params: 数据库连接参数，默认读取 db_pool.db_params()；连接失败时跳过数据库阶段
+    :param keep_dir: 保留工作目录的位置，默认运行结束后删除
+    :return: 结果记录 dict
+    """
+    stages = stages or STAGES
+    end_date = datetime.now().strftime('%Y%m%d')
+    print(f"生成合成数据：{stocks} 只股票 × {years} 年")
+    daily = make_daily(stocks, years, end_date=end_date, seed=seed)
+    base_frames = make_base_frames(daily, seed=seed)
+    print(f"合成日线 {len(daily)} 行")
+
+    work_dir = keep_dir or tempfile.mkdtemp(prefix='stockdata_bench_')
+    os.makedirs(os.path.join(work_dir, 'data'), exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        print(f"{'阶段':<16}{'行数':>10}{'耗时(秒)':>8}{'CPU(秒)':>8}{'行/秒':>12}{'内存峰值(MB)':>8}")
+        with RssSampler(0.02) as sampler:
+            run = BenchmarkRun(sampler, verbose)
+
+            def stage(name, func, rows):
+                if name in stages:
+                    return run.measure(name, func, rows)
+                with silence_output():
+                    return func()
+
+            # 清洗阶段处理的是每只股票一行的基础数据，行数为股票数
+            stage('clean', lambda: clean_base_data({name: frame.copy() for name, frame in base_frames.items()}),
+                  len(base_frames['备用列表.csv']))
+
+            # 拉取阶段：进程池从本地合成接口按股票拉取并流式写入数据集，限流器不设上限，接口缓存关闭
+            Pull_merga_stock.api = SyntheticPro(daily, os.path.join(work_dir, 'synthetic_daily.arrow'))
+            Pull_merga_stock.limiter = RateLimiter(calls_per_minute=10**9, max_concurrency=workers, initial_concurrency=workers)
+            Pull_merga_stock.cache = ApiCache(enabled=False)
+            codes = daily['ts_code'].unique()
+            start_date = daily['trade_date'].min()
+            stage('fetch', lambda: Pull_merga_stock.fetch_and_save_stock_data_parallel(
+                codes, start_date, end_date, 'benchmark', './data', workers, engine='process'), len(daily))
+
+            storage = get_storage()
+            name = f'merged_stocks_data_{end_date}'
+            copy_name = f'benchmark_copy_{end_date}'
+            data = stage('serialize_read', lambda: storage.read(name), len)
+            stage('serialize_write', lambda: storage.write(data, copy_name), len(data))
+            storage.delete(copy_name)
+            data = None
+
+            stage('generate', lambda: generate_periodic_data(full=True, workers=generate_workers), len(daily))
+
+            if {'db_load', 'db_upsert'} & set(stages):
+                run_db_stages(run, storage, name, workers, batch_size, db_params, stages)
+
+        return {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'host': platform.node(),
+            'cpus': os.cpu_count(),
+            'python': platform.python_version(),
+            'params': {'stocks': stocks, 'years': years, 'seed': seed, 'workers': workers,
+                       'generate_workers': generate_workers, 'batch_size': batch_size},
+            'stages': run.stages,
+        }
+    finally:
+        Pull_merga_stock.api = None
+        os.chdir(cwd)
+        if keep_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_db_stages(run, storage, name, workers, batch_size, db_params, stages):
+    """
+    在 BENCHMARK_TABLE 上测量数据库写入：db_load 为空表上按分区通过暂存表整体装载，
+    db_upsert 为对已存在的全部行按批次 upsert（内容未变化，主要测量冲突检测与比较的开销）。
+    """
+    db_params = db_params or db_pool.db_params()
+    try:
+        conn = db_pool.connect(db_params, max_attempts=1)
+    except Exception as e:
+        print(f"无法连接数据库，跳过数据库阶段：{e}")
+        return
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE}, {BENCHMARK_TABLE}_watermark CASCADE;")
+            db_schema.create_partitioned_table(cursor, BENCHMARK_TABLE)
+            db_schema.create_watermark_table(cursor, BENCHMARK_TABLE)
+        data = schema.sort_rows(storage.read(name, columns=Upload_database.COLUMNS), ['cycle', 'ts_code', 'trade_date'])
+
+        def load():
+            staged, _, partitions = Upload_database.split_partitions(data, set())
+            return Upload_database.load_partitions(staged, partitions, batch_size, workers, db_params, table=BENCHMARK_TABLE)
+
+        def upsert():
+            num_batches = (len(data) + batch_size - 1) // batch_size
+            return Upload_database.upload_batches(data, range(num_batches), batch_size, workers, db_params, table=BENCHMARK_TABLE)
+
+        if 'db_load' in stages:
+            run.measure('db_load', load, lambda result: result[0])
+        else:
+            with silence_output():
+                load()
+        if 'db_upsert' in stages:
+            run.measure('db_upsert', upsert, lambda result: result[0])
+    finally:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE}, {BENCHMARK_TABLE}_watermark CASCADE;")
+        conn.close()
+
+
+def load_results(results_file=RESULTS_FILE):
+    if not os.path.isfile(results_file):
+        return []
+    with open(results_file, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_result(result, results_file=RESULTS_FILE):
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+def compare(result, previous):
+    """与参数相同的上一次结果对比每个阶段的每秒行数和内存峰值。"""
+    label = f"，{previous['label']}" if previous.get('label') else ''
+    print(f"\n与 {previous['timestamp']}（{previous.get('commit') or '未知提交'}{label}）的结果对比：")
+    print(f"{'阶段':<16}{'行/秒':>14}{'变化':>10}{'内存峰值(MB)':>10}{'变化':>10}")
+    for name, stat in result['stages'].items():
+        old = previous['stages'].get(name)
+        if old is None or not old.get('rows_per_sec') or not stat.get('rows_per_sec'):
+            continue
+        speed = (stat['rows_per_sec'] / old['rows_per_sec'] - 1) * 100
+        memory = (stat['peak_rss_mb'] / old['peak_rss_mb'] - 1) * 100 if old['peak_rss_mb'] else 0.0
+        print(f"{name:<18}{stat['rows_per_sec']:>14,.0f}{speed:>+9.1f}%{stat['peak_rss_mb']:>14.1f}{memory:>+9.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='用合成数据测量各阶段的耗时、每秒处理行数和内存峰值')
+    parser.add_argument('--stocks', type=int, default=500, help='合成的股票数量')
+    parser.add_argument('--years', type=int, default=5, help='合成的历史年数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"逗号分隔的阶段，可选 {','.join(STAGES)}")
+    parser.add_argument('--workers', type=int, default=4, help='拉取和上传阶段的进程数')
+    parser.add_argument('--generate-workers', type=int, default=1, help='周期数据生成的分片进程数')
+    parser.add_argument('--batch-size', type=int, default=100000, help='上传阶段的每批行数')
+    parser.add_argument('--verbose', action='store_true', help='打印各阶段自身的输出')
+    parser.add_argument('--keep-dir', default=None, help='在指定目录中运行并保留中间文件')
+    parser.add_argument('--output', default=RESULTS_FILE, help='追加保存结果的文件')
+    parser.add_argument('--label', default=None, help='本次结果的备注，如修改内容或机器说明')
+    parser.add_argument('--no-save', action='store_true', help='不保存本次结果')
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(',') if stage]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"未知的阶段：{sorted(unknown)}")
+
+    if not args.verbose:
+        # 上传阶段逐个分区打印的日志会打断结果表格
+        logging.disable(logging.INFO)
+    result = run_benchmark(args.stocks, args.years, args.seed, stages, args.workers, args.generate_workers,
+                           args.batch_size, verbose=args.verbose, keep_dir=args.keep_dir)
+    result['label'] = args.label
+    output = os.path.abspath(args.output)
+    previous = [old for old in load_results(output) if old['params'] == result['params']]
+    if previous:
+        compare(result, previous[-1])
+    if not args.no_save:
+        save_result(result, output)
+        print(f"\n结果已追加到 {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import os
+import time
+import random
+import logging
+import psycopg2
+from multiprocessing.util import Finalize
+
+logger = logging.getLogger(__name__)
+
+
+def db_params():
+    """
+    从环境变量读取数据库连接参数，变量名与 libpq 一致（PGHOST、PGPORT、PGUSER、PGPASSWORD、PGDATABASE），
+    PG_STATEMENT_TIMEOUT 为单条语句的超时时间（毫秒）。
+    """
+    params = dict(
+        host=os.getenv('PGHOST', 'localhost'),
+        port=int(os.getenv('PGPORT', '5432')),
+        user=os.getenv('PGUSER', 'postgres'),
+        dbname=os.getenv('PGDATABASE', 'stocks'),
+        connect_timeout=int(os.getenv('PG_CONNECT_TIMEOUT', '10')),
+        options=f"-c statement_timeout={os.getenv('PG_STATEMENT_TIMEOUT', '300000')}"
+    )
+    if os.getenv('PGPASSWORD'):
+        params['password'] = os.getenv('PGPASSWORD')
+    return params
+
+
+def connect(params=None, max_attempts=5, base_delay=5):
+    """创建数据库连接，数据库被其他用户占用时按指数退避重试
+
+    Args:
+        params: 连接参数，默认读取 db_params()
+        max_attempts: 最大重试次数
+        base_delay: 基础等待时间（秒）
+
+    Returns:
+        psycopg2连接对象
+
+    Raises:
+        Exception: 如果超过最大重试次数仍无法连接
+    """
+    params = params or db_params()
+    attempt = 0
+    last_exception = None
+
+    while attempt < max_attempts:
+        try:
+            conn = psycopg2.connect(**params)
+            if attempt > 0:
+                logger.info(f"成功连接到数据库，尝试次数：{attempt+1}")
+            return conn
+        except psycopg2.OperationalError as e:
+            attempt += 1
+            last_exception = e
+
+            # 检查是否是数据库被占用的错误
+            if "is being accessed by other users" in str(e):
+                # 使用指数退避和随机抖动
+                delay = base_delay * (2 ** (attempt - 1)) + random.uniform(0, 3)
+                logger.warning(f"数据库被其他用户占用，{delay:.2f}秒后重试 ({attempt}/{max_attempts})：{e}")
+                time.sleep(delay)
+            else:
+                # 其他连接错误，直接抛出
+                raise e
+
+    # 超出最大重试次数
+    logger.error(f"无法连接到数据库，已达到最大重试次数：{max_attempts}")
+    raise last_exception
+
+
+# 工作进程内的持久连接，由 init_worker 在进程池启动时设置，整个运行期间复用
+_worker_params = None
+_worker_setup = None
+_worker_conn = None
+
+
+def init_worker(params=None, setup=None):
+    """
+    进程池的 initializer：记录连接参数，工作进程第一次取连接时建立，之后所有任务复用同一个连接。
+
+    :param params: 连接参数，默认读取 db_params()
+    :param setup: setup(conn)，每个新连接建立后调用一次，用于创建会话级的临时表等
+    """
+    global _worker_params, _worker_setup, _worker_conn
+    _worker_params = params or db_params()
+    _worker_setup = setup
+    _worker_conn = None
+    # 工作进程正常退出时关闭连接
+    Finalize(None, close_worker, exitpriority=10)
+
+
+def worker_connection():
+    """返回当前工作进程的持久连接，连接已断开时重新建立。"""
+    global _worker_conn
+    if _worker_conn is None or _worker_conn.closed:
+        _worker_conn = connect(_worker_params)
+        if _worker_setup is not None:
+            with _worker_conn:
+                _worker_setup(_worker_conn)
+    return _worker_conn
+
+
+def close_worker():
+    global _worker_conn
+    if _worker_conn is not None and not _worker_conn.closed:
+        _worker_conn.close()
+    _worker_conn = None
@@ -0,0 +1,212 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# stock_data 按 cycle 列表分区，日线分区再按 trade_date 年份范围分区
+CYCLES = ['daily', 'weekly', 'monthly', 'quarterly', 'yearly']
+
+COLUMNS_SQL = """
+    ts_code VARCHAR(10) NOT NULL,
+    trade_date DATE NOT NULL,
+    cycle VARCHAR(10) NOT NULL,
+    open FLOAT,
+    high FLOAT,
+    low FLOAT,
+    close FLOAT,
+    pre_close FLOAT,
+    change FLOAT,
+    pct_chg FLOAT,
+    vol FLOAT,
+    amount FLOAT
+"""
+
+
+def table_kind(cursor, table):
+    """返回表类型：'r' 普通表，'p' 分区表，不存在时返回 None。"""
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def partition_name(table, cycle, year=None):
+    """日线按年份的分区名为 {table}_daily_{year}，其他周期为 {table}_{cycle}。"""
+    return f"{table}_{cycle}_{year}" if year is not None else f"{table}_{cycle}"
+
+
+def partition_parent(table, cycle):
+    """分区所属的父表：日线年份分区挂在 {table}_daily 下，其他周期直接挂在 {table} 下。"""
+    return f"{table}_daily" if cycle == 'daily' else table
+
+
+def partition_bounds(cycle, year=None):
+    """ATTACH / CREATE PARTITION 使用的分区范围。"""
+    if cycle == 'daily':
+        return f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+    return f"FOR VALUES IN ('{cycle}')"
+
+
+def partition_check(cycle, year=None):
+    """与分区范围一致的 CHECK 约束，ATTACH 前加在暂存表上可以省去校验扫描。"""
+    if cycle == 'daily':
+        return f"cycle = 'daily' AND trade_date >= DATE '{year}-01-01' AND trade_date < DATE '{year + 1}-01-01'"
+    return f"cycle = '{cycle}'"
+
+
+def create_partitioned_table(cursor, table='stock_data'):
+    """创建按周期分区的数据表，日线子分区按年份在装载时创建。"""
+    cursor.execute(f"""
+        CREATE TABLE {table} ({COLUMNS_SQL},
+            PRIMARY KEY (ts_code, trade_date, cycle)
+        ) PARTITION BY LIST (cycle);
+    """)
+    cursor.execute(f"""
+        CREATE TABLE {partition_name(table, 'daily')} PARTITION OF {table}
+            FOR VALUES IN ('daily') PARTITION BY RANGE (trade_date);
+    """)
+    for cycle in CYCLES[1:]:
+        cursor.execute(f"CREATE TABLE {partition_name(table, cycle)} PARTITION OF {table} {partition_bounds(cycle)};")
+
+
+def create_watermark_table(cursor, table='stock_data'):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table}_watermark (
+            ts_code VARCHAR(10) NOT NULL,
+            cycle VARCHAR(10) NOT NULL,
+            trade_date DATE NOT NULL,
+            PRIMARY KEY (ts_code, cycle)
+        );
+    """)
+
+
+def create_periodic_state_table(cursor, table='stock_data'):
+    """在数据库内生成周期K线时使用的状态表：每只股票每个周期已折叠进周期K线的最新日线交易日。"""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table}_periodic_state (
+            ts_code VARCHAR(10) NOT NULL,
+            cycle VARCHAR(10) NOT NULL,
+            trade_date DATE NOT NULL,
+            PRIMARY KEY (ts_code, cycle)
+        );
+    """)
+
+
+def ensure_schema(conn, table='stock_data'):
+    """
+    确保数据表和水位表存在，数据表不存在时按分区表创建。
+
+    :return: 'partitioned' 或 'legacy'（已存在的未分区表，需执行 migrate_legacy_table 迁移）
+    """
+    with conn:
+        with conn.cursor() as cursor:
+            kind = table_kind(cursor, table)
+            if kind is None:
+                create_partitioned_table(cursor, table)
+                kind = 'p'
+            create_watermark_table(cursor, table)
+    if kind != 'p':
+        logger.warning(f"{table} 为未分区的旧表，可执行 python src/Upload_database.py --migrate 迁移为分区表")
+        return 'legacy'
+    return 'partitioned'
+
+
+def loaded_partitions(cursor, table='stock_data'):
+    """
+    返回已有数据的分区 {(cycle, year)}，日线为 ('daily', 年份)，其他周期年份为 None。
+    """
+    loaded = set()
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent IN (to_regclass(%s), to_regclass(%s)) AND c.relkind = 'r';
+    """, (table, partition_name(table, 'daily')))
+    for (name,) in cursor.fetchall():
+        cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {name});")
+        if not cursor.fetchone()[0]:
+            continue
+        suffix = name[len(table) + 1:]
+        if suffix.startswith('daily_'):
+            loaded.add(('daily', int(suffix.split('_')[1])))
+        else:
+            loaded.add((suffix, None))
+    return loaded
+
+
+def load_partition_via_staging(conn, table, cycle, year, fill):
+    """
+    通过暂存表整体装载一个分区：建无索引的暂存表，调用 fill 写入数据，再建主键和 CHECK 约束，
+    最后在同一事务中替换原有的空分区并挂到父表上。只用于空分区或尚不存在的分区。
+
+    :param fill: fill(cursor, staging_table)，向暂存表写入数据
+    :return: 装载的行数
+    """
+    name = partition_name(table, cycle, year)
+    parent = partition_parent(table, cycle)
+    staging = f"{name}_staging"
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {staging};")
+            cursor.execute(f"CREATE TABLE {staging} ({COLUMNS_SQL});")
+            fill(cursor, staging)
+            # 数据写完后再建索引，一次排序建成，避免逐行维护
+            cursor.execute(f"ALTER TABLE {staging} ADD CONSTRAINT {staging}_bounds CHECK ({partition_check(cycle, year)});")
+            cursor.execute(f"ALTER TABLE {staging} ADD PRIMARY KEY (ts_code, trade_date, cycle);")
+            if table_kind(cursor, name) is not None:
+                cursor.execute(f"ALTER TABLE {parent} DETACH PARTITION {name};")
+                cursor.execute(f"DROP TABLE {name};")
+            cursor.execute(f"ALTER TABLE {staging} RENAME TO {name};")
+            cursor.execute(f"ALTER INDEX {staging}_pkey RENAME TO {name}_pkey;")
+            cursor.execute(f"ALTER TABLE {parent} ATTACH PARTITION {name} {partition_bounds(cycle, year)};")
+            cursor.execute(f"ALTER TABLE {name} DROP CONSTRAINT {staging}_bounds;")
+            cursor.execute(f"""
+                INSERT INTO {table}_watermark (ts_code, cycle, trade_date)
+                SELECT ts_code, cycle, max(trade_date) FROM {name} GROUP BY ts_code, cycle ORDER BY ts_code, cycle
+                ON CONFLICT (ts_code, cycle) DO UPDATE SET
+                    trade_date=GREATEST({table}_watermark.trade_date, EXCLUDED.trade_date);
+            """)
+            cursor.execute(f"ANALYZE {name};")
+            cursor.execute(f"SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s);", (name,))
+            rows = cursor.fetchone()[0]
+    return rows
+
+
+def migrate_legacy_table(conn, table='stock_data', keep_legacy=False):
+    """
+    把未分区的旧表迁移为分区表：旧表改名为 {table}_legacy，新建分区表后逐个分区通过暂存表装载。
+    每个分区单独提交，中断后再次执行会跳过已装载的分区。
+
+    :param keep_legacy: 迁移完成后是否保留旧表
+    """
+    legacy = f"{table}_legacy"
+    with conn:
+        with conn.cursor() as cursor:
+            kind = table_kind(cursor, table)
+            if kind == 'r':
+                cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy};")
+                cursor.execute(f"ALTER INDEX IF EXISTS {table}_pkey RENAME TO {legacy}_pkey;")
+                create_partitioned_table(cursor, table)
+            elif kind is None:
+                create_partitioned_table(cursor, table)
+            create_watermark_table(cursor, table)
+            if table_kind(cursor, legacy) is None:
+                logger.info(f"没有需要迁移的旧表 {legacy}")
+                return
+            cursor.execute(f"""
+                SELECT DISTINCT cycle, CASE WHEN cycle = 'daily' THEN extract(year FROM trade_date)::int END
+                FROM {legacy};
+            """)
+            keys = cursor.fetchall()
+            done = loaded_partitions(cursor, table)
+
+    for cycle, year in sorted(keys, key=lambda key: (key[0], key[1] or 0)):
+        if (cycle, year) in done:
+            continue
+        where = partition_check(cycle, year)
+        rows = load_partition_via_staging(
+            conn, table, cycle, year,
+            lambda cursor, staging: cursor.execute(f"INSERT INTO {staging} SELECT * FROM {legacy} WHERE {where};"))
+        logger.info(f"已迁移分区 {partition_name(table, cycle, year)}：{rows} 行")
+
+    if not keep_legacy:
+        with conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP TABLE {legacy};")
+    logger.info(f"{table} 已迁移为分区表")
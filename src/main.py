@@ -1,52 +1,165 @@
 import os
-import subprocess
 import time
+import argparse
 from datetime import datetime
-import glob
 from dotenv import load_dotenv
 
-# 自动加载项目根目录下的 .env 文件
+# 自动加载项目根目录下的 .env 文件，需在导入各阶段模块之前加载
 load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
 
-def main():
-    start_time = time.time()
+import Pull_base_data
+import Pull_merga_stock
+import Upload_database
+import Adjust_price
+import metrics
+from bar_store import update_bar_store
+from Clear_data import clean_base_data
+from Generating_periodic_data import generate_periodic_data
+from pipeline import Pipeline
+from run_manifest import RunManifest
+from storage import get_storage
 
-    # 获取当前日期
-    current_date = datetime.now().strftime('%Y%m%d')
 
-    # 定义基础数据文件的目标路径和命名规则
+def build_pipeline(current_date, materialize=False, full=False, engine=None, max_workers=6, profile=(), profiler=None):
+    """
+    构建每日流水线：六个基础数据接口并行拉取 -> 清洗 -> 拉取日线 -> 补拉失败股票 -> 生成周期数据 -> 更新数据库，
+    生成周期数据后同时更新K线存储、计算前复权和后复权数据并上传到复权数据表。
+
+    :param current_date: 运行日期（目标交易日），数据集、运行清单和拉取的结束日期均使用该日期，格式：YYYYMMDD
+    :param materialize: 是否把基础数据接口的原始结果和合并后未清洗的数据也保存到 data 目录
+    :param full: 忽略水位和增量状态，拉取完整历史、重新生成所有周期并上传全部行
+    :param engine: 按股票拉取的执行引擎，默认读取环境变量 TUSHARE_FETCH_ENGINE
+    :param max_workers: 最多同时运行的阶段数
+    :param profile: 需要性能剖析的阶段名称，'all' 为全部阶段
+    :param profiler: 剖析工具，'cprofile' 或 'py-spy'
+    """
     target_directory = './data'
     base_data_filename = os.path.join(target_directory, f'基础数据_预处理{current_date}.csv')
-    daily_data_filename = os.path.join(target_directory, f'merged_stocks_data_{current_date}.csv')
+    failed_manifest = os.path.join(target_directory, f'failed_stocks_{current_date}.json')
+    storage = get_storage()
+    daily_dataset = f'merged_stocks_data_{current_date}'
+
+    # 基础数据接口与日线拉取共用同一个限流器和接口缓存
+    Pull_merga_stock.limiter = Pull_base_data.get_limiter()
+    Pull_merga_stock.cache = Pull_base_data.get_cache()
+
+    # 基础数据在流水线开始前判断一次，七个基础数据阶段共用结果
+    base_data_exists = os.path.isfile(base_data_filename)
+    if base_data_exists:
+        print("--------------------基础数据已存在，跳过采集和清洗步骤>>>--------------------")
+
+    def daily_data_exists():
+        if not storage.exists(daily_dataset):
+            return False
+        # 完整重新生成需要完整历史，已存在的数据集是增量拉取的（或没有记录）时重新拉取
+        if full and RunManifest(current_date).data['stages'].get('fetch', {}).get('incremental', True):
+            print(f"今日日线数据集 {storage.path(daily_dataset)} 不是完整历史，重新拉取")
+            return False
+        print(f"--------------------今日日线数据已存在：{storage.path(daily_dataset)}，跳过拉取步骤>>>--------------------")
+        return True
+
+    def no_failures():
+        return not os.path.isfile(failed_manifest)
+
+    def stage_done(stage, message):
+        stages = [stage] if isinstance(stage, str) else stage
+        def skip():
+            if all(RunManifest(current_date).is_done(name) for name in stages):
+                print(message)
+                return True
+            return False
+        return skip
 
-    # 检查基础数据文件是否已存在
-    if os.path.isfile(base_data_filename):
-        print("--------------------基础数据已存在，跳过采集和清洗步骤，直接进入日线数据处理>>>--------------------")
-    else:
-        # 如果没有生成文件，则执行基础数据采集和清洗
-        print("--------------------开始采集今日基础数据--------------------")
-        subprocess.run(['python', os.path.join('src', 'Pull_base_data.py')], check=True)
+    def fetch_daily(inputs):
+        base_data = inputs['clear']
+        stock_codes = base_data['ts_code'].values if base_data is not None else None
+        return Pull_merga_stock.pull_daily_data(stock_codes, full=full, engine=engine, end_date=current_date)
 
-        print("--------------------采集完成，进入清洗、去重、预处理>>>--------------------")
-        subprocess.run(['python', os.path.join('src', 'Clear_data.py')], check=True)
+    pipeline = Pipeline(max_workers=max_workers, profile=profile, profile_dir=metrics.profile_dir(current_date),
+                        profiler=profiler)
+    base_stages = []
+    for file_name, fetch in Pull_base_data.BASE_DATA_FETCHERS.items():
+        name = f'base:{file_name}'
+        pipeline.add(name, lambda inputs, fetch=fetch: fetch(Pull_base_data.get_pro(), save=materialize),
+                     skip=lambda: base_data_exists)
+        base_stages.append(name)
+    pipeline.add('clear', lambda inputs: clean_base_data({name.split(':', 1)[1]: df for name, df in inputs.items()},
+                                                         save_merged=materialize, run_date=current_date),
+                 deps=base_stages, skip=lambda: base_data_exists)
+    pipeline.add('fetch', fetch_daily, deps=['clear'], skip=daily_data_exists)
+    pipeline.add('retry', lambda inputs: Pull_merga_stock.pull_daily_data(retry_failed=True, engine=engine, end_date=current_date),
+                 deps=['fetch'], skip=no_failures)
+    pipeline.add('generate', lambda inputs: generate_periodic_data(full=full)[1], deps=['retry'],
+                 skip=stage_done('generate', "--------------------今日周期数据已生成，跳过生成步骤>>>--------------------"))
+    # 完整重新生成的历史可能修正了早于库中水位的行，增量同步会跳过这些行，因此上传全部行
+    upload_sync_mode = 'full' if full else None
+    pipeline.add('upload', lambda inputs: Upload_database.main(inputs['generate'], sync_mode=upload_sync_mode,
+                                                                    run_date=current_date), deps=['generate'],
+                 skip=stage_done('upload', "--------------------今日数据已上传数据库，跳过上传步骤>>>--------------------"))
+
+    # 未配置复权方式（ADJUST_MODES 为空）时不计算复权数据
+    adjust_done = stage_done('adjust', "--------------------今日复权数据已生成，跳过复权步骤>>>--------------------")
+    upload_adjusted_done = stage_done([Upload_database.upload_stage(Adjust_price.ADJUSTED_TABLES[mode]) for mode in Adjust_price.ADJUST_MODES],
+                                      "--------------------今日复权数据已上传数据库，跳过上传步骤>>>--------------------")
+    pipeline.add('bar_store', lambda inputs: update_bar_store(inputs['generate'], full=full), deps=['generate'],
+                 skip=stage_done('bar_store', "--------------------今日K线存储已更新，跳过更新步骤>>>--------------------"))
+    pipeline.add('adjust', lambda inputs: Adjust_price.adjust_prices(full=full, pro=Pull_base_data.get_pro()), deps=['generate'],
+                 skip=lambda: not Adjust_price.ADJUST_MODES or adjust_done())
+    pipeline.add('upload_adjusted', lambda inputs: Adjust_price.upload_adjusted(inputs['adjust'], run_date=current_date), deps=['adjust'],
+                 skip=lambda: not Adjust_price.ADJUST_MODES or upload_adjusted_done())
+    return pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(description='拉取基础数据与日线数据，生成多周期数据并更新数据库')
+    parser.add_argument('--materialize', action='store_true', help='保存基础数据接口的原始结果等中间文件')
+    parser.add_argument('--full', action='store_true', help='忽略水位和增量状态，拉取完整历史、重新生成所有周期并上传全部行')
+    parser.add_argument('--engine', choices=['process', 'async'], default=None,
+                        help='按股票拉取的执行引擎，默认读取环境变量 TUSHARE_FETCH_ENGINE')
+    parser.add_argument('--workers', type=int, default=6, help='最多同时运行的阶段数')
+    parser.add_argument('--force', action='store_true', help='非交易日也运行')
+    parser.add_argument('--profile', default=','.join(metrics.PROFILE_STAGES),
+                        help='需要性能剖析的阶段，逗号分隔，all 为全部阶段，默认读取环境变量 PROFILE_STAGES')
+    parser.add_argument('--profiler', choices=['cprofile', 'py-spy'], default=None,
+                        help='性能剖析工具，默认读取环境变量 PROFILER')
+    args = parser.parse_args()
+
+    start_time = time.time()
+
+    # 获取当前日期
+    current_date = datetime.now().strftime('%Y%m%d')
 
-    # 检查日线数据文件是否已存在
-    if os.path.isfile(daily_data_filename):
-        print(f"--------------------今日日线数据文件已存在：{daily_data_filename}，跳过拉取步骤>>>--------------------")
-    else:
-        # 如果没有生成日线数据文件，则执行日线数据拉取
-        print("--------------------开始拉取日线历史数据--------------------")
-        subprocess.run(['python', os.path.join('src', 'Pull_merga_stock.py')], check=True) 
+    # 按交易日历确定目标交易日，非交易日没有新数据，直接结束；
+    # 数据集、运行清单和拉取的结束日期都使用目标交易日，--force 或凌晨运行时处理的是最近一个已发布的交易日
+    calendar = Pull_base_data.get_calendar(current_date)
+    if calendar is not None:
+        if not calendar.is_open(current_date) and not args.force:
+            print(f"--------------------{current_date} 不是交易日（上一交易日 {calendar.latest_trade_date(current_date)}），无需运行--------------------")
+            return
+        current_date = calendar.target_trade_date() or current_date
+        print(f"目标交易日：{current_date}")
 
-    print("--------------------开始生成周期数据--------------------")
-    subprocess.run(['python', os.path.join('src', 'Generating_periodic_data.py')], check=True)
+    # 运行清单记录各阶段及阶段内工作单元的完成情况，中断后重新运行从失败的单元继续
+    print(f"运行清单：{RunManifest(current_date).summary()}")
 
-    print("--------------------更新数据库--------------------")
-    subprocess.run(['python', os.path.join('src', 'Upload_database.py')], check=True)
+    pipeline = build_pipeline(current_date, materialize=args.materialize, full=args.full,
+                              engine=args.engine, max_workers=args.workers,
+                              profile=[name for name in args.profile.split(',') if name], profiler=args.profiler)
+    try:
+        pipeline.run()
+    finally:
+        pipeline.report()
+        print(Pull_base_data.get_cache().summary())
+        print(f"运行清单：{RunManifest(current_date).summary()}")
+        # 运行报告记录各阶段、各接口和数据库各批次的指标，同时写出供 node_exporter 采集的 Prometheus 文本文件
+        report = metrics.build_report(current_date, pipeline.stats, Pull_base_data.get_limiter(), Pull_base_data.get_cache(),
+                                      wall=time.time() - start_time, started_at=start_time)
+        metrics.print_report(report)
+        print(f"运行报告：{metrics.write_report(report)}，Prometheus 指标：{metrics.write_prometheus(report)}")
 
     end_time = time.time()
     total_time = end_time - start_time
     print(f"--------------------基础数据、日、周、月、季、年线数据拉取并更新结束，耗时：{total_time:.2f} 秒--------------------")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,396 @@
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import signal
+import bisect
+import resource
+import cProfile
+import threading
+import subprocess
+from datetime import datetime
+from process_pool import context
+
+# 运行报告、Prometheus 文本文件和性能剖析结果的保存目录
+METRICS_DIR = os.getenv('METRICS_DIR', './data/metrics')
+
+# node_exporter textfile collector 读取的文件路径，默认保存在 METRICS_DIR 下
+METRICS_TEXTFILE = os.getenv('METRICS_TEXTFILE') or os.path.join(METRICS_DIR, 'stock_pipeline.prom')
+
+# 需要性能剖析的阶段（逗号分隔，all 为全部阶段），留空则不剖析；剖析工具为 cprofile 或 py-spy
+PROFILE_STAGES = [name for name in os.getenv('PROFILE_STAGES', '').split(',') if name]
+PROFILER = os.getenv('PROFILER', 'cprofile')
+
+# 接口调用耗时直方图的桶上限（秒），与 Prometheus histogram 的 le 标签对应
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 分别统计的 Tushare 接口，其余接口记入 other
+ENDPOINTS = ('daily', 'adj_factor', 'trade_cal', 'stock_basic', 'stock_company', 'namechange',
+             'new_share', 'bak_basic', 'other')
+
+# Prometheus 指标名称前缀
+PREFIX = 'stock_pipeline'
+
+
+class ApiMetrics:
+    """
+    按接口统计的 Tushare 调用指标：调用次数、失败次数、重试次数、耗时直方图和限流等待时间。
+
+    计数保存在共享内存中，在主进程中创建后随限流器通过进程池 initializer 传给子进程，
+    各进程的调用记入同一份统计。
+    """
+
+    FIELDS = ('calls', 'errors', 'retries', 'latency_sum', 'throttle_wait')
+
+    def __init__(self):
+        self.width = len(self.FIELDS) + len(LATENCY_BUCKETS) + 1
+        self._lock = context.Lock()
+        self._values = context.RawArray('d', len(ENDPOINTS) * self.width)
+
+    def _offset(self, endpoint):
+        index = ENDPOINTS.index(endpoint) if endpoint in ENDPOINTS else len(ENDPOINTS) - 1
+        return index * self.width
+
+    def observe(self, endpoint, latency, error=False):
+        """记录一次调用的耗时（秒），error 为 True 表示调用抛出异常。"""
+        offset = self._offset(endpoint)
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, latency)
+        with self._lock:
+            self._values[offset] += 1
+            self._values[offset + 1] += bool(error)
+            self._values[offset + 3] += latency
+            self._values[offset + len(self.FIELDS) + bucket] += 1
+
+    def add_retry(self, endpoint, count=1):
+        """记录重试次数，包括频率超限后的重试和按股票拉取失败后的重试。"""
+        offset = self._offset(endpoint)
+        with self._lock:
+            self._values[offset + 2] += count
+
+    def add_throttle_wait(self, endpoint, seconds):
+        """累计调用前因限流等待的秒数。"""
+        offset = self._offset(endpoint)
+        with self._lock:
+            self._values[offset + 4] += seconds
+
+    def snapshot(self):
+        """
+        返回有调用记录的接口的统计。
+
+        :return: {接口: {calls, errors, retries, latency_sum, throttle_wait, buckets}}，buckets 为各桶的累计次数，最后一个为 +Inf
+        """
+        with self._lock:
+            values = list(self._values)
+        result = {}
+        for index, endpoint in enumerate(ENDPOINTS):
+            row = values[index * self.width:(index + 1) * self.width]
+            if not any(row):
+                continue
+            stats = dict(zip(self.FIELDS, row[:len(self.FIELDS)]))
+            for field in ('calls', 'errors', 'retries'):
+                stats[field] = int(stats[field])
+            cumulative, buckets = 0, []
+            for count in row[len(self.FIELDS):]:
+                cumulative += int(count)
+                buckets.append(cumulative)
+            stats['buckets'] = buckets
+            stats['p50'] = quantile(buckets, 0.5)
+            stats['p95'] = quantile(buckets, 0.95)
+            result[endpoint] = stats
+        return result
+
+
+def quantile(buckets, q):
+    """按直方图各桶的累计次数在桶内线性插值估计分位数，落在 +Inf 桶时返回最大的桶上限。"""
+    total = buckets[-1] if buckets else 0
+    if not total:
+        return None
+    rank = q * total
+    lower, previous = 0.0, 0
+    for bound, cumulative in zip(LATENCY_BUCKETS, buckets):
+        if cumulative >= rank:
+            return lower + (bound - lower) * (rank - previous) / max(1, cumulative - previous)
+        lower, previous = bound, cumulative
+    return LATENCY_BUCKETS[-1]
+
+
+# 进程内所有限流器共用的接口统计，首次使用时创建；spawn 启动的子进程导入本模块时不创建锁和共享内存
+api_metrics = None
+api_metrics_lock = threading.Lock()
+
+
+def get_api_metrics():
+    """返回进程内共用的接口统计，首次调用时创建。"""
+    global api_metrics
+    with api_metrics_lock:
+        if api_metrics is None:
+            api_metrics = ApiMetrics()
+    return api_metrics
+
+# 数据库每个批次（或整体装载的分区）的写入记录，由主进程在批次返回后追加
+db_batches = []
+db_lock = threading.Lock()
+
+
+def record_batch(table, kind, rows, seconds):
+    """
+    记录一个已提交的数据库批次。
+
+    :param table: 目标数据表
+    :param kind: 'upsert' 为按批次 upsert，'partition' 为通过暂存表整体装载的分区
+    :param rows: 写入行数
+    :param seconds: 工作进程中从 COPY 到提交的耗时
+    """
+    with db_lock:
+        db_batches.append({'table': table, 'kind': kind, 'rows': int(rows), 'seconds': seconds,
+                           'rows_per_second': rows / seconds if seconds else None})
+
+
+def db_summary(batches):
+    """按数据表和写入方式汇总批次数、行数、耗时和单批写入速度的最小、中位、最大值。"""
+    groups = {}
+    for batch in batches:
+        groups.setdefault((batch['table'], batch['kind']), []).append(batch)
+    summary = []
+    for (table, kind), group in groups.items():
+        rates = sorted(batch['rows_per_second'] for batch in group if batch['rows_per_second'])
+        rows = sum(batch['rows'] for batch in group)
+        seconds = sum(batch['seconds'] for batch in group)
+        summary.append({'table': table, 'kind': kind, 'batches': len(group), 'rows': rows, 'seconds': seconds,
+                        'rows_per_second': rows / seconds if seconds else None,
+                        'min_rows_per_second': rates[0] if rates else None,
+                        'median_rows_per_second': rates[len(rates) // 2] if rates else None,
+                        'max_rows_per_second': rates[-1] if rates else None})
+    return summary
+
+
+def count_rows(value):
+    """统计阶段输入输出中的行数：DataFrame 取行数，列表、元组和字典累加其中的 DataFrame，无法统计时返回 None。"""
+    if hasattr(value, 'shape') and hasattr(value, 'columns'):
+        return len(value)
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        counts = [count_rows(item) for item in value]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def cpu_times():
+    """返回 (当前线程的 CPU 时间, 已结束子进程的累计 CPU 时间)，单位秒。"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.thread_time(), children.ru_utime + children.ru_stime
+
+
+class StageProfiler:
+    """
+    阶段的性能剖析上下文。
+
+    cprofile 只剖析运行阶段的线程，结果保存为 {阶段}.prof，可用 python -m pstats 或 snakeviz 查看；
+    py-spy 在阶段运行期间对整个进程（含子进程）采样，结果保存为 speedscope 格式的 {阶段}.speedscope.json，
+    未安装 py-spy 时改用 cprofile。
+    """
+
+    def __init__(self, stage, output_dir, profiler=None):
+        """
+        :param stage: 阶段名称
+        :param output_dir: 剖析结果保存目录
+        :param profiler: 'cprofile' 或 'py-spy'，默认读取环境变量 PROFILER
+        """
+        self.profiler = profiler or PROFILER
+        if self.profiler == 'py-spy' and shutil.which('py-spy') is None:
+            print(f"未找到 py-spy，阶段 {stage} 改用 cProfile 剖析")
+            self.profiler = 'cprofile'
+        name = stage.replace(':', '_')
+        suffix = 'speedscope.json' if self.profiler == 'py-spy' else 'prof'
+        self.path = os.path.join(output_dir, f'{name}.{suffix}')
+        os.makedirs(output_dir, exist_ok=True)
+        self._profile = None
+        self._process = None
+
+    def __enter__(self):
+        if self.profiler == 'py-spy':
+            self._process = subprocess.Popen(
+                ['py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses', '--format', 'speedscope',
+                 '--output', self.path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._process is not None:
+            # py-spy 收到 SIGINT 后停止采样并写出结果
+            self._process.send_signal(signal.SIGINT)
+            try:
+                self._process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        else:
+            self._profile.disable()
+            self._profile.dump_stats(self.path)
+
+
+def profile_dir(run_date, metrics_dir=None):
+    """剖析结果的保存目录：{METRICS_DIR}/profile/{运行日期}。"""
+    return os.path.join(metrics_dir or METRICS_DIR, 'profile', run_date)
+
+
+def build_report(run_date, stages, limiter=None, cache=None, wall=None, started_at=None):
+    """
+    汇总一次运行的指标。
+
+    :param run_date: 运行日期，格式：YYYYMMDD
+    :param stages: Pipeline.stats，{阶段名称: 状态、耗时、CPU 时间、内存峰值和输入输出行数}
+    :param limiter: 限流器，提供时记录其接口统计和限流统计
+    :param cache: 接口缓存，提供时记录命中情况
+    :param wall: 整次运行的耗时（秒）
+    :param started_at: 运行开始时间戳
+    """
+    with db_lock:
+        batches = list(db_batches)
+    return {
+        'run_date': run_date,
+        'started_at': datetime.fromtimestamp(started_at or time.time()).isoformat(timespec='seconds'),
+        'wall': wall,
+        'stages': stages,
+        'api': (limiter.metrics if limiter is not None else get_api_metrics()).snapshot(),
+        'limiter': limiter.stats() if limiter is not None else None,
+        'cache': cache.stats() if cache is not None else None,
+        'db': db_summary(batches),
+        'db_batches': batches,
+    }
+
+
+def write_report(report, metrics_dir=None):
+    """把运行报告保存为 {METRICS_DIR}/run_report_{运行日期}_{开始时间}.json，返回文件路径。"""
+    metrics_dir = metrics_dir or METRICS_DIR
+    os.makedirs(metrics_dir, exist_ok=True)
+    started = report['started_at'][11:].replace(':', '')
+    path = os.path.join(metrics_dir, f"run_report_{report['run_date']}_{started}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    return path
+
+
+def label_text(labels):
+    """把标签字典格式化为 {name="value",...}，转义反斜杠、双引号和换行。"""
+    if not labels:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def prometheus_text(report):
+    """把运行报告转换为 Prometheus 文本格式。"""
+    metrics = {}
+
+    def add(name, metric_type, help_text, value, **labels):
+        if value is None:
+            return
+        metric = metrics.setdefault(name, {'type': metric_type, 'help': help_text, 'samples': []})
+        metric['samples'].append((name, labels, value))
+
+    add(f'{PREFIX}_run_duration_seconds', 'gauge', '整次运行的耗时', report['wall'], run_date=report['run_date'])
+    add(f'{PREFIX}_run_timestamp_seconds', 'gauge', '运行开始时间',
+        datetime.fromisoformat(report['started_at']).timestamp(), run_date=report['run_date'])
+
+    for stage, stat in report['stages'].items():
+        add(f'{PREFIX}_stage_wall_seconds', 'gauge', '阶段耗时', stat['wall'], stage=stage, status=stat['status'])
+        add(f'{PREFIX}_stage_cpu_seconds', 'gauge', '阶段线程及其间结束的子进程的 CPU 时间', stat.get('cpu'), stage=stage)
+        add(f'{PREFIX}_stage_peak_rss_bytes', 'gauge', '阶段运行期间的进程内存峰值', stat['peak_rss'] or None, stage=stage)
+        add(f'{PREFIX}_stage_rows_in', 'gauge', '阶段输入行数', stat.get('rows_in'), stage=stage)
+        add(f'{PREFIX}_stage_rows_out', 'gauge', '阶段输出行数', stat.get('rows_out'), stage=stage)
+
+    name = f'{PREFIX}_api_request_duration_seconds'
+    for endpoint, stats in report['api'].items():
+        metric = metrics.setdefault(name, {'type': 'histogram', 'help': 'Tushare 接口调用耗时', 'samples': []})
+        for bound, cumulative in zip(LATENCY_BUCKETS + ('+Inf',), stats['buckets']):
+            metric['samples'].append((f'{name}_bucket', {'endpoint': endpoint, 'le': bound}, cumulative))
+        metric['samples'].append((f'{name}_sum', {'endpoint': endpoint}, stats['latency_sum']))
+        metric['samples'].append((f'{name}_count', {'endpoint': endpoint}, stats['calls']))
+    for endpoint, stats in report['api'].items():
+        add(f'{PREFIX}_api_errors_total', 'counter', 'Tushare 接口调用失败次数', stats['errors'], endpoint=endpoint)
+        add(f'{PREFIX}_api_retries_total', 'counter', 'Tushare 接口重试次数', stats['retries'], endpoint=endpoint)
+        add(f'{PREFIX}_api_throttle_wait_seconds_total', 'counter', '调用前因限流等待的秒数',
+            stats['throttle_wait'], endpoint=endpoint)
+
+    if report['limiter'] is not None:
+        add(f'{PREFIX}_api_quota_errors_total', 'counter', '频率超限次数', report['limiter']['quota_errors'])
+        add(f'{PREFIX}_api_concurrency', 'gauge', '限流器结束时的并发数', report['limiter']['concurrency'])
+    if report['cache'] is not None:
+        add(f'{PREFIX}_api_cache_hits_total', 'counter', '接口缓存命中次数', report['cache']['hits'])
+        add(f'{PREFIX}_api_cache_misses_total', 'counter', '接口缓存未命中次数', report['cache']['misses'])
+
+    for group in report['db']:
+        labels = {'table': group['table'], 'kind': group['kind']}
+        add(f'{PREFIX}_db_batches_total', 'counter', '已提交的数据库批次数', group['batches'], **labels)
+        add(f'{PREFIX}_db_rows_total', 'counter', '写入数据库的行数', group['rows'], **labels)
+        add(f'{PREFIX}_db_batch_seconds_total', 'counter', '数据库批次累计耗时', group['seconds'], **labels)
+        for stat in ('min', 'median', 'max'):
+            add(f'{PREFIX}_db_batch_rows_per_second', 'gauge', '单批写入速度', group[f'{stat}_rows_per_second'],
+                stat=stat, **labels)
+
+    lines = []
+    for name, metric in metrics.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for sample, labels, value in metric['samples']:
+            lines.append(f'{sample}{label_text(labels)} {value:g}' if isinstance(value, float) else
+                         f'{sample}{label_text(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(report, path=None):
+    """写出 Prometheus 文本文件，先写临时文件再替换，node_exporter 不会读到写了一半的文件。"""
+    path = path or METRICS_TEXTFILE
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text(report))
+    os.replace(tmp_path, path)
+    return path
+
+
+def print_report(report):
+    """打印运行报告中的接口调用和数据库写入统计，阶段统计见 Pipeline.report。"""
+    if report['api']:
+        print(f"{'接口':<16}{'调用':>8}{'失败':>6}{'重试':>6}{'平均(秒)':>10}{'P50(秒)':>10}{'P95(秒)':>10}{'限流等待(秒)':>14}")
+        for endpoint, stats in report['api'].items():
+            mean = stats['latency_sum'] / stats['calls'] if stats['calls'] else 0.0
+            print(f"{endpoint:<16}{stats['calls']:>8}{stats['errors']:>6}{stats['retries']:>6}{mean:>10.3f}"
+                  f"{stats['p50'] or 0:>10.3f}{stats['p95'] or 0:>10.3f}{stats['throttle_wait']:>14.1f}")
+    if report['db']:
+        print(f"{'数据表':<20}{'方式':<10}{'批次':>6}{'行数':>12}{'耗时(秒)':>10}{'行/秒':>12}{'单批最慢(行/秒)':>18}")
+        for group in report['db']:
+            print(f"{group['table']:<20}{group['kind']:<10}{group['batches']:>6}{group['rows']:>12}{group['seconds']:>10.2f}"
+                  f"{group['rows_per_second'] or 0:>12,.0f}{group['min_rows_per_second'] or 0:>18,.0f}")
+
+
+def latest_report(metrics_dir=None):
+    """返回最近一次运行报告的路径，没有时返回 None。"""
+    paths = sorted(glob.glob(os.path.join(metrics_dir or METRICS_DIR, 'run_report_*.json')))
+    return paths[-1] if paths else None
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else latest_report()
+    if path is None:
+        print("没有找到运行报告")
+        return
+    with open(path, encoding='utf-8') as f:
+        report = json.load(f)
+    print(f"运行报告：{path}，运行日期 {report['run_date']}，开始于 {report['started_at']}，耗时 {report['wall'] or 0:.2f} 秒")
+    print(f"{'阶段':<24}{'状态':<6}{'耗时(秒)':>10}{'CPU(秒)':>10}{'内存峰值(MB)':>14}{'输入行数':>12}{'输出行数':>12}")
+    for name, stat in report['stages'].items():
+        print(f"{name:<24}{stat['status']:<6}{stat['wall']:>10.2f}{stat.get('cpu') or 0:>10.2f}"
+              f"{stat['peak_rss'] / 2**20:>14.1f}{stat.get('rows_in') or '':>12}{stat.get('rows_out') or '':>12}")
+    print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import io
+import time
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+import schema
+import db_schema
+import metrics
+from Upload_database import create_database_connection, upsert_sql, COLUMNS
+from Generating_periodic_data import resample_all_cycles, CYCLE_FREQS
+
+logger = logging.getLogger(__name__)
+
+# 各周期的周期结束日期，与 Generating_periodic_data 中 pandas 周期的 end_time 一致（周线以周五为周期结束日）
+PERIOD_END_SQL = {
+    'weekly': "({d} + mod(12 - extract(isodow FROM {d})::int, 7))",
+    'monthly': "(date_trunc('month', {d}::timestamp) + interval '1 month - 1 day')::date",
+    'quarterly': "(date_trunc('quarter', {d}::timestamp) + interval '3 months - 1 day')::date",
+    'yearly': "(date_trunc('year', {d}::timestamp) + interval '1 year - 1 day')::date",
+}
+
+# 各周期的周期开始日期（周线为上周六）
+PERIOD_START_SQL = {
+    'weekly': "({d} - mod(extract(isodow FROM {d})::int + 1, 7))",
+    'monthly': "date_trunc('month', {d}::timestamp)::date",
+    'quarterly': "date_trunc('quarter', {d}::timestamp)::date",
+    'yearly': "date_trunc('year', {d}::timestamp)::date",
+}
+
+
+def period_end(cycle, column):
+    return PERIOD_END_SQL[cycle].format(d=column)
+
+
+def period_start(cycle, column):
+    return PERIOD_START_SQL[cycle].format(d=column)
+
+
+def create_functions(cursor):
+    """
+    创建 kahan_sum 聚合函数：与 pandas 分组求和相同的 Kahan 补偿求和，按 ORDER BY 的顺序累加，跳过 NULL，全为 NULL 时为 0。
+    直接用 sum(float8) 或 numeric 求和在最后一位上会与 Python 生成的结果不同。
+    """
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION kahan_sum_step(state float8[], value float8) RETURNS float8[]
+        LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+            SELECT ARRAY[t, t - state[1] - y] FROM (SELECT state[1] + (value - state[2]) AS t, value - state[2] AS y) s
+        $$;
+    """)
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION kahan_sum_final(state float8[]) RETURNS float8
+        LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$ SELECT state[1] $$;
+    """)
+    cursor.execute("""
+        CREATE OR REPLACE AGGREGATE kahan_sum(float8) (
+            SFUNC = kahan_sum_step, STYPE = float8[], FINALFUNC = kahan_sum_final, INITCOND = '{0,0}'
+        );
+    """)
+
+
+def mark_dirty(cursor, table, cycle, since=None):
+    """
+    在临时表 tmp_periodic_dirty 中列出需要重新聚合的股票及起始日期：日线水位晚于状态表记录的股票从状态表的日期所在周期开始，
+    状态表中没有的股票从头开始（since 为 NULL）；since 中的股票（本次上传了日线的股票）从其最早上传日期所在周期开始。
+
+    :param since: 本次上传的日线中每只股票的最早交易日 {ts_code: 日期}，用于覆盖水位当天被修正的日线
+    """
+    cursor.execute("CREATE TEMP TABLE tmp_periodic_dirty (ts_code VARCHAR(10) PRIMARY KEY, since DATE) ON COMMIT DROP;")
+    cursor.execute(f"""
+        INSERT INTO tmp_periodic_dirty (ts_code, since)
+        SELECT w.ts_code, s.trade_date FROM {table}_watermark w
+        LEFT JOIN {table}_periodic_state s ON s.ts_code = w.ts_code AND s.cycle = %s
+        WHERE w.cycle = 'daily' AND (s.trade_date IS NULL OR w.trade_date > s.trade_date);
+    """, (cycle,))
+    if since:
+        # 两个起始日期任一为 NULL（从头聚合）时保持 NULL，LEAST 会忽略 NULL
+        cursor.execute(f"""
+            INSERT INTO tmp_periodic_dirty (ts_code, since)
+            SELECT u.ts_code, CASE WHEN s.trade_date IS NULL THEN NULL ELSE LEAST(s.trade_date, u.since) END
+            FROM unnest(%s::text[], %s::date[]) AS u(ts_code, since)
+            LEFT JOIN {table}_periodic_state s ON s.ts_code = u.ts_code AND s.cycle = %s
+            ON CONFLICT (ts_code) DO UPDATE SET since =
+                CASE WHEN tmp_periodic_dirty.since IS NULL OR EXCLUDED.since IS NULL THEN NULL
+                     ELSE LEAST(tmp_periodic_dirty.since, EXCLUDED.since) END;
+        """, (list(since), [str(date)[:10] for date in since.values()], cycle))
+
+
+def refresh_cycle(conn, cycle, table='stock_data', since=None):
+    """
+    在数据库内由日线聚合出一个周期的K线，只重新聚合有新日线的股票从上次聚合的最后一个（可能仍未结束的）周期开始的部分，
+    结果与 Generating_periodic_data.aggregate_cycle + finalize_bars 一致：
+
+    - open、close 为周期内第一个、最后一个非空值，high、low 取最大、最小值，vol、amount 与 pandas 分组求和一样按交易日顺序做 Kahan 补偿求和；
+    - 任一价格全为空的周期不生成；
+    - pre_close 为上一周期的收盘价，第一个周期为 0，按 numpy 的方式（乘 100 后按就近取偶取整，double precision 的 round 与 numpy.rint 相同）保留两位小数后计算 change、pct_chg，
+      pre_close、change 与 Python 生成的数据一样经过 float32 取整。
+
+    K线、水位和状态表在同一事务中更新。
+
+    :param cycle: 周期标签，如 'weekly'
+    :param since: 见 mark_dirty
+    :return: upsert 的K线数
+    """
+    end = period_end(cycle, 'd.trade_date')
+    prices = ['open', 'high', 'low', 'close']
+    with conn:
+        with conn.cursor() as cursor:
+            mark_dirty(cursor, table, cycle, since)
+            # previous 为重新聚合部分之前最后一根已入库K线的收盘价，作为第一根重新聚合的K线的 pre_close
+            cursor.execute(f"""
+                CREATE TEMP TABLE tmp_periodic_bars ON COMMIT DROP AS
+                WITH days AS (
+                    SELECT d.ts_code, d.trade_date, {end} AS period, d.open, d.high, d.low, d.close, d.vol, d.amount
+                    FROM tmp_periodic_dirty t
+                    JOIN {table} d ON d.ts_code = t.ts_code
+                    WHERE d.cycle = 'daily' AND (t.since IS NULL OR d.trade_date >= {period_start(cycle, 't.since')})
+                ),
+                bars AS (
+                    SELECT ts_code, period AS trade_date,
+                        (array_agg(open ORDER BY trade_date) FILTER (WHERE open IS NOT NULL))[1] AS open,
+                        max(high) AS high,
+                        min(low) AS low,
+                        (array_agg(close ORDER BY trade_date DESC) FILTER (WHERE close IS NOT NULL))[1] AS close,
+                        kahan_sum(vol ORDER BY trade_date) AS vol,
+                        kahan_sum(amount ORDER BY trade_date) AS amount,
+                        max(trade_date) AS last_daily
+                    FROM days
+                    GROUP BY ts_code, period
+                    HAVING {' AND '.join(f'count({column}) > 0' for column in prices)}
+                ),
+                previous AS (
+                    SELECT t.ts_code, (
+                        SELECT p.close FROM {table} p
+                        WHERE p.cycle = %(cycle)s AND p.ts_code = t.ts_code AND p.trade_date < {period_end(cycle, 't.since')}
+                        ORDER BY p.trade_date DESC LIMIT 1
+                    ) AS close
+                    FROM tmp_periodic_dirty t
+                    WHERE t.since IS NOT NULL
+                ),
+                rounded AS (
+                    SELECT b.*,
+                        round(b.close * 100) / 100 AS close_r,
+                        round(coalesce(lag(b.close) OVER (PARTITION BY b.ts_code ORDER BY b.trade_date), p.close, 0) * 100) / 100 AS pre_r
+                    FROM bars b
+                    LEFT JOIN previous p ON p.ts_code = b.ts_code
+                )
+                SELECT ts_code, trade_date, %(cycle)s::varchar(10) AS cycle, open, high, low, close,
+                    pre_r::real::float8 AS pre_close,
+                    (round((close_r - pre_r) * 100) / 100)::real::float8 AS change,
+                    CASE WHEN pre_r <> 0 THEN round((close_r - pre_r) / pre_r * 100 * 100) / 100 ELSE 0 END AS pct_chg,
+                    vol, amount, last_daily
+                FROM rounded;
+            """, {'cycle': cycle})
+            cursor.execute(upsert_sql(table, 'tmp_periodic_bars'))
+            cursor.execute("SELECT count(*) FROM tmp_periodic_bars;")
+            rows = cursor.fetchone()[0]
+            cursor.execute(f"""
+                INSERT INTO {table}_watermark (ts_code, cycle, trade_date)
+                SELECT ts_code, cycle, max(trade_date) FROM tmp_periodic_bars GROUP BY ts_code, cycle ORDER BY ts_code, cycle
+                ON CONFLICT (ts_code, cycle) DO UPDATE SET
+                    trade_date=GREATEST({table}_watermark.trade_date, EXCLUDED.trade_date);
+            """)
+            cursor.execute(f"""
+                INSERT INTO {table}_periodic_state (ts_code, cycle, trade_date)
+                SELECT ts_code, cycle, max(last_daily) FROM tmp_periodic_bars GROUP BY ts_code, cycle ORDER BY ts_code, cycle
+                ON CONFLICT (ts_code, cycle) DO UPDATE SET
+                    trade_date=GREATEST({table}_periodic_state.trade_date, EXCLUDED.trade_date);
+            """)
+    return rows
+
+
+def refresh(conn, table='stock_data', cycles=None, since=None):
+    """
+    在数据库内增量刷新各周期K线，每个周期一个事务。
+
+    :param cycles: 需要刷新的周期，默认为 CYCLE_FREQS 中的全部周期
+    :param since: 本次上传的日线中每只股票的最早交易日（Series 或字典），见 mark_dirty
+    :return: {周期: upsert 的K线数}
+    """
+    with conn:
+        with conn.cursor() as cursor:
+            db_schema.create_watermark_table(cursor, table)
+            db_schema.create_periodic_state_table(cursor, table)
+            create_functions(cursor)
+    since = dict(since.items()) if since is not None else None
+    results = {}
+    for cycle in cycles or list(CYCLE_FREQS):
+        start = time.perf_counter()
+        results[cycle] = refresh_cycle(conn, cycle, table, since)
+        elapsed = time.perf_counter() - start
+        metrics.record_batch(table, f'sql:{cycle}', results[cycle], elapsed)
+        logger.info(f"{table} {cycle} 数据库内聚合完成：更新 {results[cycle]} 根K线，耗时 {elapsed:.2f} 秒")
+    return results
+
+
+def rebuild(conn, table='stock_data', cycles=None):
+    """清空状态表中指定周期的记录后重新聚合全部股票的完整历史。"""
+    cycles = cycles or list(CYCLE_FREQS)
+    with conn:
+        with conn.cursor() as cursor:
+            db_schema.create_periodic_state_table(cursor, table)
+            cursor.execute(f"DELETE FROM {table}_periodic_state WHERE cycle = ANY(%s);", (cycles,))
+    return refresh(conn, table, cycles)
+
+
+def read_rows(conn, table, codes, cycles):
+    """读取指定股票、指定周期的全部K线。"""
+    buffer = io.StringIO()
+    with conn.cursor() as cursor:
+        query = cursor.mogrify(f"""
+            COPY (SELECT {', '.join(COLUMNS)} FROM {table} WHERE ts_code = ANY(%s) AND cycle = ANY(%s))
+            TO STDOUT WITH CSV HEADER
+        """, (list(codes), list(cycles))).decode()
+        cursor.copy_expert(query, buffer)
+    buffer.seek(0)
+    # 逐行比较需要与库中完全相同的浮点数，默认的快速解析在最后一位上可能有误差
+    return schema.apply_schema(pd.read_csv(buffer, dtype={'ts_code': str}, float_precision='round_trip'))
+
+
+def verify(conn, table='stock_data', codes=None, sample=50, cycles=None):
+    """
+    抽样核对数据库内聚合的周期K线：读取股票的完整日线用 resample_all_cycles 重新生成，与库中K线逐行比较。
+
+    :param codes: 需要核对的股票，默认从日线水位表中随机抽取 sample 只
+    :return: {周期: 不一致的行数（含只出现在一边的行）}
+    """
+    cycles = cycles or list(CYCLE_FREQS)
+    if codes is None:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT ts_code FROM {table}_watermark WHERE cycle = 'daily' ORDER BY random() LIMIT %s;", (sample,))
+            codes = [row[0] for row in cursor.fetchall()]
+    daily = read_rows(conn, table, codes, ['daily'])
+    expected = resample_all_cycles(daily, cycles)
+    actual = read_rows(conn, table, codes, cycles)
+    columns = [column for column in COLUMNS if column not in ('ts_code', 'trade_date', 'cycle')]
+    mismatches = {}
+    for cycle in cycles:
+        left = schema.apply_schema(expected[cycle][COLUMNS].copy())
+        right = actual[actual['cycle'] == cycle]
+        merged = left.merge(right, on=['ts_code', 'trade_date'], how='outer', suffixes=('', '_db'), indicator=True)
+        differs = merged['_merge'] != 'both'
+        for column in columns:
+            a = merged[column].to_numpy(dtype='float64')
+            b = merged[f'{column}_db'].to_numpy(dtype='float64')
+            differs |= ~((a == b) | (np.isnan(a) & np.isnan(b)))
+        mismatches[cycle] = int(differs.sum())
+        logger.info(f"{cycle}：{len(codes)} 只股票，Python 生成 {len(left)} 根，库中 {len(right)} 根，不一致 {mismatches[cycle]} 根")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='在 PostgreSQL 内由日线聚合周、月、季、年K线')
+    parser.add_argument('--table', default='stock_data', help='数据表，默认 stock_data')
+    parser.add_argument('--cycles', default=None, help='逗号分隔的周期，默认全部周期')
+    parser.add_argument('--rebuild', action='store_true', help='忽略状态表，重新聚合全部股票的完整历史')
+    parser.add_argument('--verify', type=int, nargs='?', const=50, default=None, metavar='N',
+                        help='随机抽取 N 只股票（默认 50），与 Python 生成的结果逐行核对')
+    args = parser.parse_args()
+    cycles = args.cycles.split(',') if args.cycles else None
+    conn = create_database_connection()
+    try:
+        if args.verify is not None:
+            mismatches = verify(conn, args.table, sample=args.verify, cycles=cycles)
+            if any(mismatches.values()):
+                raise SystemExit(1)
+        elif args.rebuild:
+            rebuild(conn, args.table, cycles)
+        else:
+            refresh(conn, args.table, cycles)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
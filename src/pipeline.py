@@ -0,0 +1,195 @@
+import os
+import time
+import resource
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from metrics import StageProfiler, count_rows, cpu_times
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def current_rss():
+    """返回当前进程的常驻内存（字节），读取 /proc/self/statm，不可用时退回历史峰值 ru_maxrss。"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RssSampler:
+    """
+    后台线程定期采样进程常驻内存，记录每个运行中阶段期间的峰值。
+    多个阶段并行运行时，各阶段记录的是重叠时间段内整个进程的峰值。
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peaks = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        rss = current_rss()
+        with self._lock:
+            for name in self.peaks:
+                self.peaks[name] = max(self.peaks[name], rss)
+        return rss
+
+    def start_stage(self, name):
+        rss = current_rss()
+        with self._lock:
+            self.peaks[name] = rss
+        return rss
+
+    def end_stage(self, name):
+        self.sample()
+        with self._lock:
+            return self.peaks.pop(name)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Stage:
+    """
+    流水线中的一个阶段。
+
+    :param name: 阶段名称
+    :param func: 阶段函数，参数为 {依赖阶段名称: 依赖阶段的返回值}，返回值在内存中传给下游阶段
+    :param deps: 依赖的阶段名称列表
+    :param skip: 无参函数，在阶段即将运行时调用，返回 True 时跳过该阶段，返回值记为 None
+    """
+
+    def __init__(self, name, func, deps=(), skip=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.skip = skip
+
+
+class Pipeline:
+    """
+    进程内的有向无环图流水线：依赖全部完成的阶段立即提交到线程池运行，互不依赖的阶段并行执行，
+    阶段结果在内存中传给下游阶段，并记录每个阶段的耗时、CPU 时间、内存峰值和输入输出行数。
+    """
+
+    def __init__(self, max_workers=6, sample_interval=0.05, profile=(), profile_dir=None, profiler=None):
+        """
+        :param max_workers: 最多同时运行的阶段数
+        :param sample_interval: 内存采样间隔（秒）
+        :param profile: 需要性能剖析的阶段名称，包含 'all' 时剖析全部阶段
+        :param profile_dir: 剖析结果保存目录
+        :param profiler: 剖析工具，'cprofile' 或 'py-spy'，见 metrics.StageProfiler
+        """
+        self.max_workers = max_workers
+        self.sample_interval = sample_interval
+        self.profile = set(profile)
+        self.profile_dir = profile_dir
+        self.profiler = profiler
+        self.stages = {}
+        self.stats = {}
+
+    def add(self, name, func, deps=(), skip=None):
+        """添加阶段，依赖的阶段需先添加。"""
+        missing = [dep for dep in deps if dep not in self.stages]
+        if missing:
+            raise ValueError(f"阶段 {name} 依赖的阶段不存在：{missing}")
+        self.stages[name] = Stage(name, func, deps, skip)
+        return self
+
+    def _run_stage(self, stage, inputs, sampler):
+        rows_in = count_rows(list(inputs.values()))
+        if stage.skip is not None and stage.skip():
+            self.stats[stage.name] = {'status': '跳过', 'wall': 0.0, 'cpu': 0.0, 'peak_rss': 0, 'rss_delta': 0,
+                                      'rows_in': rows_in, 'rows_out': None}
+            return None
+        profiler = None
+        if self.profile & {stage.name, 'all'}:
+            profiler = StageProfiler(stage.name, self.profile_dir or '.', self.profiler)
+        start_rss = sampler.start_stage(stage.name)
+        start_time = time.time()
+        # CPU 时间为阶段线程的 CPU 时间加上阶段运行期间结束的子进程的 CPU 时间，并行阶段的子进程可能互相计入
+        start_thread, start_children = cpu_times()
+        result = None
+        try:
+            if profiler is not None:
+                with profiler:
+                    result = stage.func(inputs)
+            else:
+                result = stage.func(inputs)
+            status = '完成'
+            return result
+        except Exception:
+            status = '失败'
+            raise
+        finally:
+            peak_rss = sampler.end_stage(stage.name)
+            end_thread, end_children = cpu_times()
+            self.stats[stage.name] = {'status': status, 'wall': time.time() - start_time,
+                                      'cpu': end_thread - start_thread + max(0.0, end_children - start_children),
+                                      'peak_rss': peak_rss, 'rss_delta': peak_rss - start_rss,
+                                      'rows_in': rows_in, 'rows_out': count_rows(result)}
+            if profiler is not None:
+                self.stats[stage.name]['profile'] = profiler.path
+
+    def run(self):
+        """
+        按依赖顺序运行全部阶段，任一阶段失败时不再提交新阶段，等待运行中的阶段结束后抛出异常。
+
+        :return: {阶段名称: 返回值}
+        """
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        error = None
+        with RssSampler(self.sample_interval) as sampler, ThreadPoolExecutor(self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    ready = [stage for stage in pending.values() if all(dep in results for dep in stage.deps)]
+                    for stage in ready:
+                        inputs = {dep: results[dep] for dep in stage.deps}
+                        running[executor.submit(self._run_stage, stage, inputs, sampler)] = stage.name
+                        del pending[stage.name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        print(f"阶段 {name} 失败：{e}")
+                        error = error or e
+        if error is not None:
+            raise error
+        return results
+
+    def report(self):
+        """打印每个阶段的状态、耗时、CPU 时间、运行期间的进程内存峰值和输入输出行数。"""
+        print(f"{'阶段':<24}{'状态':<6}{'耗时(秒)':>10}{'CPU(秒)':>10}{'内存峰值(MB)':>14}{'内存增量(MB)':>14}"
+              f"{'输入行数':>12}{'输出行数':>12}")
+        for name in self.stages:
+            stat = self.stats.get(name)
+            if stat is None:
+                print(f"{name:<24}{'未运行':<6}")
+                continue
+            print(f"{name:<24}{stat['status']:<6}{stat['wall']:>10.2f}{stat['cpu']:>10.2f}"
+                  f"{stat['peak_rss'] / 2**20:>14.1f}{stat['rss_delta'] / 2**20:>14.1f}"
+                  f"{stat['rows_in'] if stat['rows_in'] is not None else '':>12}"
+                  f"{stat['rows_out'] if stat['rows_out'] is not None else '':>12}")
+            if 'profile' in stat:
+                print(f"{'':<24}性能剖析：{stat['profile']}")
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        if children:
+            print(f"子进程内存峰值(MB)：{children:.1f}")
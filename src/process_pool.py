@@ -0,0 +1,17 @@
+import os
+import multiprocessing
+from dotenv import load_dotenv
+
+# 加载.env环境变量
+load_dotenv()
+
+# 进程池的启动方式：spawn（默认）、forkserver 或 fork。
+# main.py 在线程池中并行运行各阶段，另有内存采样线程，fork 只复制调用线程，
+# 其他线程当时持有的锁（日志、标准输出、内存分配器等）在子进程中永远不会释放，子进程可能因此卡死；
+# spawn 启动全新的解释器，子进程需要的数据通过 initializer 参数和任务参数显式传入。
+# forkserver 的工作进程不是主进程的子进程，运行报告中各阶段的 CPU 时间不包含工作进程。
+POOL_START_METHOD = os.getenv('POOL_START_METHOD', 'spawn')
+
+# 全部进程池以及传给子进程的锁、共享内存计数都从同一个上下文创建，
+# 以 fork 方式创建的锁不能传给 spawn 启动的子进程
+context = multiprocessing.get_context(POOL_START_METHOD)
@@ -0,0 +1,199 @@
+import os
+import time
+import random
+import asyncio
+from dotenv import load_dotenv
+from process_pool import context
+from metrics import get_api_metrics
+
+# 加载.env环境变量
+load_dotenv()
+
+# Tushare 超出频率限制时的错误信息关键字
+QUOTA_ERROR_KEYWORDS = ('每分钟最多访问', '每小时最多访问', '频率超限')
+
+
+def is_quota_error(error):
+    """判断异常是否为 Tushare 的访问频率超限错误。"""
+    message = str(error)
+    return any(keyword in message for keyword in QUOTA_ERROR_KEYWORDS)
+
+
+def retry_delay(attempt, base_delay=2.0, max_delay=60.0):
+    """
+    计算第 attempt 次失败后的重试等待时间：指数退避，并加入随机抖动避免多只股票同时重试。
+    """
+    delay = min(max_delay, base_delay * (2 ** (attempt - 1)))
+    return delay * random.uniform(0.5, 1.5)
+
+
+class RateLimiter:
+    """
+    跨进程共享的 Tushare 调用限流器。
+
+    令牌桶按每分钟调用次数匀速补充令牌，所有进程共用同一个桶；同时限制同时在途的请求数，
+    遇到频率超限错误时并发减半并暂停发放令牌，连续成功后逐步恢复并发。
+    状态保存在共享内存中，需在创建进程池之前构造，并通过 initializer 传给子进程。
+    """
+
+    def __init__(self, calls_per_minute=None, max_concurrency=None, initial_concurrency=None,
+                 cooldown=20.0, ramp_up_after=20, max_quota_retries=3, metrics=None):
+        """
+        :param calls_per_minute: 每分钟最多调用次数，默认读取环境变量 TUSHARE_CALLS_PER_MINUTE（500）
+        :param max_concurrency: 并发上限，默认读取环境变量 TUSHARE_MAX_WORKERS（10）
+        :param initial_concurrency: 初始并发数，默认为 5 与并发上限中的较小值
+        :param cooldown: 遇到频率超限错误后暂停发放令牌的秒数
+        :param ramp_up_after: 连续成功多少次（乘以当前并发数）后并发加一
+        :param max_quota_retries: 单次调用遇到频率超限错误时的最多重试次数
+        :param metrics: 按接口记录调用耗时、重试和限流等待的 metrics.ApiMetrics，默认使用进程共用的 metrics.get_api_metrics()
+        """
+        calls_per_minute = calls_per_minute or int(os.getenv('TUSHARE_CALLS_PER_MINUTE', '500'))
+        self.max_concurrency = max_concurrency or int(os.getenv('TUSHARE_MAX_WORKERS', '10'))
+        initial_concurrency = initial_concurrency or min(5, self.max_concurrency)
+
+        self.rate = calls_per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.cooldown = cooldown
+        self.ramp_up_after = ramp_up_after
+        self.max_quota_retries = max_quota_retries
+        self.metrics = metrics or get_api_metrics()
+
+        self._lock = context.Lock()
+        self._tokens = context.RawValue('d', self.capacity)
+        self._last_refill = context.RawValue('d', time.monotonic())
+        self._paused_until = context.RawValue('d', 0.0)
+        self._concurrency = context.RawValue('i', initial_concurrency)
+        self._in_flight = context.RawValue('i', 0)
+        self._success_streak = context.RawValue('i', 0)
+        self._throttle_wait = context.RawValue('d', 0.0)
+        self._quota_errors = context.RawValue('i', 0)
+
+    def try_acquire(self):
+        """
+        尝试获取一个令牌和一个并发名额。
+
+        :return: 0 表示获取成功，否则为建议等待的秒数
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last_refill.value
+            self._tokens.value = min(self.capacity, self._tokens.value + elapsed * self.rate)
+            self._last_refill.value = now
+
+            if now < self._paused_until.value:
+                return self._paused_until.value - now
+            if self._in_flight.value >= self._concurrency.value:
+                return 0.05
+            if self._tokens.value < 1:
+                return (1 - self._tokens.value) / self.rate
+
+            self._tokens.value -= 1
+            self._in_flight.value += 1
+            return 0
+
+    def acquire(self, api_name=None):
+        """阻塞直到获取令牌和并发名额，api_name 为等待时间计入的接口。"""
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            self.add_throttle_wait(wait, api_name)
+            time.sleep(wait)
+
+    async def acquire_async(self, api_name=None):
+        """acquire 的协程版本，等待时让出事件循环。"""
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            self.add_throttle_wait(wait, api_name)
+            await asyncio.sleep(wait)
+
+    def add_throttle_wait(self, seconds, api_name=None):
+        """累计因限流产生的等待时间。"""
+        with self._lock:
+            self._throttle_wait.value += seconds
+        self.metrics.add_throttle_wait(api_name, seconds)
+
+    def release(self, success=True):
+        """
+        归还并发名额；连续成功达到阈值后并发加一。
+
+        :param success: 本次调用是否成功
+        """
+        with self._lock:
+            self._in_flight.value = max(0, self._in_flight.value - 1)
+            if not success:
+                self._success_streak.value = 0
+                return
+            self._success_streak.value += 1
+            if (self._concurrency.value < self.max_concurrency
+                    and self._success_streak.value >= self.ramp_up_after * self._concurrency.value):
+                self._concurrency.value += 1
+                self._success_streak.value = 0
+
+    def report_quota_error(self):
+        """遇到频率超限错误：并发减半，清空令牌并暂停发放一段时间。"""
+        with self._lock:
+            self._concurrency.value = max(1, self._concurrency.value // 2)
+            self._tokens.value = 0
+            self._paused_until.value = max(self._paused_until.value, time.monotonic() + self.cooldown)
+            self._success_streak.value = 0
+            self._quota_errors.value += 1
+
+    def call(self, func, *args, api_name=None, **kwargs):
+        """
+        在限流下调用 func，频率超限时退避后重试，其他异常直接抛出。
+
+        :param api_name: 接口名称，调用耗时、重试次数和限流等待按接口记入 metrics，不传给 func
+        """
+        attempt = 0
+        while True:
+            self.acquire(api_name)
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self.metrics.observe(api_name, time.perf_counter() - start, error=True)
+                self.release(success=False)
+                if is_quota_error(e) and attempt < self.max_quota_retries:
+                    attempt += 1
+                    self.metrics.add_retry(api_name)
+                    self.report_quota_error()
+                    continue
+                raise
+            self.metrics.observe(api_name, time.perf_counter() - start)
+            self.release(success=True)
+            return result
+
+    async def call_async(self, func, *args, api_name=None, **kwargs):
+        """
+        call 的协程版本，func 为协程函数。
+        """
+        attempt = 0
+        while True:
+            await self.acquire_async(api_name)
+            start = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                self.metrics.observe(api_name, time.perf_counter() - start, error=True)
+                self.release(success=False)
+                if is_quota_error(e) and attempt < self.max_quota_retries:
+                    attempt += 1
+                    self.metrics.add_retry(api_name)
+                    self.report_quota_error()
+                    continue
+                raise
+            self.metrics.observe(api_name, time.perf_counter() - start)
+            self.release(success=True)
+            return result
+
+    def stats(self):
+        """返回当前并发数、累计限流等待秒数和频率超限次数。"""
+        with self._lock:
+            return {
+                'concurrency': self._concurrency.value,
+                'throttle_wait': self._throttle_wait.value,
+                'quota_errors': self._quota_errors.value,
+            }
@@ -0,0 +1,122 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+# 运行清单保存目录，Clear_data.py 只清理 data 目录下的 CSV 文件
+MANIFEST_DIR = './data/state'
+
+# 在运行清单中记录进度的流水线阶段，按执行顺序排列；基础数据阶段以文件是否存在判断，不记入清单
+STAGES = ['fetch', 'generate', 'upload', 'bar_store', 'adjust']
+
+# 并行运行的阶段各自持有清单对象，保存时在锁内重新读取文件，只覆盖本对象修改过的阶段
+save_lock = threading.Lock()
+
+
+class RunManifest:
+    """
+    单日流水线的运行清单，记录每个阶段是否完成以及阶段内已完成的工作单元
+    （已落盘的股票代码/交易日、已生成的周期、已提交的上传批次），
+    重新运行时各阶段据此跳过已完成的部分，从失败的工作单元继续。
+
+    清单以 JSON 保存在 data/state/run_manifest_{日期}.json，每次更新先写临时文件再替换，中断时不会损坏。
+    """
+
+    def __init__(self, run_date=None, manifest_dir=MANIFEST_DIR):
+        """
+        :param run_date: 运行日期，格式：YYYYMMDD，默认为今天
+        :param manifest_dir: 清单保存目录
+        """
+        self.run_date = run_date or datetime.today().strftime('%Y%m%d')
+        self.path = os.path.join(manifest_dir, f'run_manifest_{self.run_date}.json')
+        self.data = {'run_date': self.run_date, 'stages': {}}
+        if os.path.isfile(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def stage(self, name):
+        return self.data['stages'].setdefault(name, {'done': False, 'units': []})
+
+    def save(self, *names):
+        """
+        保存清单：文件中其他阶段的进度以文件为准，names 中的阶段以本对象为准。
+
+        :param names: 本次修改的阶段
+        """
+        with save_lock:
+            stages = {}
+            if os.path.isfile(self.path):
+                with open(self.path, encoding='utf-8') as f:
+                    stages = json.load(f)['stages']
+            for name in names:
+                if name in self.data['stages']:
+                    stages[name] = self.data['stages'][name]
+                else:
+                    stages.pop(name, None)
+            self.data['stages'] = stages
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def is_done(self, name):
+        """阶段是否已完成。"""
+        return self.data['stages'].get(name, {}).get('done', False)
+
+    def done_units(self, name):
+        """返回阶段内已完成的工作单元集合。"""
+        return set(self.data['stages'].get(name, {}).get('units', []))
+
+    def add_units(self, name, units):
+        """记录阶段内新完成的工作单元并立即保存。"""
+        stage = self.stage(name)
+        known = set(stage['units'])
+        stage['units'].extend(unit for unit in units if unit not in known)
+        stage['updated_at'] = datetime.now().isoformat(timespec='seconds')
+        self.save(name)
+
+    def mark_done(self, name, **info):
+        """
+        标记阶段完成。
+
+        :param info: 需要一并记录的附加信息，如行数、耗时
+        """
+        stage = self.stage(name)
+        stage.update(info)
+        stage['done'] = True
+        stage['updated_at'] = datetime.now().isoformat(timespec='seconds')
+        self.save(name)
+
+    def check_params(self, name, **params):
+        """
+        核对阶段的工作单元划分参数（如总行数、批次大小），与已记录的不一致时清空该阶段的进度。
+        """
+        stage = self.stage(name)
+        if stage.get('params') != params:
+            stage.update({'done': False, 'units': [], 'params': params})
+            self.save(name)
+
+    def reset(self, *names):
+        """清空指定阶段的进度，上游数据重新生成后调用。"""
+        for name in names:
+            self.data['stages'].pop(name, None)
+        self.save(*names)
+
+    def summary(self):
+        """返回各阶段的完成情况描述，STAGES 之外已记录的阶段（如复权数据的上传 upload:stock_data_qfq）排在最后。"""
+        parts = []
+        for name in STAGES + [name for name in self.data['stages'] if name not in STAGES]:
+            stage = self.data['stages'].get(name)
+            if stage is None:
+                parts.append(f"{name}: 未开始")
+            elif stage['done']:
+                parts.append(f"{name}: 已完成")
+            else:
+                parts.append(f"{name}: 已完成 {len(stage['units'])} 个单元")
+        return '，'.join(parts)
+
+
+def dataset_run_date(name):
+    """从数据集名称 merged_stocks_data_{日期} 中取出运行日期。"""
+    return name.rsplit('_', 1)[-1]
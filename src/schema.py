@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+# 行情数据在内存中的统一列类型：代码和周期为分类编码，价格为 float32，交易日期为 datetime64
+CYCLES = ['daily', 'weekly', 'monthly', 'quarterly', 'yearly']
+CYCLE_DTYPE = pd.CategoricalDtype(CYCLES)
+
+# 价格类字段以 float32 存储；A 股价格为两位小数，需要 float64 时四舍五入到 2 位，与 CSV 解析结果一致
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'pre_close', 'change']
+PRICE_DECIMALS = 2
+
+DTYPES = {
+    'ts_code': 'category',
+    'cycle': CYCLE_DTYPE,
+    'open': 'float32',
+    'high': 'float32',
+    'low': 'float32',
+    'close': 'float32',
+    'pre_close': 'float32',
+    'change': 'float32',
+    'pct_chg': 'float64',
+    'vol': 'float64',
+    'amount': 'float64',
+}
+
+
+def normalize_trade_date(dates):
+    """
+    将 YYYYMMDD（整数或字符串）、YYYY-MM-DD 字符串或 datetime 类型的交易日期统一转换为 datetime64。
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    dates = dates.astype(str)
+    fmt = '%Y-%m-%d' if dates.str.contains('-', regex=False).any() else '%Y%m%d'
+    return pd.to_datetime(dates, format=fmt)
+
+
+def apply_schema(df, categorical=True):
+    """
+    按 DTYPES 就地转换 df 中已有的列，类型已一致的列不做复制。
+    ts_code 的类别按代码排序，按类别编码排序即按代码排序。
+
+    :param categorical: 为 False 时 ts_code、cycle 保持字符串，用于每只股票一行的小表
+    :return: df
+    """
+    for column, dtype in DTYPES.items():
+        if column not in df.columns:
+            continue
+        values = df[column]
+        if column in ('ts_code', 'cycle') and not categorical:
+            if values.dtype != object:
+                df[column] = values.astype(str)
+        elif column == 'ts_code':
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[column] = values.astype('category')
+            elif not values.cat.categories.is_monotonic_increasing:
+                df[column] = values.cat.set_categories(values.cat.categories.sort_values())
+        elif column == 'cycle':
+            # 无序分类类型只比较类别集合，需确认类别顺序与 CYCLES 一致，编码才能按 CYCLES 下标使用
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[column] = values.astype(dtype)
+            elif list(values.cat.categories) != CYCLES:
+                df[column] = values.cat.set_categories(CYCLES)
+        elif values.dtype != dtype:
+            df[column] = values.astype(dtype)
+    if 'trade_date' in df.columns and df['trade_date'].dtype != 'datetime64[ns]':
+        df['trade_date'] = normalize_trade_date(df['trade_date']).astype('datetime64[ns]')
+    return df
+
+
+def read_csv(path, categorical=True, **kwargs):
+    """按 DTYPES 读取 CSV，交易日期解析为 datetime64。"""
+    columns = pd.read_csv(path, nrows=0).columns
+    dtype = {column: dtype for column, dtype in DTYPES.items() if column in columns}
+    if not categorical:
+        dtype.update({column: str for column in ('ts_code', 'cycle') if column in columns})
+    return apply_schema(pd.read_csv(path, dtype=dtype, **kwargs), categorical)
+
+
+def cycle_column(cycle, length):
+    """长度为 length、值全部为 cycle 的周期列。"""
+    return pd.Categorical.from_codes(np.full(length, CYCLES.index(cycle), dtype='int8'), dtype=CYCLE_DTYPE)
+
+
+def float64_values(df, columns):
+    """返回 columns 的 float64 数组，float32 价格字段四舍五入到 2 位，与写入前的数值一致。"""
+    values = df[columns].to_numpy(dtype='float64')
+    for i, column in enumerate(columns):
+        if df[column].dtype == np.float32:
+            values[:, i] = values[:, i].round(PRICE_DECIMALS)
+    return values
+
+
+def concat(frames):
+    """
+    拼接多个数据框，ts_code 先统一为同一组类别，避免拼接后退化为 object 字符串。
+    会修改传入数据框的 ts_code 列。
+    """
+    frames = [frame for frame in frames if frame is not None]
+    if all(isinstance(frame['ts_code'].dtype, pd.CategoricalDtype) for frame in frames if 'ts_code' in frame):
+        categories = pd.Index(sorted(set().union(*(frame['ts_code'].cat.categories for frame in frames if 'ts_code' in frame))))
+        for frame in frames:
+            if 'ts_code' in frame and not frame['ts_code'].cat.categories.equals(categories):
+                frame['ts_code'] = frame['ts_code'].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def sort_rows(df, by):
+    """
+    按 by 排序：分类列取类别编码、交易日期取天数，组合成一个整数键排序，不生成字符串；
+    已经有序时直接返回 df，不做复制。by 中的列需为 apply_schema 后的类型。
+    """
+    key = np.zeros(len(df), dtype='int64')
+    for column in by:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.to_numpy().astype('int64')
+            size = len(values.cat.categories)
+        else:
+            days = values.to_numpy().astype('datetime64[D]').astype('int64')
+            low = days.min() if len(days) else 0
+            codes = days - low
+            size = int(codes.max()) + 1 if len(codes) else 1
+        key = key * size + codes
+    if len(key) < 2 or (key[1:] >= key[:-1]).all():
+        return df if isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1 else df.reset_index(drop=True)
+    df = df.take(np.argsort(key, kind='stable'))
+    df.index = pd.RangeIndex(len(df))
+    return df
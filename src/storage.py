@@ -0,0 +1,383 @@
+import os
+import glob
+import json
+import uuid
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+import schema
+from schema import normalize_trade_date
+
+# 加载.env环境变量
+load_dotenv()
+
+# 存储格式：parquet（按 cycle、year 分区的列式存储）或 csv（与旧版一致的单个 CSV 文件）
+STORAGE_FORMAT = os.getenv('STORAGE_FORMAT', 'parquet')
+
+# 写出 parquet 后是否额外导出一份 CSV
+STORAGE_EXPORT_CSV = os.getenv('STORAGE_EXPORT_CSV', '0') == '1'
+
+DATA_DIR = './data'
+
+# 流式写入时缓冲多少行后落盘一次
+SINK_FLUSH_ROWS = int(os.getenv('STORAGE_SINK_FLUSH_ROWS', '500000'))
+
+# 已知字段的列式存储类型，其他字段按 pandas 类型推断
+COLUMN_TYPES = {
+    'ts_code': pa.dictionary(pa.int32(), pa.string()),
+    'trade_date': pa.date32(),
+    'open': pa.float32(),
+    'high': pa.float32(),
+    'low': pa.float32(),
+    'close': pa.float32(),
+    'pre_close': pa.float32(),
+    'change': pa.float32(),
+    'pct_chg': pa.float64(),
+    'vol': pa.float64(),
+    'amount': pa.float64(),
+    'cycle': pa.string(),
+    'year': pa.int16(),
+}
+
+
+class ParquetStorage:
+    """
+    列式存储：每个数据集为一个目录，按 cycle 和 year 分区，例如
+    data/merged_stocks_data_20240101/cycle=daily/year=2024/xxx.parquet
+    """
+
+    fmt = 'parquet'
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name)
+
+    def exists(self, name):
+        return os.path.isdir(self.path(name)) and bool(glob.glob(os.path.join(self.path(name), 'cycle=*')))
+
+    def cycles(self, name):
+        """返回数据集中已有的周期标签。"""
+        return sorted(os.path.basename(p).split('=', 1)[1] for p in glob.glob(os.path.join(self.path(name), 'cycle=*')))
+
+    def to_table(self, df):
+        """按 COLUMN_TYPES 逐列构建带类型的 Arrow 表，并补充分区列，不复制 df。"""
+        arrays = {}
+        for column in df.columns:
+            values = df[column]
+            if column == 'trade_date':
+                values = normalize_trade_date(values)
+                arrays[column] = pa.Array.from_pandas(values).cast(pa.date32())
+            elif column == 'cycle':
+                arrays[column] = pa.Array.from_pandas(values).cast(pa.string())
+            elif column == 'ts_code' and not isinstance(values.dtype, pd.CategoricalDtype):
+                arrays[column] = pa.Array.from_pandas(values.astype('category')).cast(COLUMN_TYPES[column])
+            elif column in COLUMN_TYPES:
+                arrays[column] = pa.Array.from_pandas(values).cast(COLUMN_TYPES[column])
+            else:
+                arrays[column] = pa.Array.from_pandas(values)
+        if 'cycle' not in arrays:
+            arrays['cycle'] = pa.array(np.full(len(df), 'daily', dtype=object), pa.string())
+        arrays['year'] = pc.year(arrays['trade_date']).cast(pa.int16())
+        return pa.table(arrays)
+
+    def write(self, df, name):
+        """覆盖写入整个数据集。"""
+        if os.path.isdir(self.path(name)):
+            shutil.rmtree(self.path(name))
+        self.append(df, name)
+
+    def append(self, df, name):
+        """写入 df 涉及的 (cycle, year) 分区，已存在的同名分区会被替换，其他分区保持不变。"""
+        pq.write_to_dataset(self.to_table(df), self.path(name), partition_cols=['cycle', 'year'],
+                            existing_data_behavior='delete_matching')
+
+    def insert(self, df, name, basename=None):
+        """
+        以新文件写入 df，不修改已有分区中的数据。
+
+        :param basename: 文件名前缀，默认随机生成；指定时再次写入会覆盖上次同名的文件
+        """
+        pq.write_to_dataset(self.to_table(df), self.path(name), partition_cols=['cycle', 'year'],
+                            basename_template=f'{basename or uuid.uuid4().hex}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore')
+
+    def delete_cycles(self, name, cycles):
+        """删除指定周期的全部分区。"""
+        for cycle in cycles:
+            shutil.rmtree(os.path.join(self.path(name), f'cycle={cycle}'), ignore_errors=True)
+
+    def open_sink(self, name, flush_rows=None):
+        """打开流式写入器，存在未完成的写入时从中断处继续。"""
+        return ParquetSink(self, name, flush_rows or SINK_FLUSH_ROWS)
+
+    def read(self, name, cycles=None, columns=None, codes=None):
+        """
+        读取数据集。
+
+        :param cycles: 只读取指定周期的分区，默认读取全部
+        :param columns: 只读取指定列，默认读取全部
+        :param codes: 只读取指定股票代码的行，默认读取全部
+        :return: 按 schema.DTYPES 转换类型的 DataFrame：ts_code、cycle 为 category，trade_date 为 datetime64，价格为 float32
+        """
+        filters = [('cycle', 'in', list(cycles))] if cycles else []
+        if codes is not None:
+            filters.append(('ts_code', 'in', list(codes)))
+        read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ['cycle']))
+        table = pq.read_table(self.path(name), columns=read_columns, filters=filters or None,
+                              partitioning='hive')
+        if 'year' in table.column_names:
+            table = table.drop(['year'])
+        if columns is not None:
+            table = table.select(list(columns))
+        df = table.to_pandas(date_as_object=False, self_destruct=True)
+        del table
+        return schema.apply_schema(df)
+
+    def delete(self, name):
+        if os.path.isdir(self.path(name)):
+            shutil.rmtree(self.path(name))
+
+
+class CsvStorage:
+    """CSV 存储：每个数据集为 data 目录下的一个 CSV 文件，与旧版文件格式一致。"""
+
+    fmt = 'csv'
+
+    def __init__(self, data_dir=DATA_DIR):
+        self.data_dir = data_dir
+
+    def path(self, name):
+        return os.path.join(self.data_dir, f'{name}.csv')
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def cycles(self, name):
+        """返回数据集中已有的周期标签，没有 cycle 列的文件只包含日线。"""
+        columns = pd.read_csv(self.path(name), nrows=0).columns
+        if 'cycle' not in columns:
+            return ['daily']
+        return sorted(pd.read_csv(self.path(name), usecols=['cycle'])['cycle'].unique())
+
+    def write(self, df, name):
+        df.to_csv(self.path(name), index=False)
+
+    def append(self, df, name):
+        """追加写入；列不一致时读取原文件合并后重写。"""
+        if not self.exists(name):
+            self.write(df, name)
+            return
+        existing_columns = list(pd.read_csv(self.path(name), nrows=0).columns)
+        if existing_columns == list(df.columns):
+            df.to_csv(self.path(name), mode='a', header=False, index=False)
+        else:
+            self.write(pd.concat([self.read(name), df], ignore_index=True), name)
+
+    def insert(self, df, name, basename=None):
+        """追加写入 df。"""
+        self.append(df, name)
+
+    def open_sink(self, name, flush_rows=None):
+        """打开流式写入器，存在未完成的写入时从中断处继续。"""
+        return CsvSink(self, name, flush_rows or SINK_FLUSH_ROWS)
+
+    def read(self, name, cycles=None, columns=None, codes=None):
+        df = schema.read_csv(self.path(name), usecols=columns)
+        if cycles and 'cycle' in df.columns:
+            df = df[df['cycle'].isin(cycles)]
+        if codes is not None:
+            df = df[df['ts_code'].isin(codes)]
+        return df
+
+    def delete(self, name):
+        if self.exists(name):
+            os.remove(self.path(name))
+
+
+class StreamingSink:
+    """
+    流式写入器基类：每只股票的数据到达后先进入缓冲区，累计 flush_rows 行后落盘，内存占用与股票数量、历史长度无关。
+
+    每次落盘后在进度文件中追加一行，记录本次落盘包含的键（股票代码等），
+    崩溃后重新打开时丢弃未记录的部分数据，并通过 done_keys 跳过已完成的键。
+    全部写入完成后调用 close，未完成的数据集才会以正式名称出现。
+    """
+
+    def __init__(self, flush_rows):
+        self.flush_rows = flush_rows
+        self.buffer = []
+        self.buffered_rows = 0
+        self.buffered_keys = []
+        self.rows_written = 0
+        self.done_keys = set()
+        # 每次落盘并记录进度后调用，参数为本次落盘的键列表
+        self.on_flush = None
+        for entry in self.read_progress():
+            self.done_keys.update(entry['keys'])
+
+    def read_progress(self):
+        if not os.path.isfile(self.progress_file):
+            return []
+        entries = []
+        with open(self.progress_file, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # 最后一行可能在写入时中断
+                    break
+        return entries
+
+    def record_progress(self, entry):
+        with open(self.progress_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def write(self, df, keys):
+        """
+        写入一批数据。
+
+        :param df: DataFrame，可为 None 表示该键没有数据
+        :param keys: 本批数据对应的键列表，落盘后记为已完成
+        """
+        if df is not None and not df.empty:
+            self.buffer.append(df)
+            self.buffered_rows += len(df)
+        self.buffered_keys.extend(keys)
+        if self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer and not self.buffered_keys:
+            return
+        rows = self.write_part(pd.concat(self.buffer, ignore_index=True) if self.buffer else None)
+        self.rows_written += rows
+        self.done_keys.update(self.buffered_keys)
+        if self.on_flush is not None:
+            self.on_flush(self.buffered_keys)
+        self.buffer, self.buffered_rows, self.buffered_keys = [], 0, []
+
+    def close(self):
+        """落盘剩余数据并发布数据集，返回是否写入了数据。"""
+        self.flush()
+        return self.publish()
+
+
+class ParquetSink(StreamingSink):
+    """写入 {name}.partial 目录，每次落盘生成一组分区文件，完成后重命名为正式数据集。"""
+
+    def __init__(self, storage, name, flush_rows):
+        self.storage = storage
+        self.name = name
+        self.partial_dir = storage.path(name) + '.partial'
+        self.progress_file = os.path.join(self.partial_dir, '_progress.jsonl')
+        os.makedirs(self.partial_dir, exist_ok=True)
+        super().__init__(flush_rows)
+        entries = self.read_progress()
+        self.rows_written = sum(entry['rows'] for entry in entries)
+        self.part = max((entry['part'] for entry in entries), default=-1) + 1
+
+        # 删除进度文件中没有记录的分区文件（落盘后、记录进度前崩溃）
+        committed = {f"part-{entry['part']:05d}-" for entry in entries}
+        for path in glob.glob(os.path.join(self.partial_dir, 'cycle=*', 'year=*', 'part-*.parquet')):
+            if os.path.basename(path)[:11] not in committed:
+                os.remove(path)
+
+    def write_part(self, df):
+        rows = 0
+        if df is not None:
+            pq.write_to_dataset(self.storage.to_table(df), self.partial_dir, partition_cols=['cycle', 'year'],
+                                basename_template=f'part-{self.part:05d}-{{i}}.parquet',
+                                existing_data_behavior='overwrite_or_ignore')
+            rows = len(df)
+        self.record_progress({'part': self.part, 'rows': rows, 'keys': self.buffered_keys})
+        self.part += 1
+        return rows
+
+    def publish(self):
+        if self.rows_written == 0:
+            shutil.rmtree(self.partial_dir)
+            return False
+        self.storage.delete(self.name)
+        os.replace(self.partial_dir, self.storage.path(self.name))
+        os.remove(os.path.join(self.storage.path(self.name), '_progress.jsonl'))
+        return True
+
+
+class CsvSink(StreamingSink):
+    """追加写入 {name}.csv.partial，进度文件记录每次落盘后的文件长度，恢复时截断到最后一次完整落盘的位置。"""
+
+    def __init__(self, storage, name, flush_rows):
+        self.storage = storage
+        self.name = name
+        self.partial_file = storage.path(name) + '.partial'
+        self.progress_file = self.partial_file + '.progress.jsonl'
+        super().__init__(flush_rows)
+        entries = self.read_progress()
+        self.rows_written = sum(entry['rows'] for entry in entries)
+        offset = entries[-1]['offset'] if entries else 0
+        self.columns = entries[-1].get('columns') if entries else None
+        with open(self.partial_file, 'ab') as f:
+            f.truncate(offset)
+
+    def write_part(self, df):
+        rows = 0
+        if df is not None:
+            if self.columns is None:
+                self.columns = list(df.columns)
+                df.to_csv(self.partial_file, mode='a', header=True, index=False)
+            else:
+                df[self.columns].to_csv(self.partial_file, mode='a', header=False, index=False)
+            rows = len(df)
+        self.record_progress({'offset': os.path.getsize(self.partial_file), 'rows': rows,
+                              'columns': self.columns, 'keys': self.buffered_keys})
+        return rows
+
+    def publish(self):
+        if self.rows_written == 0:
+            os.remove(self.partial_file)
+        else:
+            os.replace(self.partial_file, self.storage.path(self.name))
+        os.remove(self.progress_file)
+        return self.rows_written > 0
+
+
+def get_storage(fmt=None, data_dir=DATA_DIR):
+    """按格式返回存储后端，默认读取环境变量 STORAGE_FORMAT。"""
+    fmt = fmt or STORAGE_FORMAT
+    if fmt == 'csv':
+        return CsvStorage(data_dir)
+    if fmt == 'parquet':
+        return ParquetStorage(data_dir)
+    raise ValueError(f'不支持的存储格式：{fmt}')
+
+
+def latest_dataset(prefix, storage=None):
+    """返回 data 目录下以 prefix 开头、日期后缀最大的数据集名称，不存在时返回 None。"""
+    storage = storage or get_storage()
+    suffix = '.csv' if storage.fmt == 'csv' else ''
+    paths = [p for p in glob.glob(os.path.join(storage.data_dir, f'{prefix}*{suffix}'))
+             if (storage.fmt == 'csv') == os.path.isfile(p) and not p.endswith('.partial')]
+    if not paths:
+        return None
+    latest = max(paths, key=lambda x: os.path.basename(x).split('_')[-1].replace('.csv', ''))
+    return os.path.basename(latest)[:len(os.path.basename(latest)) - len(suffix)]
+
+
+def export_csv(name, storage=None):
+    """把数据集导出为 data/{name}.csv。"""
+    storage = storage or get_storage()
+    csv_storage = CsvStorage(storage.data_dir)
+    if storage.fmt == 'csv':
+        return csv_storage.path(name)
+    df = storage.read(name)
+    df['trade_date'] = df['trade_date'].dt.strftime('%Y-%m-%d')
+    csv_storage.write(df, name)
+    return csv_storage.path(name)
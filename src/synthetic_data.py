@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+# 代码前两位、交易所及其占比，覆盖主板、创业板和科创板（清洗阶段会过滤 68 开头的代码）
+CODE_PREFIXES = [('00', 'SZ', 0.35), ('30', 'SZ', 0.2), ('60', 'SH', 0.38), ('68', 'SH', 0.07)]
+
+# 每年固定休市的月日（元旦、劳动节、国庆），春节按每年 2 月上旬的 5 个交易日近似
+FIXED_HOLIDAYS = ['01-01', '05-01', '05-02', '05-03', '10-01', '10-02', '10-03', '10-04', '10-05', '10-06', '10-07']
+
+
+def trade_days(start_date, end_date):
+    """近似的 A 股交易日：工作日去掉固定节假日和春节假期。"""
+    days = pd.bdate_range(start_date, end_date)
+    month_day = days.strftime('%m-%d')
+    spring = (days.month == 2) & (days.day >= 5) & (days.day <= 11)
+    return days[~month_day.isin(FIXED_HOLIDAYS) & ~spring]
+
+
+def make_codes(num_stocks, rng):
+    """按 CODE_PREFIXES 的占比生成不重复的股票代码，同一前缀下按顺序编号。"""
+    weights = np.array([weight for _, _, weight in CODE_PREFIXES])
+    choice = rng.choice(len(CODE_PREFIXES), num_stocks, p=weights / weights.sum())
+    counters = [0] * len(CODE_PREFIXES)
+    codes = []
+    for k in choice:
+        prefix, exchange, _ = CODE_PREFIXES[k]
+        codes.append(f'{prefix}{counters[k]:04d}.{exchange}')
+        counters[k] += 1
+    return codes
+
+
+def make_daily(num_stocks=500, years=5, end_date=None, seed=0, suspension_rate=0.01, late_listing_rate=0.3, delisting_rate=0.03):
+    """
+    生成与 pro.daily 返回格式一致的合成日线数据：每只股票按交易日倒序，trade_date 为 YYYYMMDD 字符串。
+
+    价格为带涨跌停限制的对数随机游走，保留两位小数；部分股票在区间中途上市或退市，
+    每只股票随机出现单日停牌和连续数十个交易日的长期停牌。
+
+    :param num_stocks: 股票数量
+    :param years: 历史年数
+    :param end_date: 最后一个交易日之前的日期，默认今天
+    :param seed: 随机种子，相同参数生成相同数据
+    :param suspension_rate: 单日停牌的概率
+    :param late_listing_rate: 在区间中途上市的股票比例
+    :param delisting_rate: 在区间中途退市的股票比例
+    :return: DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    end = pd.Timestamp(end_date or datetime.now().strftime('%Y%m%d'))
+    days = trade_days(end - pd.DateOffset(years=years), end)
+    n_days = len(days)
+    day_strings = days.strftime('%Y%m%d').to_numpy()
+
+    frames = []
+    for code in make_codes(num_stocks, rng):
+        first = rng.integers(1, n_days - 20) if rng.random() < late_listing_rate else 0
+        last = rng.integers(first + 20, n_days) if rng.random() < delisting_rate else n_days
+        mask = np.zeros(n_days, dtype=bool)
+        mask[first:last] = True
+        mask &= rng.random(n_days) >= suspension_rate
+        if rng.random() < 0.2:
+            # 长期停牌
+            start = rng.integers(first, last)
+            mask[start:start + rng.integers(20, 120)] = False
+        index = np.flatnonzero(mask)
+        n = len(index)
+        if n == 0:
+            continue
+
+        # 对数收益率截断在 ±10% 涨跌停以内
+        returns = np.clip(rng.normal(0.0002, 0.025, n), -0.0953, 0.0953)
+        close = np.round(rng.uniform(3, 80) * np.exp(np.cumsum(returns)), 2)
+        close = np.maximum(close, 0.01)
+        pre_close = np.r_[np.round(close[0] / np.exp(returns[0]), 2), close[:-1]]
+        open_ = np.round(pre_close * np.exp(rng.normal(0, 0.01, n)), 2)
+        high = np.round(np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.01, n))), 2)
+        low = np.round(np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.01, n))), 2)
+        vol = np.round(rng.lognormal(11, 1, n), 2)
+        frame = pd.DataFrame({
+            'ts_code': code,
+            'trade_date': day_strings[index],
+            'open': open_,
+            'high': high,
+            'low': low,
+            'close': close,
+            'pre_close': pre_close,
+            'change': np.round(close - pre_close, 2),
+            'pct_chg': np.round((close - pre_close) / pre_close * 100, 4),
+            'vol': vol,
+            'amount': np.round(vol * close / 10, 3),
+        })
+        frames.append(frame.iloc[::-1])
+    return pd.concat(frames, ignore_index=True)
+
+
+def make_base_frames(daily, seed=0):
+    """
+    按合成日线生成基础数据接口的返回结果，键与 Pull_base_data.BASE_DATA_FETCHERS 一致，供清洗阶段使用。
+    部分股票的名称带 ST、地区为空，部分股票缺少公司信息或曾用名。
+    """
+    rng = np.random.default_rng(seed)
+    codes = daily['ts_code'].drop_duplicates().to_numpy()
+    n = len(codes)
+    latest_date = daily['trade_date'].max()
+    names = np.where(rng.random(n) < 0.04, [f'ST股票{i}' for i in range(n)], [f'股票{i}' for i in range(n)])
+    areas = np.where(rng.random(n) < 0.02, None, rng.choice(['北京', '上海', '深圳', '浙江', '江苏'], n))
+    industries = rng.choice(['银行', '医药', '软件服务', '电气设备', '食品'], n)
+    list_dates = daily.groupby('ts_code', sort=False)['trade_date'].min().reindex(codes).to_numpy()
+
+    def sample(fraction):
+        return np.sort(rng.choice(n, int(n * fraction), replace=False))
+
+    bak = pd.DataFrame({
+        'trade_date': latest_date, 'ts_code': codes, 'industry': industries, 'area': areas,
+        'pe': np.round(rng.uniform(5, 80, n), 2), 'float_share': np.round(rng.uniform(1, 50, n), 2),
+        'total_share': np.round(rng.uniform(50, 100, n), 2), 'total_assets': np.round(rng.uniform(1, 500, n), 2),
+        'liquid_assets': np.round(rng.uniform(1, 200, n), 2), 'fixed_assets': np.round(rng.uniform(1, 100, n), 2),
+        'reserved': np.round(rng.uniform(0, 10, n), 2), 'eps': np.round(rng.normal(0.5, 0.5, n), 2),
+        'bvps': np.round(rng.uniform(1, 20, n), 2), 'pb': np.round(rng.uniform(0.5, 10, n), 2),
+        'list_date': list_dates, 'undp': np.round(rng.uniform(0, 5, n), 2), 'per_undp': np.round(rng.uniform(0, 3, n), 2),
+        'rev_yoy': np.round(rng.normal(10, 20, n), 2), 'profit_yoy': np.round(rng.normal(10, 30, n), 2),
+        'gpr': np.round(rng.uniform(0, 60, n), 2), 'npr': np.round(rng.uniform(-10, 30, n), 2),
+        'holder_num': rng.integers(1000, 500000, n), 'name': names,
+    })
+    basic = pd.DataFrame({
+        'ts_code': codes, 'symbol': [code[:6] for code in codes], 'name': names, 'area': areas, 'industry': industries,
+        'market': '主板', 'list_date': list_dates, 'act_name': '实际控制人', 'act_ent_type': '民营企业',
+        'fullname': [f'股票{i}股份有限公司' for i in range(n)], 'enname': 'Synthetic Co., Ltd.',
+        'exchange': [code[-2:] for code in codes], 'is_hs': 'N',
+    })
+    company = sample(0.95)
+    stock_company = pd.DataFrame({
+        'ts_code': codes[company], 'chairman': '董事长', 'manager': '总经理', 'reg_capital': np.round(rng.uniform(1e4, 1e6, len(company)), 2),
+        'province': '北京', 'city': '北京市', 'website': 'www.example.com', 'email': 'ir@example.com',
+        'business_scope': '经营范围', 'employees': rng.integers(50, 50000, len(company)), 'introduction': '公司简介',
+        'setup_date': '20000101', 'main_business': '主营业务',
+    })
+    renamed = sample(0.5)
+    namechange = pd.DataFrame({
+        'ts_code': codes[renamed], 'name': names[renamed], 'start_date': list_dates[renamed], 'end_date': None,
+        'ann_date': list_dates[renamed], 'change_reason': '改名',
+    })
+    ipo = sample(0.1)
+    new_share = pd.DataFrame({
+        'ts_code': codes[ipo], 'sub_code': [code[:6] for code in codes[ipo]], 'name': names[ipo],
+        'ipo_date': list_dates[ipo], 'issue_date': list_dates[ipo], 'amount': np.round(rng.uniform(1e3, 1e5, len(ipo)), 2),
+    })
+    latest = daily[daily['trade_date'] == latest_date]
+    return {
+        '日线行情': latest.reset_index(drop=True),
+        '上市公司基本信息.csv': stock_company,
+        '股票曾用名.csv': namechange,
+        'IPO新股上市.csv': new_share,
+        '股票列表.csv': basic,
+        '备用列表.csv': bak,
+    }
@@ -0,0 +1,120 @@
+import os
+import time
+import bisect
+from datetime import datetime, timedelta
+import pandas as pd
+
+# 本地缓存的交易日历，记录每个自然日是否开市
+CALENDAR_FILE = './data/state/trade_calendar.csv'
+
+# 日历的起始日期与交易所，与日线拉取的起始日期一致
+CALENDAR_START = '20100101'
+CALENDAR_EXCHANGE = 'SSE'
+
+# 本地日历超过该天数未更新时重新拉取（交易所通常在年底前公布次年的休市安排）
+CALENDAR_REFRESH_DAYS = int(os.getenv('TRADE_CALENDAR_REFRESH_DAYS', '30'))
+
+# 交易日当天的日线在该时刻（时）之后发布，此前运行时以上一个交易日为目标交易日
+DAILY_DATA_READY_HOUR = int(os.getenv('DAILY_DATA_READY_HOUR', '16'))
+
+
+def next_day(date_str):
+    """返回 YYYYMMDD 日期的下一自然日。"""
+    return (datetime.strptime(date_str, '%Y%m%d') + timedelta(days=1)).strftime('%Y%m%d')
+
+
+class TradeCalendar:
+    """
+    交易日历：判断某天是否开市、查找最近的交易日、列出区间内的交易日，日期均为 YYYYMMDD 字符串。
+    """
+
+    def __init__(self, calendar):
+        """
+        :param calendar: 包含 cal_date、is_open 两列的 DataFrame，覆盖的自然日需连续
+        """
+        calendar = calendar.astype({'cal_date': str, 'is_open': int}).sort_values('cal_date')
+        self.first_date = calendar['cal_date'].iloc[0]
+        self.last_date = calendar['cal_date'].iloc[-1]
+        self.open_days = calendar.loc[calendar['is_open'] == 1, 'cal_date'].tolist()
+        self._open_set = set(self.open_days)
+
+    def covers(self, date):
+        return self.first_date <= date <= self.last_date
+
+    def is_open(self, date):
+        """date 是否为交易日。"""
+        return date in self._open_set
+
+    def latest_trade_date(self, date):
+        """不晚于 date 的最近一个交易日，没有时返回 None。"""
+        i = bisect.bisect_right(self.open_days, date)
+        return self.open_days[i - 1] if i else None
+
+    def target_trade_date(self, now=None):
+        """
+        本次运行的目标交易日：不晚于今天的最近一个交易日；今天是交易日但当天日线尚未发布时为上一个交易日，
+        如凌晨补跑前一交易日的任务。
+        """
+        now = now or datetime.now()
+        today = now.strftime('%Y%m%d')
+        if self.is_open(today) and now.hour < DAILY_DATA_READY_HOUR:
+            return self.previous_trade_date(today)
+        return self.latest_trade_date(today)
+
+    def previous_trade_date(self, date):
+        """早于 date 的最近一个交易日，没有时返回 None。"""
+        i = bisect.bisect_left(self.open_days, date)
+        return self.open_days[i - 1] if i else None
+
+    def open_dates(self, start_date, end_date):
+        """[start_date, end_date] 区间内的交易日（升序）。"""
+        lo = bisect.bisect_left(self.open_days, start_date)
+        hi = bisect.bisect_right(self.open_days, end_date)
+        return self.open_days[lo:hi]
+
+
+def fetch_calendar(pro, start_date, end_date, call=None):
+    """
+    通过 trade_cal 接口拉取 [start_date, end_date] 的交易日历。
+
+    :param call: call(api_name, func, **params)，用于经过接口缓存和限流器调用，默认直接调用
+    """
+    params = dict(exchange=CALENDAR_EXCHANGE, start_date=start_date, end_date=end_date, fields='cal_date,is_open')
+    if call is not None:
+        return call('trade_cal', pro.trade_cal, **params)
+    return pro.trade_cal(**params)
+
+
+def load_calendar(pro=None, date=None, call=None, calendar_file=CALENDAR_FILE):
+    """
+    读取本地交易日历；文件不存在、不覆盖 date 所在年份或超过 CALENDAR_REFRESH_DAYS 天未更新时，
+    从接口重新拉取 CALENDAR_START 至 date 次年年底的日历并保存。拉取失败时继续使用本地日历。
+
+    :param pro: Tushare pro 接口，为 None 时只读取本地日历
+    :param date: 需要覆盖的日期，默认今天
+    :param call: 传给 fetch_calendar 的调用方式
+    :return: TradeCalendar，没有可用日历时返回 None
+    """
+    date = date or datetime.now().strftime('%Y%m%d')
+    calendar = None
+    if os.path.isfile(calendar_file):
+        calendar = TradeCalendar(pd.read_csv(calendar_file, dtype={'cal_date': str}))
+        fresh = time.time() - os.path.getmtime(calendar_file) < CALENDAR_REFRESH_DAYS * 86400
+        if fresh and calendar.covers(date):
+            return calendar
+    if pro is None:
+        return calendar
+
+    try:
+        df = fetch_calendar(pro, CALENDAR_START, f'{int(date[:4]) + 1}1231', call)
+    except Exception as e:
+        print(f"拉取交易日历失败：{e}")
+        return calendar
+    if df is None or df.empty:
+        return calendar
+    df = df[['cal_date', 'is_open']].drop_duplicates('cal_date')
+    os.makedirs(os.path.dirname(calendar_file), exist_ok=True)
+    tmp_file = calendar_file + '.tmp'
+    df.sort_values('cal_date').to_csv(tmp_file, index=False)
+    os.replace(tmp_file, calendar_file)
+    return TradeCalendar(df)
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+import schema
+from Adjust_price import adjust_daily, adjust_mode, update_latest_factors
+from Generating_periodic_data import CYCLE_FREQS, PERIODIC_COLUMNS, resample_all_cycles
+from synthetic_data import make_daily
+
+SPLIT = pd.Timestamp('2024-05-15')
+
+
+@pytest.fixture
+def daily():
+    daily = make_daily(6, years=1, end_date='20240628', seed=13, late_listing_rate=0, delisting_rate=0)
+    return schema.sort_rows(schema.apply_schema(daily[PERIODIC_COLUMNS]), ['ts_code', 'trade_date'])
+
+
+def make_factors(daily, ex_dates):
+    """每只股票的复权因子从 1.5 开始，ex_dates 中的股票在该日（除权除息）乘以 1.2。"""
+    factors = daily[['ts_code', 'trade_date']].copy()
+    factors['ts_code'] = factors['ts_code'].astype(str)
+    factors['adj_factor'] = 1.5
+    for code, date in ex_dates.items():
+        factors.loc[(factors['ts_code'] == code) & (factors['trade_date'] >= date), 'adj_factor'] *= 1.2
+    return factors.reset_index(drop=True)
+
+
+def expected_bars(daily, factors, mode):
+    """以全部日线和复权因子一次性计算的复权日线及周期K线；前复权以每只股票最后一个因子为基准。"""
+    factor = daily[['ts_code', 'trade_date']].astype({'ts_code': str}).merge(factors, on=['ts_code', 'trade_date'], how='left')
+    scale = factor['adj_factor'].to_numpy()
+    if mode == 'qfq':
+        scale = scale / factor.groupby('ts_code')['adj_factor'].transform('last').to_numpy()
+    adjusted = schema.apply_schema(adjust_daily(daily, scale))
+    return {'daily': adjusted, **resample_all_cycles(adjusted)}
+
+
+def as_frame(bars, since=None):
+    bars = bars[PERIODIC_COLUMNS].astype({'ts_code': str})
+    if since is not None:
+        bars = bars[bars['trade_date'] >= since]
+    return bars.sort_values(['ts_code', 'trade_date'], ignore_index=True)
+
+
+def run_two_days(daily, factors, mode):
+    """第一天计算分界日及之前的复权数据，第二天增量计算之后的日线，因子变化的股票从数据库历史重新计算。"""
+    first = daily[daily['trade_date'] <= SPLIT]
+    first_factors = factors[factors['trade_date'] <= SPLIT]
+    latest = update_latest_factors(None, first_factors)
+    codes = set(map(str, first['ts_code'].unique()))
+    _, state = adjust_mode(mode, first, first.iloc[0:0], first_factors, latest, codes, None)
+
+    second = daily[daily['trade_date'] > SPLIT]
+    new_latest = update_latest_factors(latest, factors[factors['trade_date'] > SPLIT])
+    changed = set(latest.index[~np.isclose(latest['adj_factor'], new_latest['adj_factor'].reindex(latest.index))])
+    recompute = changed if mode == 'qfq' else set()
+    # 数据库中早于当日数据集的日线，与 load_daily_history 返回的格式相同
+    history = schema.apply_schema(first[first['ts_code'].astype(str).isin(recompute)].astype({'ts_code': str}),
+                                  categorical=False)
+    bars, _ = adjust_mode(mode, second, history, factors, new_latest, recompute, state)
+    return bars, recompute
+
+
+@pytest.mark.parametrize('mode', ['qfq', 'hfq'])
+def test_incremental_adjustment_matches_full(daily, mode):
+    codes = sorted(map(str, daily['ts_code'].unique()))
+    # codes[0] 在第一天之前除权，codes[1] 在第二天的日线中除权
+    factors = make_factors(daily, {codes[0]: pd.Timestamp('2024-03-01'), codes[1]: pd.Timestamp('2024-06-03')})
+    bars, recompute = run_two_days(daily, factors, mode)
+    expected = expected_bars(daily, factors, mode)
+
+    # 前复权只重新计算最新因子变化的股票，后复权的历史不变
+    assert recompute == ({codes[1]} if mode == 'qfq' else set())
+    for cycle in ['daily'] + list(CYCLE_FREQS):
+        actual = as_frame(bars[cycle])
+        rewritten = actual['ts_code'].isin(recompute)
+        # 重新计算的股票写入全部历史，其余股票只写入包含新增日线的K线
+        pd.testing.assert_frame_equal(actual[rewritten].reset_index(drop=True),
+                                      as_frame(expected[cycle])[lambda df: df['ts_code'].isin(recompute)].reset_index(drop=True),
+                                      check_dtype=False, check_categorical=False, rtol=1e-6)
+        since = daily.loc[daily['trade_date'] > SPLIT, 'trade_date'].min()
+        pd.testing.assert_frame_equal(actual[~rewritten].reset_index(drop=True),
+                                      as_frame(expected[cycle], since)[lambda df: ~df['ts_code'].isin(recompute)].reset_index(drop=True),
+                                      check_dtype=False, check_categorical=False, rtol=1e-6)
@@ -0,0 +1,110 @@
+import json
+import asyncio
+import aiohttp
+import pandas as pd
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import async_fetcher
+from async_fetcher import AsyncTushareClient, fetch_stock_data_async
+from metrics import ApiMetrics
+from rate_limiter import RateLimiter
+
+FIELDS = ['ts_code', 'trade_date', 'close']
+
+
+def daily_reply(code):
+    return {'code': 0, 'msg': '', 'data': {'fields': FIELDS, 'items': [[code, '20240102', 10.0], [code, '20240103', 10.5]]}}
+
+
+async def serve(handler, scenario):
+    """启动模拟 Tushare 接口的本地服务，运行 scenario(url) 后关闭。"""
+    app = web.Application()
+    app.router.add_post('/', handler)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        return await scenario(str(server.make_url('/')))
+    finally:
+        await server.close()
+
+
+def make_limiter():
+    return RateLimiter(calls_per_minute=60000, max_concurrency=4, cooldown=0.01, metrics=ApiMetrics())
+
+
+def test_query_returns_frame():
+    async def handler(request):
+        body = await request.json()
+        return web.json_response(daily_reply(body['params']['ts_code']))
+
+    async def scenario(url):
+        async with aiohttp.ClientSession() as session:
+            return await AsyncTushareClient('token', session, url).query('daily', ts_code='000001.SZ')
+
+    df = asyncio.run(serve(handler, scenario))
+    assert list(df.columns) == FIELDS
+    assert df['ts_code'].tolist() == ['000001.SZ', '000001.SZ']
+
+
+def test_query_raises_on_http_error():
+    async def handler(request):
+        return web.Response(status=502, text='bad gateway')
+
+    async def scenario(url):
+        async with aiohttp.ClientSession() as session:
+            try:
+                await AsyncTushareClient('token', session, url).query('daily', ts_code='000001.SZ')
+            except Exception as e:
+                return str(e)
+
+    assert 'HTTP 502' in asyncio.run(serve(handler, scenario))
+
+
+def test_quota_error_is_retried_by_limiter():
+    calls = []
+
+    async def handler(request):
+        calls.append(1)
+        if len(calls) == 1:
+            return web.json_response({'code': 40203, 'msg': '抱歉，您每分钟最多访问该接口500次', 'data': None})
+        return web.json_response(daily_reply('000001.SZ'))
+
+    limiter = make_limiter()
+
+    async def scenario(url):
+        async with aiohttp.ClientSession() as session:
+            client = AsyncTushareClient('token', session, url)
+            return await limiter.call_async(client.query, 'daily', api_name='daily', ts_code='000001.SZ')
+
+    df = asyncio.run(serve(handler, scenario))
+    assert len(df) == 2
+    assert len(calls) == 2
+    assert limiter.stats()['quota_errors'] == 1
+
+
+def test_http_errors_are_retried_then_reported(monkeypatch):
+    monkeypatch.setattr(async_fetcher, 'retry_delay', lambda attempt: 0)
+    calls = {}
+
+    async def handler(request):
+        code = (await request.json())['params']['ts_code']
+        calls[code] = calls.get(code, 0) + 1
+        # 000001.SZ 第一次返回 500 后恢复，000002.SZ 一直返回 500，000003.SZ 没有数据
+        if code == '000002.SZ' or (code == '000001.SZ' and calls[code] == 1):
+            return web.Response(status=500)
+        if code == '000003.SZ':
+            return web.json_response({'code': 0, 'msg': '', 'data': {'fields': FIELDS, 'items': []}})
+        return web.json_response(daily_reply(code))
+
+    args_list = [(code, '20240101', '20240131', 'token') for code in ['000001.SZ', '000002.SZ', '000003.SZ']]
+
+    async def scenario(url):
+        return await fetch_stock_data_async(args_list, 4, limiter=make_limiter(), max_attempts=3, url=url)
+
+    all_data, successful, failures = asyncio.run(serve(handler, scenario))
+    assert successful == 1
+    assert pd.concat(all_data)['ts_code'].unique().tolist() == ['000001.SZ']
+    assert list(failures) == ['000002.SZ']
+    assert failures['000002.SZ']['attempts'] == 3
+    assert 'HTTP 500' in failures['000002.SZ']['error']
+    assert calls == {'000001.SZ': 2, '000002.SZ': 3, '000003.SZ': 1}
@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+import pytest
+import bar_store
+from bar_store import FIELDS, BarStore
+from Generating_periodic_data import CYCLE_FREQS, resample_all_cycles
+from synthetic_data import make_daily
+
+SPLITS = [pd.Timestamp('2024-04-17'), pd.Timestamp('2024-05-15')]
+CYCLES = ['daily'] + list(CYCLE_FREQS)
+
+
+def all_bars(daily):
+    """日线及一次性聚合的各周期K线，{周期: DataFrame}。"""
+    daily = daily.assign(trade_date=pd.to_datetime(daily['trade_date']))
+    bars = {'daily': daily}
+    bars.update(resample_all_cycles(daily))
+    return {cycle: frame.assign(cycle=cycle) for cycle, frame in bars.items()}
+
+
+def changed_bars(daily, since):
+    """since 之后的日线到达时需要写入的K线：新增的日线，以及包含这些日线的（新增或更新的）周期K线。"""
+    frames = all_bars(daily)
+    return pd.concat([frame[frame['trade_date'] >= since] for frame in frames.values()], ignore_index=True)
+
+
+def as_frame(bars):
+    frame = bars[['ts_code'] + list(FIELDS)].copy()
+    frame['ts_code'] = frame['ts_code'].astype(str)
+    frame['trade_date'] = frame['trade_date'].astype('datetime64[ns]')
+    for field, dtype in FIELDS.items():
+        if field != 'trade_date':
+            frame[field] = frame[field].astype(dtype)
+    return frame.sort_values(['ts_code', 'trade_date'], ignore_index=True)
+
+
+def assert_store_matches(store, expected):
+    for cycle in CYCLES:
+        pd.testing.assert_frame_equal(as_frame(store.read_cycle(cycle)), as_frame(expected[cycle]))
+        for code in expected['daily']['ts_code'].astype(str).unique()[:5]:
+            bars = store.load_frame(code, cycle)
+            rows = expected[cycle][expected[cycle]['ts_code'].astype(str) == code]
+            pd.testing.assert_frame_equal(as_frame(bars), as_frame(rows))
+
+
+@pytest.fixture
+def daily():
+    return make_daily(10, years=1, end_date='20240628', seed=9)
+
+
+@pytest.fixture
+def store(tmp_path, daily):
+    """以第一个分界日之前的日线构建基础段，再按分界日依次写入两个增量段。"""
+    store = BarStore(str(tmp_path / 'bar_store'))
+    dates = pd.to_datetime(daily['trade_date'])
+    base = all_bars(daily[dates < SPLITS[0]])
+    store.build(lambda cycle: base[cycle])
+    for i, since in enumerate(SPLITS):
+        until = SPLITS[i + 1] if i + 1 < len(SPLITS) else dates.max() + pd.Timedelta(days=1)
+        store.append(changed_bars(daily[dates < until], since))
+    return store
+
+
+def test_deltas_overlay_base(store, daily):
+    assert len(store.deltas()) == 2
+    assert_store_matches(store, all_bars(daily))
+
+
+def test_load_returns_views_after_compact(store, daily):
+    assert store.compact() == sum(len(frame) for frame in all_bars(daily).values())
+    assert store.deltas() == []
+    assert_store_matches(store, all_bars(daily))
+    code = str(daily['ts_code'].iloc[0])
+    # 合并后只有基础段，load 返回内存映射数组的切片
+    assert isinstance(store.load(code)['close'].base, np.memmap)
+
+
+def test_load_filters_dates(store, daily):
+    code = str(daily['ts_code'].iloc[0])
+    bars = store.load(code, start='20240501', end='2024-05-31')
+    rows = daily[(daily['ts_code'] == code) & (daily['trade_date'] >= '20240501') & (daily['trade_date'] <= '20240531')]
+    assert sorted(bars['trade_date'].astype(str)) == sorted(pd.to_datetime(rows['trade_date']).dt.strftime('%Y-%m-%d'))
+
+
+def test_too_many_deltas_are_compacted(tmp_path, daily, monkeypatch):
+    monkeypatch.setattr(bar_store, 'BAR_STORE_MAX_DELTAS', 1)
+    store = BarStore(str(tmp_path / 'bar_store'))
+    dates = pd.to_datetime(daily['trade_date'])
+    base = all_bars(daily[dates < SPLITS[0]])
+    store.build(lambda cycle: base[cycle])
+    store.append(changed_bars(daily[dates < SPLITS[1]], SPLITS[0]))
+    assert len(store.deltas()) == 1
+    store.append(changed_bars(daily, SPLITS[1]))
+    assert store.deltas() == []
+    assert_store_matches(store, all_bars(daily))
@@ -0,0 +1,15 @@
+import benchmark
+import Pull_merga_stock
+
+
+def test_benchmark_runs_on_tiny_universe(tmp_path):
+    # 拉取和分片生成都走进程池，子进程必须能拿到合成接口；数据库阶段连接不上时由 run_benchmark 自行跳过
+    result = benchmark.run_benchmark(stocks=6, years=1, workers=2, generate_workers=2, batch_size=500,
+                                     keep_dir=str(tmp_path))
+    stages = result['stages']
+    assert stages['fetch']['rows'] > 0
+    # 拉取阶段落盘的行数与合成日线一致，失败的股票不会进入数据集
+    assert stages['serialize_read']['rows'] == stages['fetch']['rows']
+    assert stages['generate']['rows'] == stages['fetch']['rows']
+    assert not list((tmp_path / 'data').glob('failed_stocks_*.json'))
+    assert Pull_merga_stock.api is None
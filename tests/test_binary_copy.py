@@ -0,0 +1,110 @@
+import io
+import struct
+from datetime import date
+import numpy as np
+import pandas as pd
+import pytest
+import schema
+import db_pool
+import db_schema
+from Upload_database import COLUMNS, FLOAT_COLUMNS, COPY_HEADER, COPY_TRAILER, encode_binary_copy, copy_batch
+
+
+def sample_batch():
+    rows = [
+        ['000001.SZ', '2024-01-02', 'daily', 10.5, 10.8, 10.3, 10.6, 10.4, 0.2, 1.92, 123456.0, 130000.5],
+        ['600000.SH', '2024-01-05', 'weekly', 7.1, 7.3, 7.0, 7.2, 7.05, 0.15, 2.13, 5e6, 3.6e6],
+        # 北交所代码长度不同，单独成组
+        ['830799.BJ', '2000-01-01', 'daily', 1.0, 1.0, 1.0, 1.0, 1.0, 0.0, 0.0, 1.0, 1.0],
+        # 含空值的行逐行编码
+        ['000002.SZ', '1999-12-31', 'yearly', np.nan, 20.0, 18.0, 19.5, np.nan, np.nan, np.nan, 0.0, 2.5e9],
+        ['000001.SZ', '2024-12-31', 'quarterly', 11.0, 12.0, 9.5, 11.8, 10.6, 1.2, 11.32, 9e7, 1.01e9],
+    ]
+    batch = pd.DataFrame(rows, columns=COLUMNS)
+    batch['trade_date'] = pd.to_datetime(batch['trade_date'])
+    return schema.apply_schema(batch)
+
+
+def decode_binary_copy(payload):
+    """按 PostgreSQL 二进制 COPY 格式逐行解析，返回 [(ts_code, trade_date, cycle, *浮点列)]。"""
+    assert payload.startswith(COPY_HEADER)
+    assert payload.endswith(COPY_TRAILER)
+    stream = io.BytesIO(payload[len(COPY_HEADER):-len(COPY_TRAILER)])
+    rows = []
+    while stream.tell() < len(payload) - len(COPY_HEADER) - len(COPY_TRAILER):
+        (count,) = struct.unpack('>h', stream.read(2))
+        assert count == len(COLUMNS)
+        fields = []
+        for _ in range(count):
+            (length,) = struct.unpack('>i', stream.read(4))
+            fields.append(None if length == -1 else stream.read(length))
+        ts_code, trade_date, cycle, *values = fields
+        (days,) = struct.unpack('>i', trade_date)
+        rows.append((ts_code.decode(), date(2000, 1, 1) + pd.Timedelta(days=days), cycle.decode(),
+                     *[np.nan if value is None else struct.unpack('>d', value)[0] for value in values]))
+    return rows
+
+
+def expected_rows(batch):
+    values = schema.float64_values(batch, FLOAT_COLUMNS)
+    return [(code, day.date(), cycle, *row) for code, day, cycle, row in
+            zip(batch['ts_code'].astype(str), batch['trade_date'], batch['cycle'].astype(str), values.tolist())]
+
+
+def same_rows(left, right):
+    key = lambda row: (row[0], row[1], row[2])
+    for a, b in zip(sorted(left, key=key), sorted(right, key=key)):
+        assert a[:3] == b[:3]
+        np.testing.assert_array_equal(np.array(a[3:], dtype='float64'), np.array(b[3:], dtype='float64'))
+    assert len(left) == len(right)
+
+
+def test_header_and_trailer():
+    payload = encode_binary_copy(sample_batch().iloc[0:0])
+    assert payload == b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8 + b'\xff\xff'
+
+
+def test_row_layout():
+    payload = encode_binary_copy(sample_batch().iloc[0:1])
+    body = payload[len(COPY_HEADER):-len(COPY_TRAILER)]
+    # 字段数、ts_code、日期（2000-01-01 起的天数）、cycle，之后 9 个长度为 8 的大端 float8
+    expected = struct.pack('>h', 12) + struct.pack('>i', 9) + b'000001.SZ' + struct.pack('>ii', 4, 8767) \
+        + struct.pack('>i', 5) + b'daily'
+    expected += b''.join(struct.pack('>id', 8, value) for value in [10.5, 10.8, 10.3, 10.6, 10.4, 0.2, 1.92, 123456.0, 130000.5])
+    assert body == expected
+
+
+def test_nulls_are_written_as_minus_one():
+    payload = encode_binary_copy(sample_batch().iloc[3:4])
+    (row,) = decode_binary_copy(payload)
+    # 2000-01-01 之前的日期为负的天数
+    assert row[:3] == ('000002.SZ', date(1999, 12, 31), 'yearly')
+    assert [column for column, value in zip(FLOAT_COLUMNS, row[3:]) if np.isnan(value)] == ['open', 'pre_close', 'change', 'pct_chg']
+    assert row[4:7] == (20.0, 18.0, 19.5) and row[10:] == (0.0, 2.5e9)
+
+
+def test_mixed_batch_round_trip():
+    batch = sample_batch()
+    same_rows(decode_binary_copy(encode_binary_copy(batch)), expected_rows(batch))
+
+
+@pytest.fixture
+def conn():
+    try:
+        conn = db_pool.connect(max_attempts=1)
+    except Exception as e:
+        pytest.skip(f"无法连接 PostgreSQL：{e}")
+    yield conn
+    conn.close()
+
+
+def test_postgres_round_trip(conn):
+    batch = sample_batch()
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE tmp_stock_data ({db_schema.COLUMNS_SQL});")
+        copy_batch(cursor, batch, 'binary')
+        cursor.execute(f"SELECT {', '.join(COLUMNS)} FROM tmp_stock_data;")
+        rows = [(code, day, cycle, *[np.nan if value is None else value for value in values])
+                for code, day, cycle, *values in cursor.fetchall()]
+    conn.rollback()
+    same_rows(rows, expected_rows(batch))
@@ -0,0 +1,54 @@
+import os
+import pandas as pd
+import Pull_merga_stock
+from api_cache import ApiCache
+from rate_limiter import RateLimiter
+
+
+class FlakyPro:
+    """按股票返回一行日线；failures 给出每只股票前几次调用失败，调用记录写入文件，多个拉取进程共用。"""
+
+    def __init__(self, log_path, failures):
+        self.log_path = log_path
+        self.failures = failures
+
+    def daily(self, ts_code='', start_date='', end_date='', **kwargs):
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        os.write(fd, f'{ts_code}\n'.encode())
+        os.close(fd)
+        with open(self.log_path) as f:
+            calls = f.read().split().count(ts_code)
+        if calls <= self.failures.get(ts_code, 0):
+            raise Exception('模拟接口错误')
+        if ts_code == '000004.SZ':
+            return pd.DataFrame()
+        return pd.DataFrame({'ts_code': [ts_code], 'trade_date': [end_date], 'close': [10.0]})
+
+
+def calls_by_code(log_path):
+    with open(log_path) as f:
+        return pd.Series(f.read().split()).value_counts().to_dict()
+
+
+def test_failed_stocks_are_retried_with_backoff(tmp_path, monkeypatch):
+    log_path = str(tmp_path / 'calls.log')
+    # 000002 前两次失败后成功，000003 一直失败，000004 没有数据
+    pro = FlakyPro(log_path, {'000002.SZ': 2, '000003.SZ': 100})
+    monkeypatch.setattr(Pull_merga_stock, 'api', pro)
+    monkeypatch.setattr(Pull_merga_stock, 'limiter', RateLimiter(calls_per_minute=10**6, max_concurrency=2))
+    monkeypatch.setattr(Pull_merga_stock, 'cache', ApiCache(enabled=False))
+    delays = []
+    monkeypatch.setattr(Pull_merga_stock, 'retry_delay', lambda attempt: delays.append(attempt) or 0)
+
+    codes = ['000001.SZ', '000002.SZ', '000003.SZ', '000004.SZ']
+    args_list = [(code, '20240101', '20240628', 'token') for code in codes]
+    all_data, successful, failures = Pull_merga_stock.fetch_stock_data_parallel(args_list, 2, max_attempts=4)
+
+    assert successful == 2
+    assert sorted(pd.concat(all_data)['ts_code']) == ['000001.SZ', '000002.SZ']
+    assert list(failures) == ['000003.SZ']
+    assert failures['000003.SZ']['attempts'] == 4
+    assert failures['000003.SZ']['error'] == '模拟接口错误'
+    assert calls_by_code(log_path) == {'000001.SZ': 1, '000002.SZ': 3, '000003.SZ': 4, '000004.SZ': 1}
+    # 每次失败按已尝试次数计算退避时间
+    assert sorted(delays) == [1, 1, 2, 2, 3]
@@ -0,0 +1,95 @@
+import pandas as pd
+import pytest
+from Generating_periodic_data import CYCLE_FREQS, PERIODIC_COLUMNS, STATE_FILE, generate_periodic_data, resample_all_cycles
+from run_manifest import RunManifest
+from storage import get_storage
+from synthetic_data import make_daily
+
+# 第一天拉取完整历史，第二天增量拉取之后的日线；分界日在周中、月中
+FIRST_DATE = '20240515'
+SECOND_DATE = '20240628'
+
+
+@pytest.fixture
+def daily(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return make_daily(20, years=2, end_date=SECOND_DATE, seed=5)
+
+
+def save_dataset(daily, run_date, incremental):
+    """按拉取阶段的方式保存数据集 merged_stocks_data_{run_date}，并在运行清单中记录是否为增量拉取。"""
+    get_storage().write(daily, f'merged_stocks_data_{run_date}')
+    RunManifest(run_date).mark_done('fetch', rows=len(daily), failed=0, incremental=incremental)
+
+
+def read_cycle(name, cycle):
+    bars = get_storage().read(name, cycles=[cycle])[PERIODIC_COLUMNS]
+    bars['ts_code'] = bars['ts_code'].astype(str)
+    return bars.sort_values(['ts_code', 'trade_date']).reset_index(drop=True)
+
+
+def expected_bars(daily, cycle, since=None):
+    """全部日线一次性聚合的K线；since 给出时只保留该日及之后结束的K线，即包含新增日线、需要重新写入的K线。"""
+    bars = resample_all_cycles(daily, cycles=[cycle])[cycle][PERIODIC_COLUMNS]
+    bars['ts_code'] = bars['ts_code'].astype(str)
+    if since is not None:
+        bars = bars[bars['trade_date'] >= pd.Timestamp(since)]
+    return bars.sort_values(['ts_code', 'trade_date']).reset_index(drop=True)
+
+
+def assert_bars_equal(actual, expected):
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False, check_categorical=False, rtol=1e-6)
+
+
+def test_incremental_matches_full_generation(daily):
+    first = daily[daily['trade_date'] <= FIRST_DATE]
+    save_dataset(first, FIRST_DATE, incremental=False)
+    generate_periodic_data(full=True, workers=1)
+
+    second = daily[daily['trade_date'] > FIRST_DATE]
+    save_dataset(second, SECOND_DATE, incremental=True)
+    generate_periodic_data(workers=1)
+
+    for cycle in CYCLE_FREQS:
+        assert_bars_equal(read_cycle(f'merged_stocks_data_{SECOND_DATE}', cycle),
+                          expected_bars(daily, cycle, since=second['trade_date'].min()))
+
+
+def test_full_refuses_incremental_dataset(daily):
+    save_dataset(daily[daily['trade_date'] <= FIRST_DATE], FIRST_DATE, incremental=False)
+    generate_periodic_data(full=True, workers=1)
+    with open(STATE_FILE, encoding='utf-8') as f:
+        state = f.read()
+
+    # 增量拉取的数据集只有最近的日线，完整重新生成会用它覆盖状态文件
+    save_dataset(daily[daily['trade_date'] > FIRST_DATE], SECOND_DATE, incremental=True)
+    with pytest.raises(ValueError):
+        generate_periodic_data(full=True, workers=1)
+    with open(STATE_FILE, encoding='utf-8') as f:
+        assert f.read() == state
+    assert get_storage().cycles(f'merged_stocks_data_{SECOND_DATE}') == ['daily']
+
+
+def generate_two_days(daily, workers):
+    """按分片数 workers 完整生成第一天、增量生成第二天，返回两个数据集的全部周期K线。"""
+    save_dataset(daily[daily['trade_date'] <= FIRST_DATE], FIRST_DATE, incremental=False)
+    generate_periodic_data(full=True, workers=workers)
+    save_dataset(daily[daily['trade_date'] > FIRST_DATE], SECOND_DATE, incremental=True)
+    generate_periodic_data(workers=workers)
+    return {(run_date, cycle): read_cycle(f'merged_stocks_data_{run_date}', cycle)
+            for run_date in (FIRST_DATE, SECOND_DATE) for cycle in CYCLE_FREQS}
+
+
+def test_sharded_matches_unsharded(daily, tmp_path, monkeypatch):
+    (tmp_path / 'single').mkdir()
+    (tmp_path / 'sharded').mkdir()
+    monkeypatch.chdir(tmp_path / 'single')
+    expected = generate_two_days(daily, workers=1)
+    # 分片由工作进程生成并直接写入数据集，各分片的增量状态合并后与单进程一致
+    monkeypatch.chdir(tmp_path / 'sharded')
+    actual = generate_two_days(daily, workers=3)
+    for key in expected:
+        assert_bars_equal(actual[key], expected[key])
+    state = pd.read_csv(STATE_FILE).sort_values(['cycle', 'ts_code']).reset_index(drop=True)
+    expected_state = pd.read_csv(tmp_path / 'single' / STATE_FILE).sort_values(['cycle', 'ts_code']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(state, expected_state)
@@ -0,0 +1,73 @@
+import os
+import pandas as pd
+import pytest
+import schema
+import db_pool
+import periodic_sql
+from synthetic_data import make_daily
+from Upload_database import create_table_sql, prepare_staging, copy_batch, upsert_sql
+
+# 每次运行使用独立的表，结束后删除
+TABLE = f'test_periodic_{os.getpid()}'
+
+
+def daily_rows(num_stocks=12):
+    daily = make_daily(num_stocks, years=2, end_date='20240628', seed=3)
+    daily['trade_date'] = pd.to_datetime(daily['trade_date'])
+    daily['cycle'] = 'daily'
+    return schema.apply_schema(daily)
+
+
+def load_daily(conn, daily):
+    """按上传阶段的方式 upsert 日线并推进水位。"""
+    prepare_staging(conn)
+    with conn:
+        with conn.cursor() as cursor:
+            copy_batch(cursor, daily, 'binary')
+            cursor.execute(upsert_sql(TABLE))
+            cursor.execute(f"""
+                INSERT INTO {TABLE}_watermark (ts_code, cycle, trade_date)
+                SELECT ts_code, cycle, max(trade_date) FROM tmp_stock_data GROUP BY ts_code, cycle
+                ON CONFLICT (ts_code, cycle) DO UPDATE SET
+                    trade_date=GREATEST({TABLE}_watermark.trade_date, EXCLUDED.trade_date);
+            """)
+
+
+@pytest.fixture
+def conn():
+    try:
+        conn = db_pool.connect(max_attempts=1)
+    except Exception as e:
+        pytest.skip(f"无法连接 PostgreSQL：{e}")
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute(create_table_sql(TABLE))
+    yield conn
+    conn.rollback()
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {TABLE}, {TABLE}_watermark, {TABLE}_periodic_state;")
+    conn.close()
+
+
+def test_refresh_matches_resample_all_cycles(conn):
+    daily = daily_rows()
+    load_daily(conn, daily)
+    periodic_sql.refresh(conn, TABLE)
+    codes = sorted(daily['ts_code'].astype(str).unique())
+    assert periodic_sql.verify(conn, TABLE, codes=codes) == {cycle: 0 for cycle in periodic_sql.CYCLE_FREQS}
+
+
+def test_incremental_refresh_matches_resample_all_cycles(conn):
+    daily = daily_rows()
+    # 先聚合到周中、月中，再追加之后的日线，最后一个未结束的周期需要重新聚合
+    split = pd.Timestamp('2024-05-15')
+    load_daily(conn, daily[daily['trade_date'] < split])
+    periodic_sql.refresh(conn, TABLE)
+
+    new_daily = daily[daily['trade_date'] >= split]
+    load_daily(conn, new_daily)
+    since = new_daily.groupby(new_daily['ts_code'].astype(str))['trade_date'].min()
+    periodic_sql.refresh(conn, TABLE, since=since)
+    codes = sorted(daily['ts_code'].astype(str).unique())
+    assert periodic_sql.verify(conn, TABLE, codes=codes) == {cycle: 0 for cycle in periodic_sql.CYCLE_FREQS}
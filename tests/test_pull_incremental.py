@@ -0,0 +1,171 @@
+import json
+import pandas as pd
+import pytest
+import Pull_merga_stock
+from api_cache import ApiCache
+from rate_limiter import RateLimiter
+from run_manifest import RunManifest
+from storage import get_storage
+
+END_DATE = '20240109'
+# 2024-01-03 之后的交易日（周一至周五），全局水位为 2024-01-03
+TRADE_DATES = ['20240104', '20240105', '20240108', '20240109']
+
+
+class StubPro:
+    """按参数返回固定日线的 pro 接口；failing_dates 中的交易日整市场拉取时报错。可序列化，供拉取进程使用。"""
+
+    def __init__(self, daily, failing_dates=()):
+        self.daily_data = daily
+        self.failing_dates = set(failing_dates)
+
+    def daily(self, ts_code='', trade_date='', start_date='', end_date='', **kwargs):
+        data = self.daily_data
+        if trade_date:
+            if trade_date in self.failing_dates:
+                raise Exception('模拟接口错误')
+            return data[data['trade_date'] == trade_date].reset_index(drop=True)
+        data = data[(data['ts_code'] == ts_code) & (data['trade_date'] >= start_date) & (data['trade_date'] <= end_date)]
+        return data.reset_index(drop=True)
+
+    def trade_cal(self, start_date='', end_date='', **kwargs):
+        days = pd.date_range(start_date, end_date)
+        return pd.DataFrame({'cal_date': days.strftime('%Y%m%d'), 'is_open': (days.dayofweek < 5).astype(int)})
+
+
+def make_rows(code, dates):
+    return pd.DataFrame({'ts_code': code, 'trade_date': dates, 'open': 10.0, 'high': 11.0, 'low': 9.0, 'close': 10.5,
+                         'pre_close': 10.0, 'change': 0.5, 'pct_chg': 5.0, 'vol': 100.0, 'amount': 1000.0})
+
+
+def market():
+    """
+    000001、000002 正常交易；000003 新上市；000004 自 2023-12-29 起停牌；
+    000005 水位落后（上次运行时未拉到 2024-01-02 之后的日线）；000006 水位落后，2024-01-08 才恢复交易。
+    """
+    return pd.concat([
+        make_rows('000001.SZ', ['20240102', '20240103'] + TRADE_DATES),
+        make_rows('000002.SZ', ['20240102', '20240103'] + TRADE_DATES),
+        make_rows('000003.SZ', ['20240103'] + TRADE_DATES),
+        make_rows('000004.SZ', ['20231228']),
+        make_rows('000005.SZ', ['20231229', '20240102', '20240103'] + TRADE_DATES),
+        make_rows('000006.SZ', ['20231229', '20240102', '20240108', '20240109']),
+    ], ignore_index=True)
+
+
+WATERMARKS = pd.Series({'000001.SZ': '20240103', '000002.SZ': '20240103', '000004.SZ': '20231228',
+                        '000005.SZ': '20231229', '000006.SZ': '20231229'})
+CODES = ['000001.SZ', '000002.SZ', '000003.SZ', '000004.SZ', '000005.SZ', '000006.SZ']
+
+
+@pytest.fixture
+def pull(tmp_path, monkeypatch):
+    """在临时目录中运行，按股票拉取使用 2 个进程，限流不设上限，接口缓存关闭。"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Pull_merga_stock, 'limiter', RateLimiter(calls_per_minute=10**6, max_concurrency=2))
+    monkeypatch.setattr(Pull_merga_stock, 'cache', ApiCache(enabled=False))
+    monkeypatch.setattr(Pull_merga_stock, 'retry_delay', lambda attempt: 0)
+    # 记录每次按股票拉取请求的 (代码, 起始日期, 结束日期)
+    requests = []
+    fetch_stock_data = Pull_merga_stock.fetch_stock_data
+
+    def record_requests(args_list, *args, **kwargs):
+        requests.extend(a[:3] for a in args_list)
+        return fetch_stock_data(args_list, *args, **kwargs)
+    monkeypatch.setattr(Pull_merga_stock, 'fetch_stock_data', record_requests)
+
+    def run(pro, watermarks=WATERMARKS):
+        monkeypatch.setattr(Pull_merga_stock, 'api', pro)
+        Pull_merga_stock.fetch_and_save_stock_data_incremental(CODES, watermarks, '20100101', END_DATE, 'token', './data', 2,
+                                                               engine='process')
+        return read_dataset()
+    run.requests = requests
+    return run
+
+
+def read_dataset():
+    data = get_storage().read(f'merged_stocks_data_{END_DATE}')
+    data['ts_code'] = data['ts_code'].astype(str)
+    data['trade_date'] = data['trade_date'].dt.strftime('%Y%m%d')
+    return data
+
+
+def dates_by_code(data):
+    return {code: sorted(rows['trade_date']) for code, rows in data.groupby('ts_code')}
+
+
+def failure_entries():
+    path = Pull_merga_stock.failure_manifest_path('./data', END_DATE)
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def test_fetches_missing_trade_dates_and_new_listings(pull):
+    data = pull(StubPro(market()))
+    assert dates_by_code(data) == {
+        '000001.SZ': TRADE_DATES,
+        '000002.SZ': TRADE_DATES,
+        '000003.SZ': ['20240103'] + TRADE_DATES,
+        '000005.SZ': ['20240102', '20240103'] + TRADE_DATES,
+        '000006.SZ': ['20240102', '20240108', '20240109'],
+    }
+    # 停牌的 000004 在整市场日线中没有数据，不逐只请求
+    assert sorted(pull.requests) == [
+        ('000003.SZ', '20100101', END_DATE),
+        ('000005.SZ', '20231230', '20240103'),
+        ('000006.SZ', '20231230', '20240103'),
+    ]
+    assert failure_entries() == []
+    # 数据集只有水位之后的日线，不能据此完整重新生成周期数据
+    assert RunManifest(END_DATE, './data/state').data['stages']['fetch']['incremental'] is True
+
+
+def test_stops_at_failed_trade_date(pull):
+    # 20240108 整市场拉取失败，之后的交易日不能落盘，否则生成阶段会把水位推进到缺口之后
+    data = pull(StubPro(market(), failing_dates={'20240108'}))
+    assert dates_by_code(data) == {
+        '000001.SZ': ['20240104', '20240105'],
+        '000002.SZ': ['20240104', '20240105'],
+        # 新上市股票也只拉到失败交易日之前
+        '000003.SZ': ['20240103', '20240104', '20240105'],
+        '000005.SZ': ['20240102', '20240103', '20240104', '20240105'],
+    }
+    # 000006 在已拉取的交易日中没有成交，暂不补齐缺口
+    assert sorted(pull.requests) == [
+        ('000003.SZ', '20100101', '20240105'),
+        ('000005.SZ', '20231230', '20240103'),
+    ]
+    [entry] = failure_entries()
+    assert entry['trade_date'] == '20240108'
+    assert entry['end_date'] == END_DATE
+
+
+def test_retry_continues_from_failed_trade_date(pull, monkeypatch):
+    pull(StubPro(market(), failing_dates={'20240108'}))
+    # 补拉阶段只保留已有水位的股票，与增量拉取一致
+    monkeypatch.setattr(Pull_merga_stock, 'load_watermarks', lambda source='auto': WATERMARKS)
+    monkeypatch.setattr(Pull_merga_stock, 'api', StubPro(market()))
+    Pull_merga_stock.retry_failed_stocks('token', './data', END_DATE, 2, engine='process')
+    data = read_dataset()
+    dates = dates_by_code(data)
+    assert dates['000001.SZ'] == TRADE_DATES
+    assert dates['000005.SZ'] == ['20240102', '20240103'] + TRADE_DATES
+    # 000006 在补拉的交易日中恢复交易，同时补齐缺口；000005 已在拉取阶段补齐，不再请求
+    assert dates['000006.SZ'] == ['20240102', '20240108', '20240109']
+    assert sorted(pull.requests)[-1] == ('000006.SZ', '20231230', '20240103')
+    assert len(pull.requests) == 3
+    assert not data.duplicated(['ts_code', 'trade_date']).any()
+    assert failure_entries() == []
+
+
+def test_retry_failing_again_keeps_the_gap(pull, monkeypatch):
+    pull(StubPro(market(), failing_dates={'20240108'}))
+    monkeypatch.setattr(Pull_merga_stock, 'load_watermarks', lambda source='auto': WATERMARKS)
+    monkeypatch.setattr(Pull_merga_stock, 'api', StubPro(market(), failing_dates={'20240109'}))
+    Pull_merga_stock.retry_failed_stocks('token', './data', END_DATE, 2, engine='process')
+    assert dates_by_code(read_dataset())['000001.SZ'] == ['20240104', '20240105', '20240108']
+    [entry] = failure_entries()
+    assert (entry['trade_date'], entry['attempts']) == ('20240109', 2)
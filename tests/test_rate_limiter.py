@@ -0,0 +1,106 @@
+import pytest
+import rate_limiter
+from metrics import ApiMetrics
+from rate_limiter import RateLimiter
+
+
+class FakeClock:
+    """代替 time 模块，sleep 只推进时钟。"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    return clock
+
+
+def make_limiter(**kwargs):
+    return RateLimiter(metrics=ApiMetrics(), **kwargs)
+
+
+def test_tokens_refill_at_configured_rate(clock):
+    limiter = make_limiter(calls_per_minute=60, max_concurrency=5)
+    assert limiter.try_acquire() == 0
+    limiter.release()
+    # 每秒补充一个令牌，桶容量为 1
+    assert limiter.try_acquire() == pytest.approx(1.0)
+    clock.sleep(0.5)
+    assert limiter.try_acquire() == pytest.approx(0.5)
+    clock.sleep(0.5)
+    assert limiter.try_acquire() == 0
+
+
+def test_concurrency_limits_requests_in_flight(clock):
+    limiter = make_limiter(calls_per_minute=6000, max_concurrency=4, initial_concurrency=2)
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() > 0
+    limiter.release()
+    assert limiter.try_acquire() == 0
+
+
+def test_concurrency_ramps_up_after_successes(clock):
+    limiter = make_limiter(calls_per_minute=6000, max_concurrency=2, initial_concurrency=1, ramp_up_after=3)
+    for _ in range(3):
+        limiter.call(lambda: None)
+    assert limiter.stats()['concurrency'] == 2
+    for _ in range(10):
+        limiter.call(lambda: None)
+    assert limiter.stats()['concurrency'] == 2
+
+
+def test_quota_error_halves_concurrency_and_retries(clock):
+    limiter = make_limiter(calls_per_minute=6000, max_concurrency=8, initial_concurrency=8, cooldown=20.0)
+    errors = ['抱歉，您每分钟最多访问该接口500次', '抱歉，您每分钟最多访问该接口500次']
+
+    def daily():
+        if errors:
+            raise Exception(errors.pop())
+        return 'data'
+
+    start = clock.now
+    assert limiter.call(daily, api_name='daily') == 'data'
+    stats = limiter.stats()
+    assert stats['concurrency'] == 2
+    assert stats['quota_errors'] == 2
+    # 每次频率超限后暂停发放令牌 cooldown 秒
+    assert clock.now - start >= 40.0
+    assert limiter.metrics.snapshot()['daily']['retries'] == 2
+
+
+def test_other_errors_and_exhausted_retries_are_raised(clock):
+    limiter = make_limiter(calls_per_minute=6000, max_concurrency=2, max_quota_retries=1, cooldown=1.0)
+
+    def broken():
+        raise ValueError('参数错误')
+    with pytest.raises(ValueError):
+        limiter.call(broken)
+    assert limiter.stats()['quota_errors'] == 0
+
+    def over_quota():
+        raise Exception('频率超限')
+    with pytest.raises(Exception, match='频率超限'):
+        limiter.call(over_quota)
+    assert limiter.stats()['quota_errors'] == 1
+    # 失败的调用也归还并发名额
+    assert limiter.try_acquire() == 0
+
+
+def test_retry_delay_backs_off_exponentially():
+    for attempt in range(1, 10):
+        expected = min(60.0, 2.0 * 2 ** (attempt - 1))
+        delays = [rate_limiter.retry_delay(attempt) for _ in range(50)]
+        assert all(0.5 * expected <= delay <= 1.5 * expected for delay in delays)
@@ -0,0 +1,38 @@
+from run_manifest import STAGES, RunManifest
+
+
+def test_progress_survives_reload(tmp_path):
+    manifest = RunManifest('20240628', str(tmp_path))
+    manifest.check_params('upload', rows=100, batch_size=10)
+    manifest.add_units('upload', [0, 1])
+    manifest.mark_done('fetch', rows=100)
+
+    # 参数一致时保留已完成的单元，不一致时清空该阶段
+    reloaded = RunManifest('20240628', str(tmp_path))
+    reloaded.check_params('upload', rows=100, batch_size=10)
+    assert reloaded.done_units('upload') == {0, 1}
+    assert reloaded.is_done('fetch')
+    reloaded.check_params('upload', rows=100, batch_size=20)
+    assert RunManifest('20240628', str(tmp_path)).done_units('upload') == set()
+
+
+def test_parallel_stages_keep_each_others_progress(tmp_path):
+    # 并行运行的阶段各自持有清单对象，保存时只覆盖自己修改的阶段
+    upload = RunManifest('20240628', str(tmp_path))
+    bar_store = RunManifest('20240628', str(tmp_path))
+    upload.add_units('upload', [0])
+    bar_store.mark_done('bar_store')
+    upload.add_units('upload', [1])
+    manifest = RunManifest('20240628', str(tmp_path))
+    assert manifest.done_units('upload') == {0, 1}
+    assert manifest.is_done('bar_store')
+
+
+def test_summary_lists_recorded_stages(tmp_path):
+    manifest = RunManifest('20240628', str(tmp_path))
+    manifest.mark_done('fetch')
+    manifest.add_units('upload:stock_data_qfq', [0])
+    parts = manifest.summary().split('，')
+    assert [part.split(':')[0] for part in parts[:len(STAGES)]] == STAGES
+    assert parts[0] == 'fetch: 已完成'
+    assert parts[-1] == 'upload:stock_data_qfq: 已完成 1 个单元'
@@ -0,0 +1,60 @@
+import os
+import pandas as pd
+import pytest
+from storage import get_storage
+from synthetic_data import make_daily
+
+
+@pytest.fixture(params=['parquet', 'csv'])
+def storage(request, tmp_path):
+    return get_storage(request.param, data_dir=str(tmp_path))
+
+
+def stock_frames():
+    daily = make_daily(6, years=1, end_date='20240628', seed=11)
+    return {code: rows.reset_index(drop=True) for code, rows in daily.groupby('ts_code')}
+
+
+def read_keys(storage, name):
+    data = storage.read(name)
+    return data['ts_code'].astype(str).value_counts().sort_index()
+
+
+def test_sink_resumes_after_crash(storage):
+    frames = stock_frames()
+    codes = sorted(frames)
+    sink = storage.open_sink('merged_stocks_data_20240628', flush_rows=1)
+    for code in codes[:3]:
+        sink.write(frames[code], [code])
+    # 模拟崩溃：缓冲区中的数据和落盘后没有记入进度的数据都应丢弃
+    sink.flush_rows = 10**9
+    sink.write(frames[codes[3]], [codes[3]])
+    if storage.fmt == 'parquet':
+        storage.insert(frames[codes[3]], 'merged_stocks_data_20240628.partial', basename='part-00099')
+    else:
+        with open(sink.partial_file, 'a', encoding='utf-8') as f:
+            f.write('000000.SZ,2024010')
+    del sink
+
+    sink = storage.open_sink('merged_stocks_data_20240628', flush_rows=1)
+    assert sink.done_keys == set(codes[:3])
+    assert sink.rows_written == sum(len(frames[code]) for code in codes[:3])
+    for code in codes[3:]:
+        sink.write(frames[code], [code])
+    assert sink.close()
+
+    counts = read_keys(storage, 'merged_stocks_data_20240628')
+    expected = pd.Series({code: len(frames[code]) for code in codes}, name='count').sort_index()
+    assert counts.to_dict() == expected.to_dict()
+    assert not os.path.exists(sink.partial_dir if storage.fmt == 'parquet' else sink.partial_file)
+    assert not os.path.exists(sink.progress_file)
+
+
+def test_publish_replaces_existing_dataset(storage):
+    frames = stock_frames()
+    codes = sorted(frames)
+    storage.write(pd.concat([frames[code] for code in codes]), 'merged_stocks_data_20240628')
+    sink = storage.open_sink('merged_stocks_data_20240628', flush_rows=1)
+    sink.write(frames[codes[0]], [codes[0]])
+    assert sink.close()
+    assert read_keys(storage, 'merged_stocks_data_20240628').to_dict() == {codes[0]: len(frames[codes[0]])}
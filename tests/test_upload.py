@@ -0,0 +1,74 @@
+import os
+import pandas as pd
+import pytest
+import db_pool
+import schema
+import Upload_database
+from run_manifest import RunManifest
+from synthetic_data import make_daily
+
+# 每次运行使用独立的表，结束后删除
+TABLE = f'test_upload_{os.getpid()}'
+FIRST_DATE = '20240531'
+SECOND_DATE = '20240628'
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    try:
+        conn = db_pool.connect(max_attempts=1)
+    except Exception as e:
+        pytest.skip(f"无法连接 PostgreSQL：{e}")
+    yield conn
+    conn.rollback()
+    with conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {TABLE}, {TABLE}_watermark CASCADE;")
+    conn.close()
+
+
+def daily_rows():
+    daily = make_daily(8, years=1, end_date=SECOND_DATE, seed=7)
+    daily['trade_date'] = pd.to_datetime(daily['trade_date'])
+    daily['cycle'] = 'daily'
+    return schema.apply_schema(daily)
+
+
+def upload(data, run_date):
+    Upload_database.main(data=data.copy(), batch_size=40, workers=2, sync_mode='delta', table=TABLE,
+                         periodic_mode='python', run_date=run_date)
+
+
+def test_delta_upload_resumes_after_partial_commit(conn, monkeypatch):
+    daily = daily_rows()
+    upload(daily[daily['trade_date'] <= pd.Timestamp(FIRST_DATE)], FIRST_DATE)
+
+    # 第二天只提交第一个批次后中断：已提交批次推进了库中水位，重新计算的增量会变少
+    calls = []
+    upload_batches = Upload_database.upload_batches
+
+    def interrupted(data, batch_indexes, *args, **kwargs):
+        calls.append(list(batch_indexes))
+        rows, _ = upload_batches(data, batch_indexes[:1], *args, **kwargs)
+        return rows, len(batch_indexes) - 1
+    monkeypatch.setattr(Upload_database, 'upload_batches', interrupted)
+    upload(daily, SECOND_DATE)
+    assert not RunManifest(SECOND_DATE).is_done(Upload_database.upload_stage(TABLE))
+
+    def resumed(data, batch_indexes, *args, **kwargs):
+        calls.append(list(batch_indexes))
+        return upload_batches(data, batch_indexes, *args, **kwargs)
+    monkeypatch.setattr(Upload_database, 'upload_batches', resumed)
+    upload(daily, SECOND_DATE)
+
+    # 继续时只上传未提交的批次，批次划分与第一次相同
+    assert len(calls[0]) > 1
+    assert calls[1] == calls[0][1:]
+    assert RunManifest(SECOND_DATE).is_done(Upload_database.upload_stage(TABLE))
+    assert not [name for name in os.listdir('./data/state') if name.startswith('upload_selection_')]
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT count(*), count(DISTINCT (ts_code, trade_date)), sum(close::numeric) FROM {TABLE};")
+        count, distinct, total_close = cursor.fetchone()
+    assert count == distinct == len(daily)
+    assert float(total_close) == pytest.approx(daily['close'].astype('float64').sum(), rel=1e-9)